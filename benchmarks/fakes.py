@@ -0,0 +1,159 @@
+import json
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+from typing import Dict, List
+
+import numpy as np
+
+
+def deterministic_vector(text: str, dimension: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+
+
+class FakeEmbedding(dict):
+    # Pinecone embeddings are read both as embedding["values"] and embedding.values
+    @property
+    def values(self) -> List[float]:
+        return self["values"]
+
+
+class FakeInference:
+
+    def __init__(self, latency_s: float, dimension: int):
+        self.latency_s = latency_s
+        self.dimension = dimension
+        self.calls = 0
+
+    def embed(self, model: str, inputs: List[str], parameters: Dict) -> List[FakeEmbedding]:
+        time.sleep(self.latency_s)
+        self.calls += 1
+        return [FakeEmbedding(values=deterministic_vector(text, self.dimension).tolist()) for text in inputs]
+
+
+class FakeIndex:
+    """
+    In-memory stand-in for a Pinecone Index: exact cosine search plus a fixed latency per call.
+    """
+
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+        self._namespaces: Dict[str, Dict[str, np.ndarray]] = {}
+        self._matrices = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: List[Dict], namespace: str) -> None:
+        time.sleep(self.latency_s)
+        with self._lock:
+            namespace_vectors = self._namespaces.setdefault(namespace, {})
+            for vector in vectors:
+                values = np.asarray(vector["values"], dtype=np.float32)
+                namespace_vectors[vector["id"]] = values / (np.linalg.norm(values) or 1.0)
+            self._matrices.pop(namespace, None)
+
+    def delete(self, ids: List[str], namespace: str) -> None:
+        time.sleep(self.latency_s)
+        with self._lock:
+            for vector_id in ids:
+                self._namespaces.get(namespace, {}).pop(vector_id, None)
+            self._matrices.pop(namespace, None)
+
+    def _matrix(self, namespace: str):
+        with self._lock:
+            if namespace not in self._matrices:
+                namespace_vectors = self._namespaces.get(namespace, {})
+                ids = list(namespace_vectors)
+                matrix = np.stack([namespace_vectors[i] for i in ids]) if ids else np.zeros((0, 0), np.float32)
+                self._matrices[namespace] = (ids, matrix)
+            return self._matrices[namespace]
+
+    def query(self, namespace: str, vector: List[float], top_k: int, **kwargs) -> Dict:
+        time.sleep(self.latency_s)
+        ids, matrix = self._matrix(namespace)
+        if not ids:
+            return {"matches": []}
+
+        vector = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+        top = np.argsort(-scores)[:top_k]
+        return {"matches": [{"id": ids[row], "score": float(scores[row])} for row in top]}
+
+    def describe_index_stats(self) -> Dict:
+        with self._lock:
+            namespaces = {namespace: {"vector_count": len(vectors)} for namespace, vectors in self._namespaces.items()}
+        return {
+            "namespaces": namespaces,
+            "total_vector_count": sum(namespace["vector_count"] for namespace in namespaces.values())
+        }
+
+
+class FakePinecone:
+
+    def __init__(self, embed_latency_s: float, index_latency_s: float, dimension: int = 1024):
+        self.inference = FakeInference(embed_latency_s, dimension)
+        self.index_latency_s = index_latency_s
+        self._indexes = {}
+
+    def Index(self, name: str) -> FakeIndex:
+        if name not in self._indexes:
+            self._indexes[name] = FakeIndex(self.index_latency_s)
+        return self._indexes[name]
+
+
+class FakeTextEncoder:
+    """
+    Stands in for CLIPTextEncoder, with a fixed cost per forward pass.
+    """
+
+    def __init__(self, latency_s: float, dimension: int = 512):
+        self.latency_s = latency_s
+        self.dimension = dimension
+        self.cache_key = "fake-clip"
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency_s)
+        return [deterministic_vector(text, self.dimension).tolist() for text in texts]
+
+
+class FakeBatches:
+    """
+    Stand-in for client.messages.batches. A batch ends batch_latency_s after it is created, and each request's
+    result is a tag set drawn from `tag_vocabulary`.
+    """
+
+    def __init__(self, batch_latency_s: float, tag_vocabulary: List[str]):
+        self.batch_latency_s = batch_latency_s
+        self.tag_vocabulary = tag_vocabulary
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def create(self, requests: List[Dict]) -> SimpleNamespace:
+        with self._lock:
+            batch_id = f"msgbatch_{len(self._batches):06d}"
+            self._batches[batch_id] = {
+                "ends_at": time.monotonic() + self.batch_latency_s,
+                "custom_ids": [request["custom_id"] for request in requests]
+            }
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id: str) -> SimpleNamespace:
+        ended = time.monotonic() >= self._batches[batch_id]["ends_at"]
+        return SimpleNamespace(id=batch_id, processing_status="ended" if ended else "in_progress")
+
+    def results(self, batch_id: str):
+        for custom_id in self._batches[batch_id]["custom_ids"]:
+            rng = np.random.default_rng(int(hashlib.sha256(custom_id.encode()).hexdigest()[:8], 16))
+            tags = rng.choice(self.tag_vocabulary, size=4, replace=False).tolist()
+            text = json.dumps({"email_content_description": "synthetic", "tags": tags})
+            yield SimpleNamespace(
+                custom_id=custom_id,
+                result=SimpleNamespace(type="succeeded", message=SimpleNamespace(content=[SimpleNamespace(text=text)]))
+            )
+
+
+class FakeAnthropic:
+
+    def __init__(self, batch_latency_s: float, tag_vocabulary: List[str]):
+        self.messages = SimpleNamespace(batches=FakeBatches(batch_latency_s, tag_vocabulary))
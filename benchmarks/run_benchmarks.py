@@ -0,0 +1,355 @@
+"""
+Offline benchmarks for index builds and queries. Pinecone, Anthropic message batches and the CLIP text encoder are
+replaced by the stand-ins in fakes.py, each with a configurable latency, so no API keys or models are needed.
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000 --output benchmarks/results
+
+Each library size runs in its own process with its own PROJECT_DATA_ROOT, so the peak RSS reported for a size is
+not inflated by the sizes before it. Results for all sizes are written to one JSON file per run.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import platform
+import subprocess
+import tempfile
+import threading
+import urllib.request
+from urllib.parse import urlencode
+from datetime import datetime, timezone
+from functools import partial
+from typing import Callable, Dict, List
+
+import numpy as np
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BENCHMARKS_FOLDER)
+sys.path.append(os.path.join(BENCHMARKS_FOLDER, "..", "utlities"))
+
+BENCHMARK_INDEX_NAME = "benchmark"
+BUILD_INDEX_NAME = "benchmark-build"
+CLIP_INDEX_NAME = "benchmark-clip"
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _latency_summary(latencies_s: List[float]) -> Dict[str, float]:
+    latencies_ms = np.asarray(latencies_s) * 1000
+    return {
+        "count": len(latencies_ms),
+        "mean_ms": float(latencies_ms.mean()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(latencies_ms.max())
+    }
+
+
+def _time_queries(query: Callable[[str], List[Dict]], queries: List[str]) -> Dict[str, float]:
+    latencies = []
+    for query_text in queries:
+        start = time.perf_counter()
+        query(query_text)
+        latencies.append(time.perf_counter() - start)
+    return _latency_summary(latencies)
+
+
+def _throughput(items: int, seconds: float) -> Dict[str, float]:
+    return {"items": items, "seconds": seconds, "items_per_second": items / seconds if seconds else 0.0}
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _load_test_service(service, queries: List[str], clients: int) -> Dict:
+    """
+    Sends every query to the service from `clients` threads at once, and reports throughput and CPU time per request.
+    """
+    next_query = iter(queries)
+    next_query_lock = threading.Lock()
+    latencies, rejected = [], []
+
+    def client() -> None:
+        while True:
+            with next_query_lock:
+                query = next(next_query, None)
+            if query is None:
+                return
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(f"{service.base_url}/search?{urlencode({'q': query})}") as response:
+                    response.read()
+                latencies.append(time.perf_counter() - start)
+            except urllib.error.HTTPError as e:
+                rejected.append(e.code)
+
+    cpu_start, start = _cpu_seconds(), time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds, cpu_seconds = time.perf_counter() - start, _cpu_seconds() - cpu_start
+
+    return {
+        **_throughput(len(latencies), seconds),
+        **_latency_summary(latencies),
+        "rejected": len(rejected),
+        "cpu_ms_per_request": cpu_seconds * 1000 / max(len(latencies), 1),
+        "engines": service.metrics()["engines"]
+    }
+
+
+def run_single_size(size: int, args: argparse.Namespace) -> Dict:
+    """
+    Runs every stage against one synthetic library. PROJECT_DATA_ROOT must already point at an empty folder.
+    """
+    # Imported here, since directories.py reads PROJECT_DATA_ROOT at import time
+    import pinecone_index_utilities
+    import display
+    from directories import IMAGES_FOLDER
+    from batch_poller import MessageBatchPoller
+    from embedding_cache import QueryEmbeddingCache
+    from generate_rag_keywords import KeywordRAGIndexCreator
+    from query_service import QueryService
+    from tag_set_store import TagSetStore
+    from tracing import HistogramExporter, get_tracer
+    from vector_store import LocalVectorStore, PineconeVectorStore
+
+    from fakes import FakeAnthropic, FakePinecone, FakeTextEncoder, deterministic_vector
+    from synthetic_library import TAG_VOCABULARY, create_synthetic_library, synthetic_queries
+
+    fake_pinecone = FakePinecone(
+        embed_latency_s=args.embed_latency_ms / 1000,
+        index_latency_s=args.index_latency_ms / 1000
+    )
+    pinecone_index_utilities.get_pinecone_client = lambda: fake_pinecone
+    display.get_pinecone_client = lambda: fake_pinecone
+
+    # The fake batches end within seconds, so poll at a matching rate
+    MessageBatchPoller.MIN_POLL_INTERVAL = min(MessageBatchPoller.MIN_POLL_INTERVAL, args.batch_latency_s / 4)
+    MessageBatchPoller.SECONDS_PER_OUTSTANDING_BATCH = 0.01
+
+    results = {"size": size, "stages": {}}
+
+    span_histogram = HistogramExporter()
+    if args.trace:
+        get_tracer().add_exporter(span_histogram)
+
+    start = time.perf_counter()
+    create_synthetic_library(IMAGES_FOLDER, TagSetStore(BENCHMARK_INDEX_NAME), size, seed=args.seed)
+    results["stages"]["generate_library"] = _throughput(size, time.perf_counter() - start)
+    print(f"[{size}] synthetic library ready")
+
+    if not args.skip_build:
+        creator = KeywordRAGIndexCreator(index_name=BUILD_INDEX_NAME, data_extraction_prompt="Describe this email.")
+        creator.CLIENT = FakeAnthropic(args.batch_latency_s, TAG_VOCABULARY)
+        start = time.perf_counter()
+        creator.create_image_tags_full_dataset()
+        results["stages"]["create_image_tags_full_dataset"] = _throughput(size, time.perf_counter() - start)
+        results["stages"]["create_image_tags_full_dataset"]["peak_rss_mb"] = _peak_rss_mb()
+        print(f"[{size}] build done")
+
+    if args.vector_store == "local":
+        keyword_store = LocalVectorStore.for_index(BENCHMARK_INDEX_NAME)
+    else:
+        keyword_store = PineconeVectorStore(fake_pinecone.Index(BENCHMARK_INDEX_NAME), namespace=BENCHMARK_INDEX_NAME)
+
+    start = time.perf_counter()
+    pinecone_index_utilities.get_embeddings_and_upsert(BENCHMARK_INDEX_NAME, vector_store=keyword_store)
+    results["stages"]["get_embeddings_and_upsert"] = _throughput(size, time.perf_counter() - start)
+    results["stages"]["get_embeddings_and_upsert"]["peak_rss_mb"] = _peak_rss_mb()
+    print(f"[{size}] upsert done")
+
+    queries = synthetic_queries(args.queries, seed=args.seed)
+
+    keyword_handler = display.KeyWordRAGSearchHandler(
+        BENCHMARK_INDEX_NAME,
+        vector_store=keyword_store,
+        embedding_cache=QueryEmbeddingCache()
+    )
+    results["stages"]["keyword_rag_query"] = _time_queries(keyword_handler.query, queries)
+    results["stages"]["keyword_rag_query"]["embedding_cache"] = keyword_handler.embedding_cache.stats()
+
+    # CLIP image vectors are random, since only the search and hydration costs matter here
+    clip_store = PineconeVectorStore(fake_pinecone.Index(CLIP_INDEX_NAME), namespace="ns1")
+    image_file_names = sorted(os.listdir(IMAGES_FOLDER))
+    for i in range(0, len(image_file_names), 1000):
+        clip_store.upsert([
+            {"id": image_file_name, "values": deterministic_vector(image_file_name, 512).tolist()}
+            for image_file_name in image_file_names[i:i + 1000]
+        ])
+
+    clip_handler = display.ImageEmbeddingsSearchHandler(
+        CLIP_INDEX_NAME,
+        vector_store=clip_store,
+        embedding_cache=QueryEmbeddingCache(),
+        text_encoder=FakeTextEncoder(args.clip_latency_ms / 1000)
+    )
+    results["stages"]["image_embeddings_query"] = _time_queries(clip_handler.query, queries)
+    results["stages"]["image_embeddings_query"]["embedding_cache"] = clip_handler.embedding_cache.stats()
+    print(f"[{size}] queries done")
+
+    # A multi-facet search over two keyword-RAG indexes and CLIP: one query per index in turn, vs one federated
+    # search. The one keyword-RAG index stands in for both, since only the embed calls and round trips matter here.
+    federated_handlers = [
+        display.KeyWordRAGSearchHandler(
+            BENCHMARK_INDEX_NAME,
+            vector_store=keyword_store,
+            embedding_cache=QueryEmbeddingCache(max_entries=0)
+        )
+        for _ in range(2)
+    ]
+    federated_clip_handler = display.ImageEmbeddingsSearchHandler(
+        CLIP_INDEX_NAME,
+        vector_store=clip_store,
+        embedding_cache=QueryEmbeddingCache(max_entries=0),
+        text_encoder=FakeTextEncoder(args.clip_latency_ms / 1000)
+    )
+    federated_handler = display.FederatedSearchHandler(
+        [],
+        keyword_rag_handlers=federated_handlers,
+        clip_handler=federated_clip_handler
+    )
+
+    def query_each_index(query_text: str) -> None:
+        for handler in federated_handlers + [federated_clip_handler]:
+            handler.query(query_text, inline_images=False)
+
+    results["stages"]["multi_index_query"] = {
+        "one_index_at_a_time": _time_queries(query_each_index, queries),
+        "federated": _time_queries(partial(federated_handler.query, inline_images=False), queries)
+    }
+    print(f"[{size}] multi-index queries done")
+
+    # Concurrent clients against the query service, one query per batch vs micro-batched. The handlers cache no
+    # embeddings, so every request pays for its embed call and CLIP forward pass.
+    results["stages"]["query_service"] = {}
+    service_queries = synthetic_queries(args.service_requests, seed=args.seed + 1, distinct=args.service_requests)
+    for label, max_batch_size, max_wait_ms in [
+        ("one_query_per_batch", 1, 0.0),
+        ("micro_batched", args.service_max_batch_size, args.service_max_wait_ms)
+    ]:
+        service = QueryService(
+            BENCHMARK_INDEX_NAME,
+            CLIP_INDEX_NAME,
+            port=0,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            max_queue_size=max(256, args.service_clients * 2),
+            keyword_rag_handler=display.KeyWordRAGSearchHandler(
+                BENCHMARK_INDEX_NAME,
+                vector_store=keyword_store,
+                embedding_cache=QueryEmbeddingCache(max_entries=0)
+            ),
+            clip_handler=display.ImageEmbeddingsSearchHandler(
+                CLIP_INDEX_NAME,
+                vector_store=clip_store,
+                embedding_cache=QueryEmbeddingCache(max_entries=0),
+                text_encoder=FakeTextEncoder(args.clip_latency_ms / 1000)
+            )
+        )
+        service.start()
+        results["stages"]["query_service"][label] = _load_test_service(
+            service, service_queries, args.service_clients
+        )
+        service.shutdown()
+    print(f"[{size}] query service done")
+
+    results["peak_rss_mb"] = _peak_rss_mb()
+    if args.trace:
+        results["spans"] = span_histogram.summary()
+    return results
+
+
+def _run_in_subprocess(size: int, args: argparse.Namespace, work_folder: str) -> Dict:
+    data_root = os.path.join(work_folder, str(size))
+    os.makedirs(data_root, exist_ok=True)
+    result_path = os.path.join(work_folder, f"{size}.json")
+
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--single-size", str(size), "--result-file", result_path]
+        + sys.argv[1:],
+        env={**os.environ, "PROJECT_DATA_ROOT": data_root, "PINECONE_API_KEY": "benchmark",
+             "ANTHROPIC_API_KEY": "benchmark"},
+        check=True
+    )
+    with open(result_path, "r") as f:
+        return json.load(f)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=500, help="queries per handler")
+    parser.add_argument("--embed-latency-ms", type=float, default=40.0, help="per Pinecone embed call")
+    parser.add_argument("--index-latency-ms", type=float, default=30.0, help="per vector index query/upsert/delete")
+    parser.add_argument("--clip-latency-ms", type=float, default=15.0, help="per CLIP text encoder forward pass")
+    parser.add_argument("--batch-latency-s", type=float, default=2.0, help="time until a message batch ends")
+    parser.add_argument("--vector-store", choices=["fake-pinecone", "local"], default="fake-pinecone",
+                        help="vector store behind the keyword-RAG index")
+    parser.add_argument("--service-clients", type=int, default=32, help="concurrent clients of the query service")
+    parser.add_argument("--service-requests", type=int, default=2000, help="requests sent to the query service")
+    parser.add_argument("--service-max-batch-size", type=int, default=32)
+    parser.add_argument("--service-max-wait-ms", type=float, default=3.0)
+    parser.add_argument("--skip-build", action="store_true", help="skip create_image_tags_full_dataset")
+    parser.add_argument("--trace", action="store_true", help="also report per-stage span timings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-folder", help="where libraries are generated; a temporary folder by default")
+    parser.add_argument("--output", default=os.path.join(BENCHMARKS_FOLDER, "results"))
+    parser.add_argument("--single-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = _parse_args()
+
+    if args.single_size is not None:
+        results = run_single_size(args.single_size, args)
+        with open(args.result_file, "w") as f:
+            json.dump(results, f)
+        return
+
+    config = {key: value for key, value in vars(args).items() if key not in ("single_size", "result_file")}
+    with tempfile.TemporaryDirectory(dir=args.work_folder) as work_folder:
+        runs = [_run_in_subprocess(size, args, work_folder) for size in args.sizes]
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "runs": runs
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = os.path.join(args.output, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for run in runs:
+        stages = run["stages"]
+        print(f"{run['size']:>7} images | keyword p50/p95/p99 "
+              f"{stages['keyword_rag_query']['p50_ms']:.1f}/{stages['keyword_rag_query']['p95_ms']:.1f}/"
+              f"{stages['keyword_rag_query']['p99_ms']:.1f} ms | clip p50/p95/p99 "
+              f"{stages['image_embeddings_query']['p50_ms']:.1f}/{stages['image_embeddings_query']['p95_ms']:.1f}/"
+              f"{stages['image_embeddings_query']['p99_ms']:.1f} ms | service "
+              f"{stages['query_service']['one_query_per_batch']['items_per_second']:.0f} -> "
+              f"{stages['query_service']['micro_batched']['items_per_second']:.0f} req/s | "
+              f"peak RSS {run['peak_rss_mb']:.0f} MB")
+    print(f"Results written to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
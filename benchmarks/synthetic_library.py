@@ -0,0 +1,78 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Tags look like what the keyword-RAG prompt produces, so BM25 and the tag strings have realistic shapes
+TAG_VOCABULARY = [
+    "abandoned cart", "welcome series", "product launch", "flash sale", "holiday promotion", "black friday",
+    "cyber monday", "back in stock", "price drop", "loyalty program", "referral offer", "birthday discount",
+    "newsletter", "product recommendations", "customer review", "survey request", "order confirmation",
+    "shipping update", "winback", "re-engagement", "free shipping", "limited time offer", "bundle deal",
+    "new arrivals", "best sellers", "gift guide", "seasonal collection", "minimalist design", "bold typography",
+    "lifestyle photography", "product grid", "countdown timer", "discount code", "call to action button",
+    "brand story", "sustainability", "apparel", "beauty", "home goods", "food and beverage", "fitness",
+    "subscription box", "mobile friendly", "dark mode", "illustration", "user generated content", "event invite",
+    "webinar", "app download", "pre-order"
+]
+
+IMAGE_WIDTH = 600
+IMAGE_HEIGHT = 1800
+IMAGES_PER_TASK = 200
+
+
+def _write_images(images_folder: str, start: int, stop: int, seed: int) -> None:
+    rng = np.random.default_rng(seed + start)
+    for image_number in range(start, stop):
+        # A few flat blocks, like the header / hero / product grid / footer layout of an email
+        image = Image.new("RGB", (IMAGE_WIDTH, IMAGE_HEIGHT), tuple(int(c) for c in rng.integers(0, 256, 3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(6):
+            top = int(rng.integers(0, IMAGE_HEIGHT - 100))
+            draw.rectangle(
+                (20, top, IMAGE_WIDTH - 20, top + int(rng.integers(50, 400))),
+                fill=tuple(int(c) for c in rng.integers(0, 256, 3))
+            )
+        image.save(os.path.join(images_folder, f"email_{image_number:06d}.png"))
+
+
+def synthetic_tag_set(rng: np.random.Generator) -> Dict[str, str | List[str]]:
+    return {
+        "email_content_description": "synthetic marketing email",
+        "email_type": rng.choice(TAG_VOCABULARY[:26]).item(),
+        "tags": rng.choice(TAG_VOCABULARY, size=int(rng.integers(4, 10)), replace=False).tolist()
+    }
+
+
+def create_synthetic_library(images_folder: str, tag_set_store, size: int, seed: int = 0, workers: int = None) -> None:
+    """
+    Writes `size` email-like PNGs to images_folder, and a tag set for each one to tag_set_store.
+    Images are rendered on a process pool; existing images are kept, so a library can be grown in place.
+    """
+    os.makedirs(images_folder, exist_ok=True)
+    existing = len([name for name in os.listdir(images_folder) if not name.startswith(".")])
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_write_images, images_folder, start, min(start + IMAGES_PER_TASK, size), seed)
+            for start in range(existing, size, IMAGES_PER_TASK)
+        ]
+        for future in futures:
+            future.result()
+
+    rng = np.random.default_rng(seed)
+    tag_set_store.put_many((f"email_{image_number:06d}", synthetic_tag_set(rng)) for image_number in range(size))
+
+
+def synthetic_queries(count: int, seed: int = 0, distinct: int = 200) -> List[str]:
+    """
+    `count` queries drawn from `distinct` one-to-three tag phrases, so repeated queries exercise the embedding cache.
+    """
+    rng = np.random.default_rng(seed)
+    phrases = [
+        " ".join(rng.choice(TAG_VOCABULARY, size=int(rng.integers(1, 4)), replace=False).tolist())
+        for _ in range(distinct)
+    ]
+    return [phrases[i] for i in rng.integers(0, distinct, count)]
@@ -0,0 +1,463 @@
+import os
+import json
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from directories import VECTOR_INDEXES_FOLDER
+from file_utilities import atomic_write_json
+from vector_store import VectorStore, LocalVectorStore, MappedIdTable
+
+# Rows handled at once when assigning or encoding, to bound temporary memory
+_CHUNK_ROWS = 16384
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _nearest_centroids(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin |x - c|^2 == argmax (x.c - |c|^2 / 2)
+    half_norms = 0.5 * np.einsum("kd,kd->k", centroids, centroids)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), _CHUNK_ROWS):
+        chunk = np.asarray(data[start:start + _CHUNK_ROWS], dtype=np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T - half_norms, axis=1)
+    return assignments
+
+
+def _kmeans(data: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest_centroids(data, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty clusters on random points rather than letting them die
+        centroids[empty] = data[rng.choice(len(data), size=int(empty.sum()), replace=False)]
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    Inverted-file index with product quantization, for inner-product search over L2-normalized vectors.
+
+    Vectors are assigned to the nearest of nlist coarse centroids, and the residual to that centroid is split into
+    subvectors of pq_subvector_dim dimensions, each stored as one byte (the nearest of 256 codebook entries).
+    With pq_subvector_dim=2 a vector takes dimension / 2 bytes instead of 4 * dimension, 8x less than float32,
+    plus its source row and id, which are not compressed.
+
+    A query scores only the lists of its nprobe nearest centroids, as centroid score plus the sum of per-subvector
+    lookups in a table computed once per query. Larger nprobe raises recall and latency. Given the exact vectors,
+    the best top_k * rerank_factor candidates are re-scored exactly, which recovers most of the quantization loss
+    for a handful of row reads.
+
+    On disk, codes, source rows and ids are raw arrays that are memory-mapped on load; meta.json is written last.
+    """
+
+    META_FILE = "meta.json"
+    IDS_FILE = "ids.utf8"
+    ID_ENDS_FILE = "id_ends.i64"
+    COARSE_CENTROIDS_FILE = "coarse_centroids.f32"
+    CODEBOOKS_FILE = "pq_codebooks.f32"
+    CODES_FILE = "codes.u8"
+    LIST_OFFSETS_FILE = "list_offsets.i64"
+    SOURCE_ROWS_FILE = "source_rows.i32"
+
+    CODEBOOK_SIZE = 256
+    # Residuals used to train each codebook; about 40 per entry is plenty
+    CODEBOOK_TRAIN_SIZE = 40 * CODEBOOK_SIZE
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        coarse_centroids: np.ndarray,
+        codebooks: np.ndarray,
+        codes: np.ndarray,
+        list_offsets: np.ndarray,
+        source_rows: np.ndarray,
+        source_version: int = None
+    ):
+        self.ids = ids
+        self.coarse_centroids = coarse_centroids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.list_offsets = list_offsets
+        # Row of each entry in the vectors the index was built from, used for exact re-scoring
+        self.source_rows = source_rows
+        self.source_version = source_version
+
+        self.dimension = coarse_centroids.shape[1]
+        self.nlist = coarse_centroids.shape[0]
+        self.subvector_count, self.codebook_size, self.subvector_dim = codebooks.shape
+        # Flat offsets into the (subvector, code) lookup table, for a single np.take per query
+        self._table_offsets = np.arange(self.subvector_count, dtype=np.intp) * self.codebook_size
+
+    @classmethod
+    def build(
+        cls,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        rows: np.ndarray = None,
+        nlist: int = None,
+        pq_subvector_dim: int = 2,
+        train_sample_size: int = 65536,
+        kmeans_iterations: int = 10,
+        seed: int = 0,
+        source_version: int = None
+    ) -> "IVFPQIndex":
+        """
+        vectors may be a memmap; it is read in chunks and only a training sample is held in memory as float32.
+        If rows is given, only those rows are indexed, e.g. the live rows of a store with deleted rows.
+        nlist defaults to 4 * sqrt(number of vectors).
+        """
+        if rows is None:
+            rows = np.arange(len(vectors))
+        count, dimension = len(rows), vectors.shape[1]
+        if dimension % pq_subvector_dim:
+            raise ValueError(f"Dimension {dimension} is not divisible by pq_subvector_dim {pq_subvector_dim}")
+        if count == 0:
+            raise ValueError("Cannot build an index without vectors")
+
+        rng = np.random.default_rng(seed)
+        nlist = min(nlist or max(1, int(4 * np.sqrt(count))), count)
+        subvector_count = dimension // pq_subvector_dim
+        codebook_size = min(cls.CODEBOOK_SIZE, count)
+
+        sample_rows = np.sort(rng.choice(count, size=min(train_sample_size, count), replace=False))
+        sample = _normalize(np.asarray(vectors[rows[sample_rows]], dtype=np.float32))
+
+        coarse_centroids = _kmeans(sample, nlist, kmeans_iterations, rng)
+
+        codebook_sample = sample[:cls.CODEBOOK_TRAIN_SIZE]
+        residuals = codebook_sample - coarse_centroids[_nearest_centroids(codebook_sample, coarse_centroids)]
+        residuals = residuals.reshape(len(codebook_sample), subvector_count, pq_subvector_dim)
+        codebooks = np.stack([
+            _kmeans(np.ascontiguousarray(residuals[:, j]), codebook_size, kmeans_iterations, rng)
+            for j in range(subvector_count)
+        ])
+
+        assignments = np.empty(count, dtype=np.int64)
+        codes = np.empty((count, subvector_count), dtype=np.uint8)
+        for start in range(0, count, _CHUNK_ROWS):
+            chunk = _normalize(np.asarray(vectors[rows[start:start + _CHUNK_ROWS]], dtype=np.float32))
+            chunk_assignments = _nearest_centroids(chunk, coarse_centroids)
+            chunk_residuals = (chunk - coarse_centroids[chunk_assignments]).reshape(len(chunk), subvector_count, -1)
+            for j in range(subvector_count):
+                codes[start:start + len(chunk), j] = _nearest_centroids(chunk_residuals[:, j], codebooks[j])
+            assignments[start:start + len(chunk)] = chunk_assignments
+
+        # Store each list contiguously
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=list_offsets[1:])
+
+        source_rows = rows[order]
+        return cls(
+            ids=[ids[row] for row in source_rows],
+            coarse_centroids=coarse_centroids,
+            codebooks=codebooks.astype(np.float32),
+            codes=codes[order],
+            list_offsets=list_offsets,
+            source_rows=source_rows.astype(np.int32),
+            source_version=source_version
+        )
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        for file_name, array in (
+            (self.COARSE_CENTROIDS_FILE, self.coarse_centroids),
+            (self.CODEBOOKS_FILE, self.codebooks),
+            (self.CODES_FILE, self.codes),
+            (self.LIST_OFFSETS_FILE, self.list_offsets),
+            (self.SOURCE_ROWS_FILE, self.source_rows)
+        ):
+            tmp_path = os.path.join(folder, file_name + ".tmp")
+            np.ascontiguousarray(array).tofile(tmp_path)
+            os.replace(tmp_path, os.path.join(folder, file_name))
+        if not isinstance(self.ids, MappedIdTable):
+            MappedIdTable.write(
+                list(self.ids),
+                os.path.join(folder, self.IDS_FILE),
+                os.path.join(folder, self.ID_ENDS_FILE)
+            )
+
+        atomic_write_json(os.path.join(folder, self.META_FILE), {
+            "dimension": self.dimension,
+            "nlist": self.nlist,
+            "subvector_count": self.subvector_count,
+            "codebook_size": self.codebook_size,
+            "subvector_dim": self.subvector_dim,
+            "source_version": self.source_version,
+            "count": len(self.ids)
+        })
+
+    @classmethod
+    def load(cls, folder: str) -> "IVFPQIndex":
+        with open(os.path.join(folder, cls.META_FILE), "r") as f:
+            meta = json.load(f)
+
+        def open_array(file_name: str, dtype, shape: Tuple) -> np.ndarray:
+            return np.memmap(os.path.join(folder, file_name), dtype=dtype, mode="r", shape=shape)
+
+        if "count" in meta:
+            count = meta["count"]
+            ids = MappedIdTable(os.path.join(folder, cls.IDS_FILE), os.path.join(folder, cls.ID_ENDS_FILE), count)
+        else:
+            # Saved before ids had their own files
+            ids = meta["ids"]
+            count = len(ids)
+
+        # Centroids and codebooks are small and read on every query, so they are loaded into memory
+        return cls(
+            ids=ids,
+            coarse_centroids=np.array(open_array(
+                cls.COARSE_CENTROIDS_FILE, np.float32, (meta["nlist"], meta["dimension"])
+            )),
+            codebooks=np.array(open_array(
+                cls.CODEBOOKS_FILE, np.float32, (meta["subvector_count"], meta["codebook_size"], meta["subvector_dim"])
+            )),
+            codes=open_array(cls.CODES_FILE, np.uint8, (count, meta["subvector_count"])),
+            list_offsets=np.array(open_array(cls.LIST_OFFSETS_FILE, np.int64, (meta["nlist"] + 1,))),
+            source_rows=open_array(cls.SOURCE_ROWS_FILE, np.int32, (count,)),
+            source_version=meta["source_version"]
+        )
+
+    def nbytes(self) -> int:
+        """
+        Size of the index, including its ID table.
+        """
+        return self.id_nbytes() + sum(
+            array.nbytes
+            for array in (self.coarse_centroids, self.codebooks, self.codes, self.list_offsets, self.source_rows)
+        )
+
+    def id_nbytes(self) -> int:
+        return MappedIdTable.encoded_nbytes(self.ids)
+
+    def _search(
+        self,
+        query: np.ndarray,
+        centroid_scores: np.ndarray,
+        top_k: int,
+        nprobe: int,
+        exact_vectors: np.ndarray,
+        rerank_factor: int
+    ) -> List[Dict]:
+        probed_lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        starts, stops = self.list_offsets[probed_lists], self.list_offsets[probed_lists + 1]
+        sizes = stops - starts
+        if not sizes.sum():
+            return []
+
+        rows = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+        # Score of a candidate = query . its centroid + sum over subvectors of query . codebook entry
+        table = np.einsum("jd,jkd->jk", query.reshape(self.subvector_count, -1), self.codebooks).ravel()
+        scores = np.take(table, self.codes[rows] + self._table_offsets).sum(axis=1)
+        scores += np.repeat(centroid_scores[probed_lists], sizes)
+
+        rerank = exact_vectors is not None and rerank_factor > 1
+        k = min(top_k * rerank_factor if rerank else top_k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+
+        if rerank:
+            # Sorted row reads are kinder to a memmap than random ones
+            source_rows = np.asarray(self.source_rows[rows[top]])
+            read_order = np.argsort(source_rows)
+            exact_scores = np.empty(len(top), dtype=np.float32)
+            exact_scores[read_order] = np.asarray(exact_vectors[source_rows[read_order]], dtype=np.float32) @ query
+            scores = np.full(len(scores), -np.inf, dtype=np.float32)
+            scores[top] = exact_scores
+            top = top[np.argpartition(-exact_scores, min(top_k, len(top)) - 1)[:top_k]]
+
+        top = top[np.argsort(-scores[top])]
+        return [{"id": self.ids[rows[i]], "score": float(scores[i])} for i in top]
+
+    def search_many(
+        self,
+        vectors: np.ndarray,
+        top_k: int,
+        nprobe: int = 16,
+        exact_vectors: np.ndarray = None,
+        rerank_factor: int = 4
+    ) -> List[List[Dict]]:
+        """
+        exact_vectors, if given, must be the L2-normalized vectors the index was built from, e.g. a memmap.
+        """
+        queries = _normalize(np.asarray(vectors, dtype=np.float32))
+        all_centroid_scores = queries @ self.coarse_centroids.T
+        nprobe = min(nprobe, self.nlist)
+        return [
+            self._search(query, centroid_scores, top_k, nprobe, exact_vectors, rerank_factor)
+            for query, centroid_scores in zip(queries, all_centroid_scores)
+        ]
+
+
+class ANNVectorStore(VectorStore):
+    """
+    Approximate search for large indexes. Writes go to an exact LocalVectorStore in the same folder, and
+    build_ann_index() trains an IVF-PQ index from it for queries.
+
+    Queries are answered exactly until the ANN index has been built, and again whenever the exact store has changed
+    since the last build, so results are never missing upserted vectors; rebuild after each batch of upserts.
+    """
+
+    EXACT_FOLDER = "exact"
+    ANN_FOLDER = "ivfpq"
+
+    def __init__(self, index_folder: str, nprobe: int = 16, rerank_factor: int = 4, **build_params):
+        self.index_folder = index_folder
+        self.nprobe = nprobe
+        # Set to 1 to answer from the quantized codes alone, without reading any exact vectors
+        self.rerank_factor = rerank_factor
+        self.build_params = build_params
+        self.exact_store = LocalVectorStore(os.path.join(index_folder, self.EXACT_FOLDER))
+        self._ann_index = None
+        self._warned_stale = False
+
+    @classmethod
+    def for_index(cls, index_name: str, **kwargs) -> "ANNVectorStore":
+        return cls(os.path.join(VECTOR_INDEXES_FOLDER, index_name), **kwargs)
+
+    @property
+    def _ann_folder(self) -> str:
+        return os.path.join(self.index_folder, self.ANN_FOLDER)
+
+    def _source_version(self) -> int | None:
+        return self.exact_store.version
+
+    def upsert(self, vectors: List[Dict]) -> None:
+        self.exact_store.upsert(vectors)
+
+    def delete(self, ids: List[str]) -> None:
+        self.exact_store.delete(ids)
+
+    def compact(self) -> None:
+        """
+        Drops deleted vectors from the exact store. Rows are renumbered, so rebuild the ANN index afterwards.
+        """
+        self.exact_store.compact()
+
+    def count(self) -> int:
+        return self.exact_store.count()
+
+    @property
+    def location(self) -> str:
+        return self.exact_store.location
+
+    def build_ann_index(self) -> None:
+        start = time.perf_counter()
+        ann_index = IVFPQIndex.build(
+            self.exact_store.ids,
+            self.exact_store.vectors,
+            rows=self.exact_store.live_rows(),
+            source_version=self._source_version(),
+            **self.build_params
+        )
+        ann_index.save(self._ann_folder)
+        self._ann_index = None
+        self._warned_stale = False
+        print(f"Built ANN index over {len(ann_index.ids)} vectors in {time.perf_counter() - start:.1f}s")
+
+    def ann_index(self) -> IVFPQIndex | None:
+        """
+        The ANN index, or None if it has not been built or the exact store has changed since.
+        """
+        if self._ann_index is None:
+            if not os.path.exists(os.path.join(self._ann_folder, IVFPQIndex.META_FILE)):
+                return None
+            self._ann_index = IVFPQIndex.load(self._ann_folder)
+
+        if self._ann_index.source_version != self._source_version():
+            if not self._warned_stale:
+                print(f"ANN index in {self.index_folder} is out of date, using exact search until it is rebuilt")
+                self._warned_stale = True
+            return None
+        return self._ann_index
+
+    def query(self, vector: List[float], top_k: int) -> List[Dict]:
+        return self.query_many([vector], top_k)[0]
+
+    def query_many(self, vectors: List[List[float]], top_k: int) -> List[List[Dict]]:
+        ann_index = self.ann_index()
+        if ann_index is None:
+            return self.exact_store.query_many(vectors, top_k)
+        return ann_index.search_many(vectors, top_k, self.nprobe, self.exact_store.vectors, self.rerank_factor)
+
+    def describe(self) -> Dict:
+        description = self.exact_store.describe()
+        ann_index = self.ann_index()
+        if ann_index is not None:
+            description.update({
+                "ann_nlist": ann_index.nlist,
+                "ann_nprobe": self.nprobe,
+                "ann_bytes": ann_index.nbytes(),
+                "exact_bytes": self.exact_store.nbytes()
+            })
+        return description
+
+
+def recall_report(
+    store: ANNVectorStore,
+    num_queries: int = 200,
+    top_k: int = 10,
+    nprobe_values: Tuple[int, ...] = (1, 4, 8, 16, 32, 64),
+    rerank_factors: Tuple[int, ...] = (1, 4),
+    query_noise: float = 0.05,
+    seed: int = 0
+) -> Dict:
+    """
+    Recall@top_k of the ANN index against exact search, and single-query latency, for each nprobe and rerank factor
+    (1 meaning no exact re-scoring).
+    Queries are stored vectors with Gaussian noise added, so they are near, but not on, indexed vectors.
+    """
+    ann_index = store.ann_index()
+    if ann_index is None:
+        raise ValueError("The ANN index is missing or out of date, call build_ann_index() first")
+
+    exact_vectors = store.exact_store.vectors
+    rng = np.random.default_rng(seed)
+    live_rows = store.exact_store.live_rows()
+    rows = rng.choice(live_rows, size=min(num_queries, len(live_rows)), replace=False)
+    queries = np.asarray(exact_vectors[np.sort(rows)], dtype=np.float32)
+    queries += rng.normal(scale=query_noise / np.sqrt(queries.shape[1]), size=queries.shape).astype(np.float32)
+
+    exact_ids = [{m["id"] for m in matches} for matches in store.exact_store.query_many(queries, top_k)]
+
+    results = []
+    for rerank_factor in rerank_factors:
+        for nprobe in nprobe_values:
+            latencies, hits = [], 0
+            for query, expected_ids in zip(queries, exact_ids):
+                start = time.perf_counter()
+                matches = ann_index.search_many(query[None], top_k, nprobe, exact_vectors, rerank_factor)[0]
+                latencies.append(time.perf_counter() - start)
+                hits += len(expected_ids & {m["id"] for m in matches})
+
+            latencies_ms = np.asarray(latencies) * 1000
+            results.append({
+                "nprobe": nprobe,
+                "rerank_factor": rerank_factor,
+                f"recall_at_{top_k}": hits / (len(queries) * top_k),
+                "p50_ms": float(np.percentile(latencies_ms, 50)),
+                "p99_ms": float(np.percentile(latencies_ms, 99))
+            })
+
+    return {
+        "vectors": len(ann_index.ids),
+        "dimension": ann_index.dimension,
+        "nlist": ann_index.nlist,
+        "pq_subvector_dim": ann_index.subvector_dim,
+        # Both sizes include the ID table, which PQ codes do not shrink
+        "ann_bytes": ann_index.nbytes(),
+        "ann_id_bytes": ann_index.id_nbytes(),
+        "exact_bytes": store.exact_store.nbytes(),
+        "compression": store.exact_store.nbytes() / ann_index.nbytes(),
+        "results": results
+    }
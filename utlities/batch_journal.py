@@ -0,0 +1,60 @@
+import os
+import json
+import threading
+from typing import Dict, List
+
+from file_utilities import atomic_write_json
+
+
+class BatchJournal:
+    """
+    Persistent record of Anthropic batches that were submitted but not yet fully ingested. For each batch it keeps
+    the manifest record (including the image file name) behind every custom_id, and which custom_ids have already
+    been saved, so that a crashed build can reattach to its batches instead of re-submitting them.
+    """
+
+    JOURNAL_FILE_NAME = ".batch_journal.json"
+
+    def __init__(self, tags_folder_file_path: str):
+        self.journal_path = os.path.join(tags_folder_file_path, self.JOURNAL_FILE_NAME)
+        self.batches = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.journal_path):
+            return {}
+        with open(self.journal_path, "r") as f:
+            batches = json.load(f)
+        for batch in batches.values():
+            batch["saved_custom_ids"] = set(batch["saved_custom_ids"])
+        return batches
+
+    def save(self) -> None:
+        with self._lock:
+            atomic_write_json(self.journal_path, {
+                batch_id: {**batch, "saved_custom_ids": sorted(batch["saved_custom_ids"])}
+                for batch_id, batch in self.batches.items()
+            })
+
+    def record_submitted(self, batch_id: str, manifest_records: Dict[str, Dict]) -> None:
+        with self._lock:
+            self.batches[batch_id] = {"manifest_records": manifest_records, "saved_custom_ids": set()}
+        self.save()
+
+    def pending_batch_ids(self) -> List[str]:
+        return list(self.batches)
+
+    def manifest_record(self, batch_id: str, custom_id: str) -> Dict | None:
+        return self.batches[batch_id]["manifest_records"].get(custom_id)
+
+    def is_saved(self, batch_id: str, custom_id: str) -> bool:
+        return custom_id in self.batches[batch_id]["saved_custom_ids"]
+
+    def mark_saved(self, batch_id: str, custom_id: str) -> None:
+        with self._lock:
+            self.batches[batch_id]["saved_custom_ids"].add(custom_id)
+
+    def mark_ingested(self, batch_id: str) -> None:
+        with self._lock:
+            self.batches.pop(batch_id, None)
+        self.save()
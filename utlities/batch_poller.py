@@ -0,0 +1,97 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import anthropic
+from anthropic.types.messages.message_batch import MessageBatch
+
+from tracing import bind_trace_context, trace_span
+
+
+class MessageBatchPoller:
+    """
+    Tracks a set of Anthropic message batches together and hands each one to `on_batch_ended` as soon as it ends,
+    regardless of submission order. Ended batches are ingested on a thread pool so polling carries on while results
+    are downloaded and written.
+
+    Every polling round retrieves each outstanding batch, so the interval scales with the number still outstanding,
+    doubles while nothing changes and drops back once a batch ends.
+    """
+
+    MIN_POLL_INTERVAL = 5
+    MAX_POLL_INTERVAL = 300
+    SECONDS_PER_OUTSTANDING_BATCH = 1
+
+    # Batches expire after 24 hours, so there is no point waiting longer than that
+    MAX_WAIT_SECONDS = 24 * 60 * 60
+
+    def __init__(
+        self,
+        client: anthropic.Anthropic,
+        on_batch_ended: Callable[[MessageBatch], None],
+        ingest_workers: int = 4
+    ):
+        self.client = client
+        self.on_batch_ended = on_batch_ended
+        self.ingest_workers = ingest_workers
+
+    def _base_poll_interval(self, outstanding_count: int) -> float:
+        return min(
+            self.MAX_POLL_INTERVAL,
+            max(self.MIN_POLL_INTERVAL, outstanding_count * self.SECONDS_PER_OUTSTANDING_BATCH)
+        )
+
+    def _poll_outstanding(self, outstanding: Dict[str, MessageBatch]) -> List[MessageBatch]:
+        ended = []
+        with trace_span("batch_poller.poll", outstanding=len(outstanding)) as span:
+            for batch_id in list(outstanding):
+                try:
+                    message_batch = self.client.messages.batches.retrieve(batch_id)
+                except anthropic.APIError as e:
+                    print(f"Unable to check batch {batch_id}, will retry: {e}")
+                    continue
+
+                if message_batch.processing_status == "ended":
+                    ended.append(message_batch)
+                    del outstanding[batch_id]
+            span.set_attribute("ended", len(ended))
+        return ended
+
+    def _ingest(self, message_batch: MessageBatch) -> None:
+        with trace_span("batch_poller.ingest", batch_id=message_batch.id):
+            self.on_batch_ended(message_batch)
+
+    def wait_for_all(self, message_batches: List[MessageBatch]) -> None:
+        outstanding = {batch.id: batch for batch in message_batches}
+        deadline = time.monotonic() + self.MAX_WAIT_SECONDS
+        interval = self._base_poll_interval(len(outstanding))
+
+        with ThreadPoolExecutor(max_workers=self.ingest_workers) as ingest_pool:
+            ingest_futures = []
+
+            while outstanding:
+                ended = self._poll_outstanding(outstanding)
+                for message_batch in ended:
+                    print(f"Batch {message_batch.id} ended, grabbing data. {len(outstanding)} outstanding, {datetime.now()}")
+                    ingest_futures.append(ingest_pool.submit(bind_trace_context(self._ingest), message_batch))
+
+                if not outstanding:
+                    break
+
+                if time.monotonic() > deadline:
+                    print(f"Gave up waiting on batches: {', '.join(outstanding)}. Unable to process their images.")
+                    break
+
+                if ended:
+                    interval = self._base_poll_interval(len(outstanding))
+                else:
+                    interval = min(self.MAX_POLL_INTERVAL, interval * 2)
+                with trace_span("batch_poller.sleep", seconds=interval):
+                    time.sleep(interval)
+
+            for future in ingest_futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error ingesting batch results: {e}")
@@ -0,0 +1,245 @@
+import os
+import json
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from functools import cached_property, lru_cache
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+from pillow_avif import AvifImagePlugin
+from transformers import CLIPImageProcessor, CLIPModel
+
+from clip_text_encoder import CLIP_MODEL_NAME, CLIP_INDEX_NAMESPACE
+from directories import IMAGES_FOLDER, VECTOR_INDEXES_FOLDER
+from file_utilities import atomic_write_json
+from hashing import file_content_hash
+from image_dedup import DuplicateImageIndex
+from pinecone_index_utilities import get_pinecone_client
+from vector_store import VectorStore, PineconeVectorStore
+
+
+@lru_cache(maxsize=None)
+def _image_processor() -> CLIPImageProcessor:
+    return CLIPImageProcessor.from_pretrained(CLIP_MODEL_NAME)
+
+
+def _decode_image(image_file_name: str) -> np.ndarray | None:
+    # Runs in decode worker processes: open, convert and preprocess to CLIP pixel values
+    try:
+        with Image.open(os.path.join(IMAGES_FOLDER, image_file_name)) as image:
+            return _image_processor()(images=image.convert("RGB"), return_tensors="np")["pixel_values"][0]
+    except Exception as e:
+        print(f"Unable to decode {image_file_name}: {e}")
+        return None
+
+
+class CLIPImageEmbeddingPipeline:
+    """
+    Builds the CLIP image index without holding the library in memory.
+
+    Images are decoded and preprocessed on a worker pool, with at most `max_batches_in_flight` batches queued, and
+    embedded in batched forward passes. Every `chunk_size` embeddings are saved to the checkpoint folder and then
+    upserted, so an interrupted run picks up after the last saved chunk. chunk_size only sets how often progress is
+    saved: the vector store splits each chunk into requests of its own size.
+
+    Chunks record the content hash of each image, and the checkpoint folder records the vector store location they
+    were upserted into. Images whose content changed are embedded again, and the checkpoints are discarded when they
+    were made for another store or the store holds fewer vectors than they do.
+
+    With a duplicate_index, only the representative of each group of near-identical images is embedded.
+    """
+
+    def __init__(
+        self,
+        index_name: str,
+        vector_store: VectorStore = None,
+        batch_size: int = 32,
+        decode_workers: int = None,
+        torch_threads: int = None,
+        chunk_size: int = 512,
+        max_batches_in_flight: int = 4,
+        duplicate_index: DuplicateImageIndex = None
+    ):
+        self.index_name = index_name
+        if vector_store is None:
+            vector_store = PineconeVectorStore(
+                get_pinecone_client().Index(index_name),
+                namespace=CLIP_INDEX_NAMESPACE
+            )
+        self.vector_store = vector_store
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.torch_threads = torch_threads
+        self.chunk_size = chunk_size
+        self.max_batches_in_flight = max_batches_in_flight
+        self.duplicate_index = duplicate_index
+        self.checkpoint_folder = os.path.join(VECTOR_INDEXES_FOLDER, index_name + "_clip_checkpoints")
+
+    @cached_property
+    def _model(self) -> CLIPModel:
+        model = CLIPModel.from_pretrained(CLIP_MODEL_NAME)
+        model.to("cpu")
+        model.eval()
+        return model
+
+    CHECKPOINT_STATE_FILE = "state.json"
+
+    def _chunk_paths(self) -> List[str]:
+        if not os.path.isdir(self.checkpoint_folder):
+            return []
+        return sorted(
+            os.path.join(self.checkpoint_folder, file_name)
+            for file_name in os.listdir(self.checkpoint_folder) if file_name.endswith(".npz")
+        )
+
+    @staticmethod
+    def _upserted_marker_path(chunk_path: str) -> str:
+        return chunk_path + ".upserted"
+
+    def _checkpoint_state_path(self) -> str:
+        return os.path.join(self.checkpoint_folder, self.CHECKPOINT_STATE_FILE)
+
+    def _checkpoint_state(self) -> Dict:
+        return {"location": self.vector_store.location, "model": CLIP_MODEL_NAME}
+
+    def _discard_checkpoints(self, reason: str) -> None:
+        print(f"Discarding CLIP checkpoints, {reason}; embedding everything")
+        shutil.rmtree(self.checkpoint_folder, ignore_errors=True)
+
+    def _checkpoints_match_store(self) -> bool:
+        # Folders saved before the store's location was recorded are assumed to belong to this store
+        if not os.path.exists(self._checkpoint_state_path()):
+            return True
+        with open(self._checkpoint_state_path(), "r") as f:
+            state = json.load(f)
+        if state != self._checkpoint_state():
+            self._discard_checkpoints(f"they were made with {state['model']} for {state['location']}")
+            return False
+        return True
+
+    def _embedded_hashes(self) -> Dict[str, str | None]:
+        """
+        Content hash each checkpointed image was embedded from, by image id. Later chunks win. Images from chunks
+        saved before hashes were recorded map to None.
+        """
+        embedded_hashes = {}
+        for chunk_path in self._chunk_paths():
+            with np.load(chunk_path) as chunk:
+                ids = chunk["ids"].tolist()
+                hashes = chunk["hashes"].tolist() if "hashes" in chunk.files else [None] * len(ids)
+                embedded_hashes.update(zip(ids, hashes))
+        return embedded_hashes
+
+    def _upsert_chunk(self, chunk_path: str) -> None:
+        with np.load(chunk_path) as chunk:
+            self.vector_store.upsert([
+                {"id": image_id, "values": embedding.tolist()}
+                for image_id, embedding in zip(chunk["ids"].tolist(), chunk["embeddings"])
+            ])
+        open(self._upserted_marker_path(chunk_path), "w").close()
+
+    def _save_and_upsert_chunk(self, ids: List[str], hashes: List[str], embeddings: List[np.ndarray]) -> None:
+        os.makedirs(self.checkpoint_folder, exist_ok=True)
+        chunk_path = os.path.join(self.checkpoint_folder, f"chunk_{len(self._chunk_paths()):06d}.npz")
+
+        tmp_path = chunk_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f, ids=np.array(ids), hashes=np.array(hashes), embeddings=np.stack(embeddings).astype(np.float32)
+            )
+        os.replace(tmp_path, chunk_path)
+
+        self._upsert_chunk(chunk_path)
+        print(f"Saved and upserted {len(ids)} embeddings to {os.path.basename(chunk_path)}")
+
+    def _decoded_batches(
+        self,
+        pool: ProcessPoolExecutor,
+        image_file_names: List[str]
+    ) -> Iterator[Tuple[List[str], List[np.ndarray | None]]]:
+        in_flight: deque[Tuple[List[str], List[Future]]] = deque()
+        batch_starts = iter(range(0, len(image_file_names), self.batch_size))
+
+        def queue_next_batch() -> None:
+            start = next(batch_starts, None)
+            if start is None:
+                return
+            names = image_file_names[start:start + self.batch_size]
+            in_flight.append((names, [pool.submit(_decode_image, name) for name in names]))
+
+        for _ in range(self.max_batches_in_flight):
+            queue_next_batch()
+
+        while in_flight:
+            names, futures = in_flight.popleft()
+            pixel_values = [future.result() for future in futures]
+            queue_next_batch()
+            yield names, pixel_values
+
+    def _embed_batch(self, pixel_values: List[np.ndarray]) -> np.ndarray:
+        with torch.inference_mode():
+            return self._model.get_image_features(pixel_values=torch.from_numpy(np.stack(pixel_values))).numpy()
+
+    def run(self, image_file_names: List[str] = None) -> None:
+        if image_file_names is None:
+            image_file_names = [
+                image_file_name for image_file_name in os.listdir(IMAGES_FOLDER) if not image_file_name.startswith(".")
+            ]
+
+        if self.duplicate_index is not None:
+            image_file_names = self.duplicate_index.representatives(image_file_names)
+
+        if self.torch_threads is not None:
+            torch.set_num_threads(self.torch_threads)
+
+        # Chunks saved by an interrupted run may not have made it into the index yet
+        if self._checkpoints_match_store():
+            for chunk_path in self._chunk_paths():
+                if not os.path.exists(self._upserted_marker_path(chunk_path)):
+                    self._upsert_chunk(chunk_path)
+
+        embedded_hashes = self._embedded_hashes()
+        vector_count = self.vector_store.count()
+        if vector_count < len(embedded_hashes):
+            self._discard_checkpoints(
+                f"{self.vector_store.location} has {vector_count} vectors but {len(embedded_hashes)} were upserted"
+            )
+            embedded_hashes = {}
+
+        os.makedirs(self.checkpoint_folder, exist_ok=True)
+        atomic_write_json(self._checkpoint_state_path(), self._checkpoint_state())
+
+        chunk_ids, chunk_hashes, chunk_embeddings = [], [], []
+        with ProcessPoolExecutor(max_workers=self.decode_workers) as pool:
+            image_hashes = dict(zip(image_file_names, pool.map(
+                file_content_hash,
+                [os.path.join(IMAGES_FOLDER, name) for name in image_file_names],
+                chunksize=64
+            )))
+            already_embedded = len(image_file_names)
+            image_file_names = [
+                name for name in image_file_names
+                if name not in embedded_hashes or embedded_hashes[name] not in (None, image_hashes[name])
+            ]
+            already_embedded -= len(image_file_names)
+            print(f"{len(image_file_names)} images to embed, {already_embedded} already embedded")
+
+            for names, pixel_values in self._decoded_batches(pool, image_file_names):
+                decoded = [(name, values) for name, values in zip(names, pixel_values) if values is not None]
+                if not decoded:
+                    continue
+
+                embeddings = self._embed_batch([values for _, values in decoded])
+                chunk_ids.extend(name for name, _ in decoded)
+                chunk_hashes.extend(image_hashes[name] for name, _ in decoded)
+                chunk_embeddings.extend(embeddings)
+
+                if len(chunk_ids) >= self.chunk_size:
+                    self._save_and_upsert_chunk(chunk_ids, chunk_hashes, chunk_embeddings)
+                    chunk_ids, chunk_hashes, chunk_embeddings = [], [], []
+
+        if chunk_ids:
+            self._save_and_upsert_chunk(chunk_ids, chunk_hashes, chunk_embeddings)
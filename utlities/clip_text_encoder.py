@@ -0,0 +1,122 @@
+import os
+import threading
+from functools import cached_property
+from typing import Dict, List
+
+import numpy as np
+import torch
+from transformers import CLIPModel, CLIPTextConfig, CLIPTextModelWithProjection, CLIPTokenizerFast
+
+from directories import MODEL_CACHE_FOLDER
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+# Namespace of the CLIP image vectors in their Pinecone index
+CLIP_INDEX_NAMESPACE = "ns1"
+CLIP_TEXT_ENCODER_FOLDER = os.path.join(MODEL_CACHE_FOLDER, "clip_text_encoder_int8")
+QUANTIZED_WEIGHTS_FILE_NAME = "quantized_state_dict.pt"
+
+
+def _quantize(model: CLIPTextModelWithProjection) -> torch.nn.Module:
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class CLIPTextEncoder:
+    """
+    Query-side CLIP encoder that loads only the text tower and tokenizer, never the vision weights.
+
+    If an int8 artifact made by export_quantized_text_encoder exists (or quantized=True), it is loaded from the
+    local model cache with no network access. Otherwise the fp32 text tower is loaded from the Hugging Face cache.
+    Nothing is loaded until load() or the first encode call.
+    """
+
+    def __init__(
+        self,
+        model_name: str = CLIP_MODEL_NAME,
+        artifact_folder: str = CLIP_TEXT_ENCODER_FOLDER,
+        quantized: bool = None
+    ):
+        self.model_name = model_name
+        self.artifact_folder = artifact_folder
+        if quantized is None:
+            quantized = os.path.exists(os.path.join(artifact_folder, QUANTIZED_WEIGHTS_FILE_NAME))
+        self.quantized = quantized
+
+        # Quantized embeddings differ slightly from fp32 ones, so they are cached under a different key
+        self.cache_key = model_name + (":int8" if quantized else "")
+
+        # Handlers are shared between threads; this stops concurrent first queries from each loading the model
+        self._load_lock = threading.Lock()
+
+    @cached_property
+    def _tokenizer(self) -> CLIPTokenizerFast:
+        if self.quantized:
+            return CLIPTokenizerFast.from_pretrained(self.artifact_folder, local_files_only=True)
+        return CLIPTokenizerFast.from_pretrained(self.model_name)
+
+    @cached_property
+    def _model(self) -> torch.nn.Module:
+        if not self.quantized:
+            model = CLIPTextModelWithProjection.from_pretrained(self.model_name)
+            model.eval()
+            return model
+
+        config = CLIPTextConfig.from_pretrained(self.artifact_folder, local_files_only=True)
+        model = _quantize(CLIPTextModelWithProjection(config))
+        model.load_state_dict(torch.load(os.path.join(self.artifact_folder, QUANTIZED_WEIGHTS_FILE_NAME)))
+        return model
+
+    def load(self) -> None:
+        """
+        Loads the tokenizer and model now, so the first query does not wait for them.
+        """
+        with self._load_lock:
+            self._tokenizer, self._model
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        self.load()
+        tokenizer, model = self._tokenizer, self._model
+
+        inputs = tokenizer(texts, padding=True, truncation=True, return_tensors="pt")
+        with torch.inference_mode():
+            return model(**inputs).text_embeds.tolist()
+
+
+def export_quantized_text_encoder(
+    model_name: str = CLIP_MODEL_NAME,
+    artifact_folder: str = CLIP_TEXT_ENCODER_FOLDER
+) -> None:
+    """
+    One-off export of the int8 dynamically quantized text tower, its config and tokenizer to the local model cache.
+    """
+    os.makedirs(artifact_folder, exist_ok=True)
+
+    model = CLIPTextModelWithProjection.from_pretrained(model_name)
+    model.config.save_pretrained(artifact_folder)
+    CLIPTokenizerFast.from_pretrained(model_name).save_pretrained(artifact_folder)
+
+    tmp_path = os.path.join(artifact_folder, QUANTIZED_WEIGHTS_FILE_NAME + ".tmp")
+    torch.save(_quantize(model).state_dict(), tmp_path)
+    os.replace(tmp_path, os.path.join(artifact_folder, QUANTIZED_WEIGHTS_FILE_NAME))
+
+
+def check_parity(
+    texts: List[str],
+    model_name: str = CLIP_MODEL_NAME,
+    artifact_folder: str = CLIP_TEXT_ENCODER_FOLDER
+) -> Dict[str, float]:
+    """
+    Compares the quantized encoder against fp32 CLIPModel.get_text_features on texts, by cosine similarity.
+    """
+    quantized = np.asarray(CLIPTextEncoder(model_name, artifact_folder, quantized=True).encode(texts))
+
+    reference_model = CLIPModel.from_pretrained(model_name)
+    reference_model.eval()
+    inputs = CLIPTokenizerFast.from_pretrained(model_name)(texts, padding=True, truncation=True, return_tensors="pt")
+    with torch.inference_mode():
+        reference = reference_model.get_text_features(**inputs).numpy()
+
+    cosine = np.sum(quantized * reference, axis=1) / (
+        np.linalg.norm(quantized, axis=1) * np.linalg.norm(reference, axis=1)
+    )
+    return {"min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean())}
@@ -9,5 +9,22 @@ PROJECT_BASE_PATH = os.environ.get("PROJECT_DATA_ROOT")
 
 IMAGES_FOLDER = os.path.join(PROJECT_BASE_PATH, "example_email_images")
 IMAGE_TAG_SETS_FOLDER = os.path.join(PROJECT_BASE_PATH, "image_tag_sets")
+VECTOR_INDEXES_FOLDER = os.path.join(PROJECT_BASE_PATH, "vector_indexes")
+THUMBNAILS_FOLDER = os.path.join(PROJECT_BASE_PATH, "thumbnails")
+REQUEST_IMAGES_FOLDER = os.path.join(PROJECT_BASE_PATH, "request_images")
+MODEL_CACHE_FOLDER = os.path.join(PROJECT_BASE_PATH, "model_cache")
 
-PROJECT_ASSETS_FOLDER = os.environ.get("PROJECT_ASSETS_FOLDER")
\ No newline at end of file
+PROJECT_ASSETS_FOLDER = os.environ.get("PROJECT_ASSETS_FOLDER")
+
+# Optional SQLite file for sharing cached query embeddings between worker processes
+QUERY_EMBEDDING_CACHE_PATH = os.environ.get("QUERY_EMBEDDING_CACHE_PATH")
+
+# Comma separated trace exporters ("log", "jsonl", "histogram"); tracing is off when unset
+TRACE_EXPORTERS = os.environ.get("TRACE_EXPORTERS")
+TRACE_JSONL_PATH = os.environ.get("TRACE_JSONL_PATH")
+
+# Port of the local image server used when results are rendered with image URLs; 0 picks a free port
+IMAGE_SERVER_PORT = int(os.environ.get("IMAGE_SERVER_PORT", 0))
+
+# Port of the long-running query service (query_service.py)
+QUERY_SERVICE_PORT = int(os.environ.get("QUERY_SERVICE_PORT", 8765))
@@ -1,186 +1,506 @@
 import os
-import json
+import html
 import base64
 
-from functools import cached_property
-from pinecone import Pinecone
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import List, Dict, Tuple
 import math
-from transformers import CLIPProcessor, CLIPModel
 
-from pinecone_index_utilities import _email_json_to_string, EMBEDDINGS_MODEL
-from directories import IMAGE_TAG_SETS_FOLDER, IMAGES_FOLDER
+from pinecone_index_utilities import EMBEDDINGS_MODEL, get_pinecone_client
+from directories import IMAGES_FOLDER
+from tag_set_store import TagSetStore, tag_set_id
+from vector_store import VectorStore, PineconeVectorStore
+from image_file_index import get_image_file_index
+from image_cache import THUMBNAIL_WIDTH, VARIANT_WIDTHS, get_image_payload_cache
+from embedding_cache import QueryEmbeddingCache, get_query_embedding_cache
+from clip_text_encoder import CLIPTextEncoder, CLIP_MODEL_NAME, CLIP_INDEX_NAMESPACE
+from lexical_index import BM25Index
+from rank_fusion import reciprocal_rank_fusion
+from tracing import bind_trace_context, trace_span
+from image_server import ImageServer, get_image_server
+from image_dedup import DuplicateImageIndex, get_duplicate_image_index
+
+# Shared by all handlers. Hydration is file I/O, so results are loaded concurrently on threads.
+_HYDRATION_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hydrate")
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="search")
+
+# When the library has duplicate images, this many times k matches are fetched, so k remain after collapsing
+DUPLICATE_OVERFETCH = 2
+
 
 def get_image_base64_from_path(image_path: str) -> str:
     with open(image_path, 'rb') as img_file:
         return base64.b64encode(img_file.read()).decode('utf-8')
 
 
+def _collapse_duplicates(matches: List[Dict], representative_ids: Dict[str, str], k: int) -> List[Dict]:
+    """
+    Replaces each match by the representative of its group of near-identical images, and keeps the best match of
+    each group, up to k.
+    """
+    if not representative_ids:
+        return matches[:k]
+
+    collapsed, seen_ids = [], set()
+    for match in matches:
+        match_id = representative_ids.get(match["id"], match["id"])
+        if match_id in seen_ids:
+            continue
+        seen_ids.add(match_id)
+        collapsed.append({**match, "id": match_id})
+        if len(collapsed) == k:
+            break
+    return collapsed
+
+
+def _hydrate_unique(ids: List[str], hydrate) -> Dict[str, Dict]:
+    unique_ids = list(dict.fromkeys(ids))
+    futures = [_HYDRATION_POOL.submit(bind_trace_context(hydrate), unique_id) for unique_id in unique_ids]
+    return {unique_id: future.result() for unique_id, future in zip(unique_ids, futures)}
+
+
 class KeyWordRAGSearchHandler:
 
-    def __init__(self, index_name: str):
+    # Most inputs Pinecone's inference API accepts in one embed call
+    EMBED_BATCH_SIZE = 96
+
+    def __init__(
+        self,
+        index_name: str,
+        vector_store: VectorStore = None,
+        embedding_cache: QueryEmbeddingCache = None,
+        lexical_index: BM25Index = None,
+        duplicate_index: DuplicateImageIndex = None
+    ):
 
         api_key = os.getenv('PINECONE_API_KEY')
         if not api_key:
             raise ValueError("PINECONE_API_KEY environment variable not set")
 
-        self.pc = Pinecone(api_key)
+        self.pc = get_pinecone_client()
         self.index_name = index_name
-        self.index = self.pc.Index(self.index_name)
-        self.image_tag_sets_folder = os.path.join(IMAGE_TAG_SETS_FOLDER, index_name)
+        if vector_store is None:
+            vector_store = PineconeVectorStore(self.pc.Index(self.index_name), namespace=self.index_name)
+        self.vector_store = vector_store
+        self.embedding_cache = embedding_cache or get_query_embedding_cache()
+        self.lexical_index = lexical_index or BM25Index.load_for_index(index_name)
+        self.tag_set_store = TagSetStore(index_name)
+
+        # Results are collapsed to one email per group of near-identical images
+        self.duplicate_index = duplicate_index or get_duplicate_image_index()
+        self._representative_ids = self.duplicate_index.representative_ids(id_for=tag_set_id)
 
     @staticmethod
-    def _get_email_image_path(email_name: str) -> str:
+    def _get_email_image_path(email_id: str) -> str:
         """
-        Get path corresponding to email name. Email name is distinct, but there are a range of file formats.
+        Get path corresponding to the email's tag set id. Email name is distinct, but there are a range of file
+        formats.
         """
-
-        possible_image_extensions = [
-            '.png', '.jpg', '.jpeg', '.gif', '.bmp','.avif',
-            '.tiff', '.tif', '.webp', '.svg', '.ico',
-            '.heic', '.heif', '.raw', '.cr2', '.nef',
-            '.arw', '.dng', '.psd', '.ai', '.eps'
-        ]
-
-        for ext in possible_image_extensions:
-            potential_path = os.path.join(IMAGES_FOLDER, email_name + ext)
-            if os.path.exists(potential_path):
-                return potential_path
-
-        raise Exception(f"No local file found for {email_name}")
+        with trace_span("keyword_rag.image_path"):
+            return get_image_file_index().path_for_tag_set_id(email_id)
 
     def _get_tags_for_email(self, email_path: str) -> str:
+        # Tags are stored pre-rendered, so this is a single indexed read
+        with trace_span("keyword_rag.tags"):
+            return self.tag_set_store.get_string(tag_set_id(os.path.basename(email_path)))
+
+
+    def _embed_queries(self, email_queries: List[str]) -> List[List[float]]:
+        embeddings = []
+        for i in range(0, len(email_queries), self.EMBED_BATCH_SIZE):
+            with trace_span("keyword_rag.embed_call", texts=len(email_queries[i:i + self.EMBED_BATCH_SIZE])):
+                query_embeddings = self.pc.inference.embed(
+                    model=EMBEDDINGS_MODEL,
+                    inputs=email_queries[i:i + self.EMBED_BATCH_SIZE],
+                    parameters={
+                        "input_type": "query"
+                    }
+                )
+            embeddings.extend(query_embedding.values for query_embedding in query_embeddings)
+        return embeddings
+
+    def _email_from_id(self, email_id: str, inline_images: bool = True) -> Dict:
+        # Here, we use the filename of the image as the ID in pinecone. That can then be used to grab both
+        # the image itself, and the tags, both of which are stored locally.
+        image_path = self._get_email_image_path(email_id)
+        email = {
+            "image_path": image_path,
+            "tags": self._get_tags_for_email(image_path),
+            "duplicates": self.duplicate_index.duplicates_of(os.path.basename(image_path))
+        }
+        if inline_images:
+            with trace_span("keyword_rag.image_payload"):
+                email.update(get_image_payload_cache().get(image_path))
+        return email
+
+    def _query_embeddings(self, email_queries: List[str]) -> List[List[float]]:
+        with trace_span("keyword_rag.embed", queries=len(email_queries)):
+            return self.embedding_cache.get_or_compute(
+                model=EMBEDDINGS_MODEL,
+                input_type="query",
+                texts=email_queries,
+                embed=self._embed_queries
+            )
+
+    def _emails_for_matches(self, matches_per_query: List[List[Dict]], inline_images: bool = True) -> List[List[Dict]]:
+        ids = [match['id'] for matches in matches_per_query for match in matches]
+        with trace_span("keyword_rag.hydrate", matches=len(ids)):
+            emails_by_id = _hydrate_unique(ids, partial(self._email_from_id, inline_images=inline_images))
+        return [[emails_by_id[match['id']] for match in matches] for matches in matches_per_query]
+
+    def query_many(self, email_queries: List[str], k: int=5, inline_images: bool = True) -> List[List[Dict]]:
+        """
+        Runs several queries with one embed call and one batched vector search. Each email is hydrated once, even
+        if it is returned for several queries, and emails are hydrated concurrently.
 
-        tags_dict_path = os.path.join(
-            self.image_tag_sets_folder,
-            os.path.splitext(os.path.basename(email_path))[0] + ".json"
-        )
-
-        try:
-            with open(tags_dict_path, "r") as f:
-                return _email_json_to_string(json.load(f))
-        except FileNotFoundError:
-            raise FileNotFoundError(f"Metadata file not found for email: {email_path}")
-        except json.JSONDecodeError:
-            raise ValueError(f"Invalid JSON in metadata file for email: {email_path}")
-
+        With inline_images=False results carry only the image path, for rendering with image URLs.
+        """
+        with trace_span("keyword_rag.query_many", index=self.index_name, queries=len(email_queries), k=k):
+            query_vectors = self._query_embeddings(email_queries)
+            with trace_span("keyword_rag.vector_query"):
+                matches_per_query = self.vector_store.query_many(
+                    vectors=query_vectors,
+                    top_k=self._top_k_to_fetch(k)
+                )
+            matches_per_query = [
+                _collapse_duplicates(matches, self._representative_ids, k) for matches in matches_per_query
+            ]
+            return self._emails_for_matches(matches_per_query, inline_images)
+
+    def _top_k_to_fetch(self, k: int) -> int:
+        return k * DUPLICATE_OVERFETCH if self._representative_ids else k
+
+    def query(self, email_query: str, k: int=5, inline_images: bool = True) -> List[Dict]:
+        return self.query_many([email_query], k, inline_images)[0]
+
+    def hybrid_query(self, email_query: str, k: int=5, inline_images: bool = True) -> List[Dict]:
+        """
+        Answers from the local BM25 index over the tag sets. If at least k emails contain every informative query
+        term (see BM25Index.search) the lexical ranking is used as is, with no embed call. Otherwise it is fused
+        with the dense results by reciprocal rank fusion. Falls back to query() when the index has no BM25 index
+        built.
+        """
+        if self.lexical_index is None:
+            return self.query(email_query, k, inline_images)
+
+        top_k = self._top_k_to_fetch(k)
+        with trace_span("keyword_rag.hybrid_query", index=self.index_name, k=k) as span:
+            with trace_span("keyword_rag.lexical_search"):
+                lexical_matches, full_match_count = self.lexical_index.search(email_query, top_k)
+            span.set_attribute("lexical_only", full_match_count >= top_k)
+            if full_match_count >= top_k:
+                lexical_matches = _collapse_duplicates(lexical_matches, self._representative_ids, k)
+                return self._emails_for_matches([lexical_matches], inline_images)[0]
+
+            query_vector = self._query_embeddings([email_query])[0]
+            with trace_span("keyword_rag.vector_query"):
+                dense_matches = self.vector_store.query(
+                    vector=query_vector,
+                    top_k=top_k
+                )
+            fused_matches = reciprocal_rank_fusion([lexical_matches, dense_matches], top_k=top_k)
+            fused_matches = _collapse_duplicates(fused_matches, self._representative_ids, k)
+            return self._emails_for_matches([fused_matches], inline_images)[0]
 
-    def query(self, email_query: str, k: int=5) -> List[Dict]:
+class ImageEmbeddingsSearchHandler(object):
 
-        query_embedding = self.pc.inference.embed(
-            model=EMBEDDINGS_MODEL,
-            inputs=[email_query],
-            parameters={
-                "input_type": "query"
-            }
-        )
+    # DEFAULT_INDEX_NAME = "clip-email-index"
+    CLIP_MODEL = CLIP_MODEL_NAME
+    CLIP_INDEX_NAMESPACE = CLIP_INDEX_NAMESPACE
 
-        results = self.index.query(
-            namespace=self.index_name,
-            vector=query_embedding[0].values,
-            top_k=k,
-            include_values=False,
-            include_metadata=False
-        )
+    def __init__(
+        self,
+        index_name,
+        vector_store: VectorStore = None,
+        embedding_cache: QueryEmbeddingCache = None,
+        text_encoder: CLIPTextEncoder = None,
+        duplicate_index: DuplicateImageIndex = None
+    ):
+        self.index_name = index_name
+        if vector_store is None:
+            vector_store = PineconeVectorStore(
+                get_pinecone_client().Index(self.index_name),
+                namespace=self.CLIP_INDEX_NAMESPACE
+            )
+        self.vector_store = vector_store
+        self.embedding_cache = embedding_cache or get_query_embedding_cache()
+
+        # Only the text tower is needed for queries. Uses the int8 artifact from the model cache when it exists.
+        self.text_encoder = text_encoder or CLIPTextEncoder(self.CLIP_MODEL)
+
+        # Results are collapsed to one image per group of near-identical images
+        self.duplicate_index = duplicate_index or get_duplicate_image_index()
+        self._representative_ids = self.duplicate_index.representative_ids()
+
+    def query_many(self, query_texts: List[str], k: int=5, inline_images: bool = True) -> List[List[Dict]]:
+        """
+        Runs several queries with one CLIP text forward pass and one batched vector search. Each image is loaded
+        once, even if it is returned for several queries, and images are loaded concurrently.
 
-        most_similar_emails = []
-        for match in results['matches']:
+        With inline_images=False results carry only the image path, for rendering with image URLs.
+        """
+        with trace_span("clip.query_many", index=self.index_name, queries=len(query_texts), k=k):
+            text_embs = self._query_embeddings(query_texts)
+
+            with trace_span("clip.vector_query"):
+                matches_per_query = self.vector_store.query_many(
+                    vectors=text_embs,
+                    top_k=k * DUPLICATE_OVERFETCH if self._representative_ids else k
+                )
+            matches_per_query = [
+                _collapse_duplicates(matches, self._representative_ids, k) for matches in matches_per_query
+            ]
+
+            ids = [m['id'] for matches in matches_per_query for m in matches]
+            with trace_span("clip.hydrate", matches=len(ids)):
+                images_by_id = _hydrate_unique(ids, partial(self._image_from_id, inline_images=inline_images))
+
+            return [[images_by_id[m['id']] for m in matches] for matches in matches_per_query]
+
+    def _query_embeddings(self, query_texts: List[str]) -> List[List[float]]:
+        with trace_span("clip.embed", queries=len(query_texts)):
+            return self.embedding_cache.get_or_compute(
+                model=self.text_encoder.cache_key,
+                input_type="text",
+                texts=query_texts,
+                embed=self.text_encoder.encode
+            )
+
+    def _image_from_id(self, image_id: str, inline_images: bool = True) -> Dict:
+        image_path = os.path.join(IMAGES_FOLDER, image_id)
+        image = {"image_path": image_path, "duplicates": self.duplicate_index.duplicates_of(image_id)}
+        if not inline_images:
+            return image
+        with trace_span("clip.image_payload"):
+            return {**image, **get_image_payload_cache().get(image_path)}
+
+    def query(self, query_text: str, k: int=5, inline_images: bool = True) -> List[Dict]:
+        return self.query_many([query_text], k, inline_images)[0]
+
+class FederatedSearchHandler:
+    """
+    Searches several keyword-RAG indexes (e.g. one built with the email type prompt and one with the audience prompt),
+    and optionally the CLIP index, as one search. The keyword-RAG indexes share an embeddings model, so the query is
+    embedded once for all of them, and once with CLIP at the same time. Every index is then searched concurrently,
+    and the ranked lists are fused by weighted reciprocal rank fusion.
+
+    Each email in the fused results is hydrated once, with the tags from every keyword-RAG index that has a tag set
+    for it. weights maps index names to their weight in the fusion, 1 by default.
+    """
+
+    # Each index contributes this many times k candidates, so emails ranked fairly well by several indexes can
+    # outrank one found by a single index
+    CANDIDATES_PER_RESULT = 2
+
+    def __init__(
+        self,
+        keyword_rag_index_names: List[str],
+        clip_index_name: str = None,
+        weights: Dict[str, float] = None,
+        keyword_rag_handlers: List[KeyWordRAGSearchHandler] = None,
+        clip_handler: ImageEmbeddingsSearchHandler = None,
+        duplicate_index: DuplicateImageIndex = None
+    ):
+        self.keyword_rag_handlers = keyword_rag_handlers or [
+            get_keyword_rag_search_handler(index_name) for index_name in keyword_rag_index_names
+        ]
+        if clip_handler is None and clip_index_name is not None:
+            clip_handler = get_image_embeddings_search_handler(clip_index_name)
+        self.clip_handler = clip_handler
 
-            # Here, we use the filename of the image as the ID in pinecone. That can then be used to grab both
-            # the image itself, and the tags, both of which are stored locally.
-            image_path = self._get_email_image_path(match['id'])
-            most_similar_emails.append({
-                "image": get_image_base64_from_path(image_path),
-                "tags": self._get_tags_for_email(image_path)
-            })
+        # In the order the ranked lists are fused: CLIP first, if searched
+        self.index_names = [handler.index_name for handler in self.keyword_rag_handlers]
+        if self.clip_handler is not None:
+            self.index_names.insert(0, self.clip_handler.index_name)
+        if not self.index_names:
+            raise ValueError("At least one index is needed for a federated search")
 
-        return most_similar_emails
+        weights = weights or {}
+        self.weights = [weights.get(index_name, 1.0) for index_name in self.index_names]
 
-class ImageEmbeddingsSearchHandler(object):
+        # Results from every index are keyed by image file name, and collapsed to one per group of near-identical images
+        self.duplicate_index = duplicate_index or get_duplicate_image_index()
+        self._representative_ids = self.duplicate_index.representative_ids()
 
-    # DEFAULT_INDEX_NAME = "clip-email-index"
-    CLIP_MODEL =  "openai/clip-vit-base-patch32"
-    CLIP_INDEX_NAMESPACE = "ns1"
+        self._pool = ThreadPoolExecutor(max_workers=len(self.index_names), thread_name_prefix="federated-search")
 
-    def __init__(self, index_name):
-        self.pc = Pinecone(os.getenv('PINECONE_API_KEY'))
-        self.index_name = index_name
-        self.index = self.pc.Index(self.index_name)
-
-    @cached_property
-    def _model(self):
-        model = CLIPModel.from_pretrained(self.CLIP_MODEL)
-        model.to("cpu")
-        return model
-
-    @cached_property
-    def _processor(self):
-        return CLIPProcessor.from_pretrained(self.CLIP_MODEL)
-
-    def query(self, query_text: str) -> List[Dict]:
-
-        text_embedding = self._processor(
-            text=query_text,
-            padding=True,
-            images=None,
-            return_tensors='pt'
-        ).to("cpu")
-
-        text_emb = self._model.get_text_features(**text_embedding)[0].tolist()
-
-        results = self.index.query(
-            namespace=self.CLIP_INDEX_NAMESPACE,
-            vector=text_emb,
-            top_k=5,
-            include_values=False,
-            include_metadata=True
-        )
+    def _search_clip(self, email_queries: List[str], top_k: int) -> List[List[Dict]]:
+        query_vectors = self.clip_handler._query_embeddings(email_queries)
+        with trace_span("federated.vector_query", index=self.clip_handler.index_name):
+            return self.clip_handler.vector_store.query_many(vectors=query_vectors, top_k=top_k)
 
-        image_file_paths = [os.path.join(IMAGES_FOLDER, m['id']) for m in results['matches']]
+    def _search_keyword_rag(
+        self,
+        handler: KeyWordRAGSearchHandler,
+        query_vectors: List[List[float]],
+        top_k: int
+    ) -> List[List[Dict]]:
+        with trace_span("federated.vector_query", index=handler.index_name):
+            matches_per_query = handler.vector_store.query_many(vectors=query_vectors, top_k=top_k)
+        # Keyword-RAG ids are tag set ids, so are mapped to the image file names CLIP uses
         return [
-            {"image": get_image_base64_from_path(image_file_path)} for image_file_path in image_file_paths
+            [{**match, "id": os.path.basename(handler._get_email_image_path(match["id"]))} for match in matches]
+            for matches in matches_per_query
         ]
 
+    def _email_from_image_file_name(self, image_file_name: str, inline_images: bool = True) -> Dict:
+        image_path = os.path.join(IMAGES_FOLDER, image_file_name)
+        tags = []
+        for handler in self.keyword_rag_handlers:
+            try:
+                tags.append(handler._get_tags_for_email(image_path))
+            except KeyError:
+                pass
+        email = {
+            "image_path": image_path,
+            "tags": "\n".join(tags),
+            "duplicates": self.duplicate_index.duplicates_of(image_file_name)
+        }
+        if inline_images:
+            with trace_span("federated.image_payload"):
+                email.update(get_image_payload_cache().get(image_path))
+        return email
+
+    def query_many(self, email_queries: List[str], k: int=5, inline_images: bool = True) -> List[List[Dict]]:
+        """
+        Each result also has its fused score, and the names of the indexes that found it.
+
+        With inline_images=False results carry only the image path, for rendering with image URLs.
+        """
+        top_k = k * self.CANDIDATES_PER_RESULT
+        with trace_span("federated.query_many", indexes=len(self.index_names), queries=len(email_queries), k=k):
+            searches = []
+            if self.clip_handler is not None:
+                searches.append(self._pool.submit(bind_trace_context(self._search_clip), email_queries, top_k))
+            if self.keyword_rag_handlers:
+                query_vectors = self.keyword_rag_handlers[0]._query_embeddings(email_queries)
+                searches.extend(
+                    self._pool.submit(bind_trace_context(self._search_keyword_rag), handler, query_vectors, top_k)
+                    for handler in self.keyword_rag_handlers
+                )
+            matches_per_index = [search.result() for search in searches]
+
+            fused_per_query, found_by_per_query = [], []
+            for matches_per_query in zip(*matches_per_index):
+                ranked_lists = [
+                    _collapse_duplicates(matches, self._representative_ids, top_k) for matches in matches_per_query
+                ]
+                found_by = {}
+                for index_name, matches in zip(self.index_names, ranked_lists):
+                    for match in matches:
+                        found_by.setdefault(match["id"], []).append(index_name)
+                fused_per_query.append(reciprocal_rank_fusion(ranked_lists, weights=self.weights, top_k=k))
+                found_by_per_query.append(found_by)
+
+            ids = [match["id"] for fused in fused_per_query for match in fused]
+            with trace_span("federated.hydrate", matches=len(ids)):
+                emails_by_id = _hydrate_unique(
+                    ids, partial(self._email_from_image_file_name, inline_images=inline_images)
+                )
+
+            return [
+                [
+                    {**emails_by_id[match["id"]], "score": match["score"], "indexes": found_by[match["id"]]}
+                    for match in fused
+                ]
+                for fused, found_by in zip(fused_per_query, found_by_per_query)
+            ]
+
+    def query(self, email_query: str, k: int=5, inline_images: bool = True) -> List[Dict]:
+        return self.query_many([email_query], k, inline_images)[0]
+
 class EmailHTMLDisplayHTMLRenderer:
+    """
+    By default images are inlined as base64 data URIs. Given an image_server, images are referenced by URL instead:
+    resized to image_width (with a 2x variant for high-density screens) and loaded lazily, so the page stays a few
+    kilobytes however many results it shows.
+
+    With page_size set, each engine shows page_size emails per row, and further rows are collapsed until opened.
+    Lazily loaded images in collapsed rows are not fetched until then.
+    """
+
+    def __init__(self, image_server: ImageServer = None, image_width: int = THUMBNAIL_WIDTH, page_size: int = None):
+        self.image_server = image_server
+        self.image_width = image_width
+        self.page_size = page_size
 
     @staticmethod
     def _tags_display_component(email: Dict) -> str:
         if email.get("tags"):
-            tags =  email["tags"].replace("\n", "<br>").replace("tags:","<b>Tags used in Keyword RAG:</b>")
+            # Queries and tags are escaped, since pages are served over HTTP by the query service
+            tags =  html.escape(email["tags"]).replace("\n", "<br>").replace("tags:","<b>Tags used in Keyword RAG:</b>")
             return f"""<div style="font-size:12px;"> {tags} </div> """
         else:
             return ""
 
-    @staticmethod
-    def _email_display_component(email: Dict) -> str:
+    def _image_src_attributes(self, email: Dict) -> str:
+        if self.image_server is not None and email.get("image_path"):
+            high_density_width = next((w for w in VARIANT_WIDTHS if w >= 2 * self.image_width), None)
+            srcset = ""
+            if high_density_width is not None:
+                srcset = (f' srcset="{self.image_server.image_url(email["image_path"], self.image_width)} 1x, '
+                          f'{self.image_server.image_url(email["image_path"], high_density_width)} 2x"')
+            return (f'src="{self.image_server.image_url(email["image_path"], self.image_width)}"{srcset} '
+                    f'loading="lazy" decoding="async"')
+
+        # Inline fallback. Results hydrated without image data are loaded here.
+        if "image" not in email:
+            email = {**email, **get_image_payload_cache().get(email["image_path"])}
+        return f'src="data:{email.get("media_type", "image/png")};base64,{email["image"]}"'
+
+    def _email_display_component(self, email: Dict) -> str:
 
         return f"""
                 <div style="height: 600px; overflow: hidden;">
-                    <img src="data:image/png;base64,{email["image"]}" style="width: 100%;" ></img>
+                    <img {self._image_src_attributes(email)} style="width: 100%;" ></img>
                 </div>"""
 
 
+    @staticmethod
+    def _duplicates_display_component(email: Dict) -> str:
+        if email.get("duplicates"):
+            return f"""<div style="font-size:12px;"><i>+{len(email["duplicates"])} near-identical emails</i></div>"""
+        else:
+            return ""
+
     def _single_email_display_wrapper(self, email: Dict, width_pct: int) -> str:
 
         return f"""   
             <div style="width: {width_pct}%;">   
                 {self._email_display_component(email)}
+                {self._duplicates_display_component(email)}
                 {self._tags_display_component(email)} 
             </div>"""
 
 
     def _emails_row_component(self, email_images: List[Dict]) -> str:
+        if not email_images:
+            return ""
         width_pct = math.floor(100 / len(email_images))
         return f"""
                 <div class="row" style="display: flex; flex-wrap: wrap; justify-content: space-between; width: 100%; align-items: flex-start;"> 
                 {''.join(self._single_email_display_wrapper(email_img, width_pct) for email_img in email_images)}
                 </div>"""
 
+    def _emails_rows_component(self, email_images: List[Dict]) -> str:
+        if not self.page_size or len(email_images) <= self.page_size:
+            return self._emails_row_component(email_images)
+
+        pages = [email_images[i:i + self.page_size] for i in range(0, len(email_images), self.page_size)]
+        more_pages = "".join(
+            f"""<details><summary>Results {page_number * self.page_size + 1}-{page_number * self.page_size + len(page)}</summary>
+                {self._emails_row_component(page)}
+                </details>"""
+            for page_number, page in enumerate(pages[1:], start=1)
+        )
+        return self._emails_row_component(pages[0]) + more_pages
+
     def _emails_row_outer_div(self, email_images, title):
         return f"""<div style="display: flex; flex-direction: column; align-items: center; width: 95%;">    
             <div style="display: flex; flex-direction: column; gap: 20px;">  
                 <h2>{title}</h2> 
-                {self._emails_row_component(email_images)}
+                {self._emails_rows_component(email_images)}
             </div>"""
 
 
@@ -192,7 +512,7 @@ class EmailHTMLDisplayHTMLRenderer:
     ) -> str:
 
         html_content = f"""  <div style="display: flex; flex-direction: column; gap: 20px;">    
-        <h1>Query Used: {email_query}</h1>
+        <h1>Query Used: {html.escape(email_query)}</h1>
             {self._emails_row_outer_div(emails_from_keywords_rag, "Emails found, Keyword RAG Search")}
             {self._emails_row_outer_div(emails_from_image_embeddings, "Emails found,  Image embeddings Search")} 
         </div> 
@@ -200,22 +520,130 @@ class EmailHTMLDisplayHTMLRenderer:
 
         return html_content
 
+    def display_emails_html_from_federated_query(self, emails: List[Dict[str,str]], email_query: str) -> str:
+        return f"""  <div style="display: flex; flex-direction: column; gap: 20px;">    
+        <h1>Query Used: {html.escape(email_query)}</h1>
+            {self._emails_row_outer_div(emails, "Emails found, Federated Search")}
+        </div> 
+        """
 
 
-def display_emails_from_query(
-    email_query: str,
-    keyword_rag_index_name: str,
-    clip_index_name: str
-) -> str:
+
+@lru_cache(maxsize=None)
+def get_keyword_rag_search_handler(index_name: str) -> KeyWordRAGSearchHandler:
+    return KeyWordRAGSearchHandler(index_name)
+
+
+@lru_cache(maxsize=None)
+def get_image_embeddings_search_handler(index_name: str) -> ImageEmbeddingsSearchHandler:
+    """
+    The CLIP text encoder is loaded here rather than on the first query, so calling this at startup (e.g. when a
+    notebook or the query service starts) takes the model load off the first search.
+    """
+    handler = ImageEmbeddingsSearchHandler(index_name)
+    handler.text_encoder.load()
+    return handler
 
 
-    emails_from_keywords_rag = KeyWordRAGSearchHandler(keyword_rag_index_name).query(email_query)
-    emails_from_image_embeddings = ImageEmbeddingsSearchHandler(clip_index_name).query(email_query)
+@lru_cache(maxsize=None)
+def get_federated_search_handler(
+    keyword_rag_index_names: Tuple[str, ...],
+    clip_index_name: str = None
+) -> FederatedSearchHandler:
+    return FederatedSearchHandler(list(keyword_rag_index_names), clip_index_name)
 
-    return EmailHTMLDisplayHTMLRenderer().display_emails_html_from_query(
-        emails_from_keywords_rag=emails_from_keywords_rag,
-        emails_from_image_embeddings=emails_from_image_embeddings,
-        email_query=email_query
-    )
 
+def _renderer(image_urls: bool, page_size: int) -> EmailHTMLDisplayHTMLRenderer:
+    return EmailHTMLDisplayHTMLRenderer(image_server=get_image_server() if image_urls else None, page_size=page_size)
 
+
+def display_emails_from_query(
+    email_query: str,
+    keyword_rag_index_name: str,
+    clip_index_name: str,
+    k: int = 5,
+    image_urls: bool = False,
+    page_size: int = None
+) -> str:
+    """
+    With image_urls=True, images are served by the local image server instead of being inlined in the HTML.
+    """
+
+    with trace_span("display.emails_from_query", image_urls=image_urls):
+        # Both engines run at the same time, on handlers that are kept alive between calls
+        with trace_span("display.search"):
+            keyword_rag_search = _SEARCH_POOL.submit(
+                bind_trace_context(get_keyword_rag_search_handler(keyword_rag_index_name).query),
+                email_query, k, inline_images=not image_urls
+            )
+            image_embeddings_search = _SEARCH_POOL.submit(
+                bind_trace_context(get_image_embeddings_search_handler(clip_index_name).query),
+                email_query, k, inline_images=not image_urls
+            )
+
+            emails_from_keywords_rag = keyword_rag_search.result()
+            emails_from_image_embeddings = image_embeddings_search.result()
+
+        with trace_span("display.render"):
+            return _renderer(image_urls, page_size).display_emails_html_from_query(
+                emails_from_keywords_rag=emails_from_keywords_rag,
+                emails_from_image_embeddings=emails_from_image_embeddings,
+                email_query=email_query
+            )
+
+
+def display_emails_from_queries(
+    email_queries: List[str],
+    keyword_rag_index_name: str,
+    clip_index_name: str,
+    k: int = 5,
+    image_urls: bool = False,
+    page_size: int = None
+) -> str:
+    """
+    Same as display_emails_from_query for a whole set of queries, using one batched search per engine.
+    """
+
+    with trace_span("display.emails_from_queries", queries=len(email_queries), image_urls=image_urls):
+        with trace_span("display.search"):
+            keyword_rag_search = _SEARCH_POOL.submit(
+                bind_trace_context(get_keyword_rag_search_handler(keyword_rag_index_name).query_many),
+                email_queries, k, inline_images=not image_urls
+            )
+            image_embeddings_search = _SEARCH_POOL.submit(
+                bind_trace_context(get_image_embeddings_search_handler(clip_index_name).query_many),
+                email_queries, k, inline_images=not image_urls
+            )
+
+            emails_from_keywords_rag = keyword_rag_search.result()
+            emails_from_image_embeddings = image_embeddings_search.result()
+
+        with trace_span("display.render"):
+            renderer = _renderer(image_urls, page_size)
+            return "".join(
+                renderer.display_emails_html_from_query(
+                    emails_from_keywords_rag=keyword_rag_emails,
+                    emails_from_image_embeddings=image_embedding_emails,
+                    email_query=email_query
+                )
+                for email_query, keyword_rag_emails, image_embedding_emails
+                in zip(email_queries, emails_from_keywords_rag, emails_from_image_embeddings)
+            )
+
+
+def display_emails_from_federated_query(
+    email_query: str,
+    keyword_rag_index_names: List[str],
+    clip_index_name: str = None,
+    k: int = 5,
+    image_urls: bool = False,
+    page_size: int = None
+) -> str:
+    """
+    One row of results fused from all the keyword-RAG indexes, and the CLIP index if given.
+    """
+    with trace_span("display.emails_from_federated_query", image_urls=image_urls):
+        handler = get_federated_search_handler(tuple(keyword_rag_index_names), clip_index_name)
+        emails = handler.query(email_query, k, inline_images=not image_urls)
+        with trace_span("display.render"):
+            return _renderer(image_urls, page_size).display_emails_html_from_federated_query(emails, email_query)
@@ -0,0 +1,138 @@
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from directories import QUERY_EMBEDDING_CACHE_PATH
+
+
+def normalize_query_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """
+    Caches query embeddings keyed by (model, input_type, normalized text).
+
+    Lookups go to an in-process LRU first, then, if a sqlite_path is given, to a SQLite table that can be shared by
+    every worker on the machine. Only the texts missing from both are passed to the embed function, in one call.
+    """
+
+    def __init__(self, max_entries: int = 10000, sqlite_path: str = None):
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+
+        self._entries: OrderedDict[Tuple[str, str, str], List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._connections = threading.local()
+
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        if self.sqlite_path is not None:
+            self._connection().execute(
+                """CREATE TABLE IF NOT EXISTS query_embeddings (
+                    model TEXT, input_type TEXT, text TEXT, embedding BLOB,
+                    PRIMARY KEY (model, input_type, text)
+                )"""
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.sqlite_path)), exist_ok=True)
+            connection = sqlite3.connect(self.sqlite_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._connections.connection = connection
+        return connection
+
+    def _read_persistent(self, key: Tuple[str, str, str]) -> List[float] | None:
+        if self.sqlite_path is None:
+            return None
+        row = self._connection().execute(
+            "SELECT embedding FROM query_embeddings WHERE model = ? AND input_type = ? AND text = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def _write_persistent(self, entries: Dict[Tuple[str, str, str], List[float]]) -> None:
+        if self.sqlite_path is None or not entries:
+            return
+        self._connection().executemany(
+            "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+            [(*key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in entries.items()]
+        )
+
+    def _remember(self, key: Tuple[str, str, str], embedding: List[float]) -> None:
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(
+        self,
+        model: str,
+        input_type: str,
+        texts: List[str],
+        embed: Callable[[List[str]], List[List[float]]]
+    ) -> List[List[float]]:
+        """
+        Returns one embedding per text. embed is called once, with one text for each normalized text not in the
+        cache. It gets the text as the caller wrote it (the first spelling, if several normalize to the same text),
+        since embedding models can be case sensitive; normalizing only decides which texts share an embedding.
+        """
+        keys = [(model, input_type, normalize_query_text(text)) for text in texts]
+        embeddings = {}
+
+        for key in keys:
+            if key in embeddings:
+                continue
+            with self._lock:
+                embedding = self._entries.get(key)
+                if embedding is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+            if embedding is None:
+                embedding = self._read_persistent(key)
+                if embedding is not None:
+                    self.persistent_hits += 1
+                    self._remember(key, embedding)
+            if embedding is not None:
+                embeddings[key] = embedding
+
+        # Missing key -> first original text with that key
+        missing_texts = {}
+        for key, text in zip(keys, texts):
+            if key not in embeddings:
+                missing_texts.setdefault(key, text)
+        if missing_texts:
+            with self._lock:
+                self.misses += len(missing_texts)
+            computed = dict(zip(missing_texts, embed(list(missing_texts.values()))))
+            for key, embedding in computed.items():
+                self._remember(key, embedding)
+            self._write_persistent(computed)
+            embeddings.update(computed)
+
+        return [embeddings[key] for key in keys]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "entries": len(self._entries)
+        }
+
+
+@lru_cache(maxsize=None)
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    return QueryEmbeddingCache(sqlite_path=QUERY_EMBEDDING_CACHE_PATH)
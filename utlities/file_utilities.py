@@ -0,0 +1,16 @@
+import os
+import json
+import threading
+
+
+def atomic_write_json(file_path: str, data, indent: int = None) -> None:
+    """
+    Writes to a temporary file in the same folder and renames it into place, so readers (and a crashed run) only
+    ever see the old or the new file, never a truncated one.
+    """
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
@@ -1,27 +1,49 @@
 
-import io
 import base64
 import anthropic
 import os
 import json
-from typing import List, Dict
+from typing import List, Dict, Iterator, Tuple
 from PIL import Image
-from tenacity import retry, stop_after_attempt, retry_if_result, wait_exponential
-import re
 from pillow_avif import AvifImagePlugin
 from anthropic.types.messages.batch_create_params import Request
 from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
 from anthropic.types.message import Message
 from anthropic.types.messages.message_batch import MessageBatch
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from functools import cached_property
 
 
-from directories import IMAGES_FOLDER, IMAGE_TAG_SETS_FOLDER
+from directories import IMAGES_FOLDER, IMAGE_TAG_SETS_FOLDER, REQUEST_IMAGES_FOLDER
+from hashing import config_hash, file_content_hash, text_hash
+from image_processing import crop_and_resize, draft_for_width, encode_image_within_budget
+from tag_set_manifest import TagSetManifest
+from vector_store import VectorStore
+from batch_poller import MessageBatchPoller
+from batch_journal import BatchJournal
+from tag_set_store import TagSetStore, tag_set_id
+from image_dedup import DuplicateImageIndex, get_duplicate_image_index
+from image_cache import get_image_payload_cache
+from tracing import trace_span
 
+# Image formats accepted by the Messages API
+MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
 
 
 class BaseAnthropicPromptMixin:
 
+    # Images are cropped and scaled to REQUEST_IMAGE_WIDTH x at most REQUEST_IMAGE_MAX_HEIGHT, which sets their token
+    # cost, then encoded as REQUEST_IMAGE_FORMAT ("JPEG" or "WEBP"). The quality is stepped down from
+    # REQUEST_IMAGE_QUALITY towards REQUEST_IMAGE_MIN_QUALITY until the image fits in REQUEST_IMAGE_MAX_BYTES.
+    REQUEST_IMAGE_WIDTH = 600
+    REQUEST_IMAGE_MAX_HEIGHT = 1400
+    REQUEST_IMAGE_FORMAT = "JPEG"
+    REQUEST_IMAGE_QUALITY = 85
+    REQUEST_IMAGE_MIN_QUALITY = 50
+    REQUEST_IMAGE_MAX_BYTES = 200 * 1024
+
     def __init__(self, model="claude-3-5-sonnet-20241022", max_tokens=1000, temperature=0):
         self.CLIENT = anthropic.Anthropic()
         self.claude_config = {
@@ -36,20 +58,46 @@ class BaseAnthropicPromptMixin:
             target_width: int = 600,
             max_height: int = 1400
     ) -> Image:
+        return crop_and_resize(img, target_width, max_height)
+
+    @classmethod
+    def _request_image_media_type(cls) -> str:
+        return MEDIA_TYPES[cls.REQUEST_IMAGE_FORMAT.upper()]
+
+    @classmethod
+    def _request_image_config(cls) -> Dict:
+        return {
+            "width": cls.REQUEST_IMAGE_WIDTH,
+            "max_height": cls.REQUEST_IMAGE_MAX_HEIGHT,
+            "format": cls.REQUEST_IMAGE_FORMAT.upper(),
+            "quality": cls.REQUEST_IMAGE_QUALITY,
+            "min_quality": cls.REQUEST_IMAGE_MIN_QUALITY,
+            "max_bytes": cls.REQUEST_IMAGE_MAX_BYTES,
+            # Images cached before transparent areas were flattened onto white are not reused
+            "transparent_background": "white"
+        }
 
-        width, height = img.size
-        aspect_ratio = height / width
-
-        new_width = target_width
-        new_height = int(new_width * aspect_ratio)
-        resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-
-        if new_height > max_height:
-            resized_img = resized_img.crop((0, 0, new_width, max_height))
-
-        return resized_img
+    @classmethod
+    def _encode_request_image(cls, image_path: str) -> bytes:
+        with Image.open(image_path) as image:
+            draft_for_width(image, cls.REQUEST_IMAGE_WIDTH)
+            resized_image = crop_and_resize(image, cls.REQUEST_IMAGE_WIDTH, cls.REQUEST_IMAGE_MAX_HEIGHT)
+
+        return encode_image_within_budget(
+            resized_image,
+            cls.REQUEST_IMAGE_FORMAT,
+            quality=cls.REQUEST_IMAGE_QUALITY,
+            max_bytes=cls.REQUEST_IMAGE_MAX_BYTES,
+            min_quality=cls.REQUEST_IMAGE_MIN_QUALITY
+        )
 
-    def _image_filename_to_base64(self, image_filename: str) -> str:
+    @classmethod
+    def _image_filename_to_base64(cls, image_filename: str) -> str:
+        """
+        Base64 of the image as sent to Claude. Encoded images are cached in REQUEST_IMAGES_FOLDER, named by the
+        content hash of the source image and the preprocessing settings, so re-indexing an image is a file read.
+        """
+        # A classmethod, so that it can be sent to worker processes without pickling the Anthropic client
         try:
             image_path = os.path.join(IMAGES_FOLDER, image_filename)
 
@@ -57,20 +105,25 @@ class BaseAnthropicPromptMixin:
                 print(f"Image file not found: {image_path}")
                 return ""
 
-            with Image.open(image_path) as image:
-                resized_image = self._resize_and_crop_image(image)
-
-                img_buffer = io.BytesIO()
-
-                resized_image.save(img_buffer, format="PNG")
-                img_bytes = img_buffer.getvalue()
-                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-                return img_base64
+            cache_key = f"{file_content_hash(image_path)}_{config_hash(cls._request_image_config())[:16]}"
+            cached_path = os.path.join(REQUEST_IMAGES_FOLDER, f"{cache_key}.{cls.REQUEST_IMAGE_FORMAT.lower()}")
+
+            if os.path.exists(cached_path):
+                with open(cached_path, "rb") as f:
+                    img_bytes = f.read()
+            else:
+                img_bytes = cls._encode_request_image(image_path)
+                os.makedirs(REQUEST_IMAGES_FOLDER, exist_ok=True)
+                tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(img_bytes)
+                os.replace(tmp_path, cached_path)
+
+            return base64.b64encode(img_bytes).decode('utf-8')
         except Exception as e:
             print(f"error with rendering email {image_filename}: {e}")
             return base64.b64encode(b"").decode('utf-8')
 
-
     @staticmethod
     def _create_tags_dictionary(message : Message, tags_to_ignore: List[str]) -> Dict:
         tags_dict = json.loads(message.content[0].text)
@@ -99,7 +152,7 @@ class SingleImagePromptHandler(BaseAnthropicPromptMixin):
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/png",
+                                "media_type": self._request_image_media_type(),
                                 "data": self._image_filename_to_base64(image_file),
                             },
                         },
@@ -116,9 +169,34 @@ class BatchNotReadyException(Exception):
 
 class KeywordRAGIndexCreator(BaseAnthropicPromptMixin):
 
-    BATCH_SIZE = 50
+    # Anthropic's limits for a single message batch
+    MAX_BATCH_REQUESTS = 100000
+    MAX_BATCH_BYTES = 256 * 1024 * 1024
 
-    def __init__(self, index_name, data_extraction_prompt, tags_to_ignore: List[str] = None):
+    # Batches are filled to this share of MAX_BATCH_BYTES, measured from each request's real size
+    BATCH_BYTES_FILL_RATIO = 0.9
+    # A batch is held in memory until it is submitted, and the client's JSON encoding of it roughly doubles that, so
+    # batches are also capped at this size. At a few hundred KB per image that is still hundreds of requests a batch.
+    MAX_BATCH_BYTES_IN_MEMORY = 64 * 1024 * 1024
+
+    # Images are encoded in worker processes (None = one per core), in chunks of ENCODE_CHUNK_SIZE. Up to
+    # PREFETCH_CHUNKS chunks are encoded ahead of the one being added to a batch.
+    PREPROCESSING_WORKERS = None
+    ENCODE_CHUNK_SIZE = 50
+    PREFETCH_CHUNKS = 2
+
+    # While ingesting a batch, progress is checkpointed to the manifest and journal every this many results
+    CHECKPOINT_EVERY_N_RESULTS = 50
+
+    def __init__(
+        self,
+        index_name,
+        data_extraction_prompt,
+        tags_to_ignore: List[str] = None,
+        vector_store: VectorStore = None,
+        retag_unrecorded_tag_sets: bool = False,
+        deduplicate: bool = False
+    ):
 
 
         super().__init__()
@@ -130,6 +208,17 @@ class KeywordRAGIndexCreator(BaseAnthropicPromptMixin):
             tags_to_ignore = []
         self.tags_to_ignore = tags_to_ignore
 
+        # If set, vectors for images that no longer exist are deleted from here along with their tag sets
+        self.vector_store = vector_store
+
+        # Tag sets written before the manifest existed are assumed to match the current prompt and config, so
+        # upgrading does not re-tag every image. Set this to re-tag them instead.
+        self.retag_unrecorded_tag_sets = retag_unrecorded_tag_sets
+
+        # If set, only one image per group of near-identical images is sent to Claude, and its tag set is copied to
+        # the rest of the group
+        self.duplicate_index: DuplicateImageIndex | None = get_duplicate_image_index() if deduplicate else None
+
         # assumed that all files here are images
         self.image_file_names = [
             image_file_name for image_file_name in os.listdir(IMAGES_FOLDER) if not image_file_name.startswith(".")
@@ -140,111 +229,304 @@ class KeywordRAGIndexCreator(BaseAnthropicPromptMixin):
         # IDs for batch items in Anthropic must be no longer than 64 characters
         # and must not use special characters other than "-" and "_"
         # Filenames are used as IDs, but must conform to these requirements (assumed all filenames are unique)
-        id_character_limit = 64
-        name, ext = os.path.splitext(image_file_name)
-        return re.sub(r'[^a-zA-Z0-9_-]', '_', name)[:id_character_limit]
+        return tag_set_id(image_file_name)
 
-    def _create_requests_list(self, image_file_names_batch: List[str]) -> List[Request]:
-        requests = []
+    def _create_request(self, image_file_name: str, image_data: str) -> Request | None:
+        # Skip images that could not be encoded
+        if not image_data:
+            print(f"Skipping {image_file_name} - could not convert to base64")
+            return None
 
-        for image_file_name in image_file_names_batch:
-            try:
-                # Get image data first and skip if not available
-                image_data = self._image_filename_to_base64(image_file_name)
-                if not image_data:
-                    print(f"Skipping {image_file_name} - could not convert to base64")
-                    continue
-
-                requests.append(
-                    Request(
-                        custom_id=self._name_for_anthropic_id(image_file_name),
-                        params=MessageCreateParamsNonStreaming(
-                            **self.claude_config,
-                            system=self.data_extraction_prompt,
-                            messages=[{
-                                "role": "user",
-                                "content": [{
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": "image/png",
-                                        "data": image_data,
-                                    },
-                                }]
-                            }]
-                        )
-                    )
+        try:
+            return Request(
+                custom_id=self._name_for_anthropic_id(image_file_name),
+                params=MessageCreateParamsNonStreaming(
+                    **self.claude_config,
+                    system=self.data_extraction_prompt,
+                    messages=[{
+                        "role": "user",
+                        "content": [{
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": self._request_image_media_type(),
+                                "data": image_data,
+                            },
+                        }]
+                    }]
                 )
-            except Exception as e:
-                print(f"Error creating request for {image_file_name}: {e}")
-
-        return requests
+            )
+        except Exception as e:
+            print(f"Error creating request for {image_file_name}: {e}")
+            return None
+
+    @cached_property
+    def _request_overhead_bytes(self) -> int:
+        """
+        Serialized size of a request apart from its image data, with the longest possible custom_id.
+        Base64 needs no JSON escaping, so a request's size is this plus the length of its image data.
+        """
+        request = self._create_request("x" * 64, "x")
+        return len(json.dumps(request)) - 1 + len(", ")
 
     def _make_tags_folder(self):
         if not os.path.isdir(self.tags_folder_file_path):
             os.mkdir(self.tags_folder_file_path)
 
-    def _create_batches_in_anthropic(self):
-        message_batches = []
-        for i in range(0, len(self.image_file_names ), self.BATCH_SIZE):
-            print(f'batch starting with image {i}, {datetime.now()}')
-            message_batch = self.CLIENT.messages.batches.create(
-                requests=self._create_requests_list(
-                    image_file_names_batch=self.image_file_names [i:i +  self.BATCH_SIZE]
-                )
-            )
+    def _manifest_record(self, image_file_name: str) -> Dict:
+        return TagSetManifest.create_record(
+            image_file_name=image_file_name,
+            image_hash=file_content_hash(os.path.join(IMAGES_FOLDER, image_file_name)),
+            prompt_hash=text_hash(self.data_extraction_prompt),
+            model_config={**self.claude_config, "tags_to_ignore": self.tags_to_ignore}
+        )
 
-            message_batches.append(message_batch)
+    def _select_images_to_tag(self) -> List[str]:
+        """
+        Returns the images whose tag set is missing, or was made from different image content, prompt or config.
+        Records for images to be tagged are journaled with their batch and moved to the manifest once saved.
+        """
+        self._pending_manifest_records = {}
+        image_file_names_to_tag = []
+
+        image_file_names = self.image_file_names
+        if self.duplicate_index is not None:
+            image_file_names = self.duplicate_index.representatives(image_file_names)
+
+        for image_file_name in image_file_names:
+            set_id = self._name_for_anthropic_id(image_file_name)
+            record = self._manifest_record(image_file_name)
+            tag_set_exists = self.tag_set_store.contains(set_id)
+
+            if set_id not in self.manifest.records and tag_set_exists and not self.retag_unrecorded_tag_sets:
+                self.manifest.set(set_id, record)
+
+            if tag_set_exists and self.manifest.is_up_to_date(set_id, record):
+                continue
+
+            self._pending_manifest_records[set_id] = record
+            image_file_names_to_tag.append(image_file_name)
+
+        return image_file_names_to_tag
+
+    def _remove_stale_tag_sets(self) -> None:
+        stale_tag_set_ids = self.manifest.ids_for_missing_images(self.image_file_names)
+        if not stale_tag_set_ids:
+            return
+
+        print(f"Removing {len(stale_tag_set_ids)} tag sets for deleted images")
+        self.tag_set_store.delete(stale_tag_set_ids)
+        for set_id in stale_tag_set_ids:
+            self.manifest.remove(set_id)
+
+        if self.vector_store is not None:
+            self.vector_store.delete(stale_tag_set_ids)
+
+        self.manifest.save()
+
+    def _fan_out_tag_sets_to_duplicates(self) -> None:
+        """
+        Copies the tag set of each group's representative to the other images in the group. A copied tag set's
+        manifest record is the representative's, so it is copied again whenever the representative is re-tagged.
+        """
+        if self.duplicate_index is None or not self.duplicate_index.has_duplicates:
+            return
+
+        representative_records = {}
+        copied = 0
+        for image_file_name in self.image_file_names:
+            representative = self.duplicate_index.representative(image_file_name)
+            if representative == image_file_name:
+                continue
+
+            if representative not in representative_records:
+                representative_records[representative] = self._manifest_record(representative)
+            representative_record = representative_records[representative]
+            representative_id = self._name_for_anthropic_id(representative)
+            if not self.manifest.is_up_to_date(representative_id, representative_record):
+                # Not tagged, e.g. its request failed
+                continue
+
+            duplicate_id = self._name_for_anthropic_id(image_file_name)
+            record = {**representative_record, "image_file_name": image_file_name}
+            if self.tag_set_store.contains(duplicate_id) and self.manifest.is_up_to_date(duplicate_id, record):
+                continue
+
+            self.tag_set_store.put(duplicate_id, self.tag_set_store.get(representative_id))
+            self.manifest.set(duplicate_id, record)
+            copied += 1
+
+        self.manifest.save()
+        print(f"Copied {copied} tag sets to duplicate images")
+
+    def _encoded_chunks(
+        self,
+        pool: ProcessPoolExecutor,
+        image_file_names: List[str]
+    ) -> Iterator[Tuple[List[str], List[str]]]:
+        """
+        Yields (file names, base64 images) per chunk of ENCODE_CHUNK_SIZE images, in order. Encoding of the following
+        chunks is already queued in the pool while the caller handles the current one.
+        """
+        in_flight: deque[Tuple[List[str], List[Future]]] = deque()
+        chunk_starts = iter(range(0, len(image_file_names), self.ENCODE_CHUNK_SIZE))
+
+        def queue_next_chunk() -> None:
+            start = next(chunk_starts, None)
+            if start is None:
+                return
+            names = image_file_names[start:start + self.ENCODE_CHUNK_SIZE]
+            in_flight.append((names, [pool.submit(self._image_filename_to_base64, n) for n in names]))
+
+        for _ in range(self.PREFETCH_CHUNKS + 1):
+            queue_next_chunk()
+
+        while in_flight:
+            names, futures = in_flight.popleft()
+            images_data = [future.result() for future in futures]
+            queue_next_chunk()
+            yield names, images_data
+
+    def _request_batches(self, pool: ProcessPoolExecutor, image_file_names: List[str]) -> Iterator[List[Request]]:
+        """
+        Builds requests as their images are encoded, and yields them in batches that are as large as the batch
+        request-count and byte limits allow.
+
+        Each yielded batch is a list held fully in memory, so it is capped at MAX_BATCH_BYTES_IN_MEMORY (64 MB) rather
+        than Anthropic's 256 MB. Raise that cap only together with the memory available to the build.
+        """
+        max_batch_bytes = min(int(self.MAX_BATCH_BYTES * self.BATCH_BYTES_FILL_RATIO), self.MAX_BATCH_BYTES_IN_MEMORY)
+        batch, batch_bytes = [], 0
+
+        for names, images_data in self._encoded_chunks(pool, image_file_names):
+            with trace_span("keyword_index.create_requests_list", images=len(names)):
+                for image_file_name, image_data in zip(names, images_data):
+                    request = self._create_request(image_file_name, image_data)
+                    if request is None:
+                        continue
+
+                    request_bytes = self._request_overhead_bytes + len(image_data)
+                    if request_bytes > max_batch_bytes:
+                        print(f"Skipping {image_file_name} - request is larger than a whole batch")
+                        continue
+
+                    batch_full = len(batch) >= self.MAX_BATCH_REQUESTS or batch_bytes + request_bytes > max_batch_bytes
+                    if batch and batch_full:
+                        yield batch
+                        batch, batch_bytes = [], 0
+
+                    batch.append(request)
+                    batch_bytes += request_bytes
+
+        if batch:
+            yield batch
+
+    def _create_batches_in_anthropic(self, image_file_names: List[str]):
+        """
+        Submits the batches from _request_batches one at a time. The client JSON-encodes a whole batch before sending
+        it, so peak memory is about twice MAX_BATCH_BYTES_IN_MEMORY, whatever the number of images.
+        """
+        message_batches = []
+        with ProcessPoolExecutor(max_workers=self.PREPROCESSING_WORKERS) as pool:
+            for requests in self._request_batches(pool, image_file_names):
+                print(f"Submitting batch of {len(requests)} requests, {datetime.now()}")
+                with trace_span("keyword_index.submit_batch", requests=len(requests)):
+                    message_batch = self.CLIENT.messages.batches.create(requests=requests)
+
+                self.journal.record_submitted(message_batch.id, {
+                    request["custom_id"]: self._pending_manifest_records[request["custom_id"]] for request in requests
+                })
+                message_batches.append(message_batch)
         return message_batches
 
-    @staticmethod
-    def _batch_status_not_complete(message_batch):
-        return message_batch.processing_status != "ended"
-
-    @retry(wait=wait_exponential(multiplier=2, min=2, max=300),
-            stop=stop_after_attempt(20),
-           retry=retry_if_result(_batch_status_not_complete))
-    def _check_batch_status(self, batch: MessageBatch) -> MessageBatch:
-        message_batch = self.CLIENT.messages.batches.retrieve(batch.id)
+    def _checkpoint(self) -> None:
+        # Manifest first: a result marked saved in the journal must already be recorded in the manifest
+        self.manifest.save()
+        self.journal.save()
 
-        status = message_batch.processing_status
-        print(f"Batch {batch.id} status: {status}, {datetime.now()}")
-        return message_batch
-
-    def _wait_for_batch_to_finish(self, batch: MessageBatch) -> bool:
-        print(f"Waiting for batch {batch.id}")
-
-        # Keep trying until batch is complete
-        try:
-            self._check_batch_status(batch)
-            print(f"Batch {batch.id} finished successfully. Grabbing data.")
-            return True
-        except Exception as e:
-            print(f"Batch {batch.id} ended without completion. Unable to process images.")
-            return False
-
-    def _extract_and_save_data_from_batch(self, batch: MessageBatch) -> Dict:
+    def _extract_and_save_data_from_batch(self, batch: MessageBatch) -> None:
 
+        results_since_checkpoint = 0
         for result in self.CLIENT.messages.batches.results(
                 batch.id,
         ):
+            if self.journal.is_saved(batch.id, result.custom_id):
+                continue
+
             try:
                 tags_dict = self._create_tags_dictionary(result.result.message, self.tags_to_ignore)
 
-                with open(os.path.join(self.tags_folder_file_path, result.custom_id + ".json"), 'w') as output_file:
-                    json.dump(tags_dict, output_file, indent=4)
+                self.tag_set_store.put(result.custom_id, tags_dict)
+
+                record = self.journal.manifest_record(batch.id, result.custom_id)
+                if record is not None:
+                    self.manifest.set(result.custom_id, record)
+                self.journal.mark_saved(batch.id, result.custom_id)
             except Exception as e:
                 print(e)
 
-    def create_image_tags_full_dataset(self) -> None:
+            results_since_checkpoint += 1
+            if results_since_checkpoint >= self.CHECKPOINT_EVERY_N_RESULTS:
+                self._checkpoint()
+                results_since_checkpoint = 0
+
+        self.manifest.save()
+        self.journal.mark_ingested(batch.id)
 
+    def _load_build_state(self) -> None:
         self._make_tags_folder()
+        self.manifest = TagSetManifest(self.tags_folder_file_path)
+        self.journal = BatchJournal(self.tags_folder_file_path)
+        self.tag_set_store = TagSetStore(self.index_name)
+
+    def _wait_for_batches_and_save_results(self, message_batches: List[MessageBatch]) -> None:
+        MessageBatchPoller(
+            client=self.CLIENT,
+            on_batch_ended=self._extract_and_save_data_from_batch
+        ).wait_for_all(message_batches)
+
+    def _resume_journaled_batches(self) -> None:
+        pending_batch_ids = self.journal.pending_batch_ids()
+        if not pending_batch_ids:
+            return
+
+        print(f"Reattaching to {len(pending_batch_ids)} batches from a previous run")
+        message_batches = []
+        for batch_id in pending_batch_ids:
+            try:
+                message_batches.append(self.CLIENT.messages.batches.retrieve(batch_id))
+            except anthropic.NotFoundError:
+                print(f"Batch {batch_id} no longer exists, its images will be re-submitted")
+                self.journal.mark_ingested(batch_id)
 
-        print(f"{len(self.image_file_names)} tag sets to create")
-        message_batches = self._create_batches_in_anthropic()
+        self._wait_for_batches_and_save_results(message_batches)
 
-        for batch in message_batches:
-            if self._wait_for_batch_to_finish(batch):
-                self._extract_and_save_data_from_batch(
-                    batch=batch
-                )
+    def resume(self) -> None:
+        """
+        Reattaches to batches submitted by an interrupted run and saves any results not already written.
+        """
+        self._load_build_state()
+        self._resume_journaled_batches()
+
+    def create_image_tags_full_dataset(self) -> None:
+
+        self._load_build_state()
+        self._resume_journaled_batches()
+
+        self._remove_stale_tag_sets()
+        if self.duplicate_index is not None:
+            self.duplicate_index.build(self.image_file_names, workers=self.PREPROCESSING_WORKERS)
+        image_file_names_to_tag = self._select_images_to_tag()
+        self.manifest.save()
+
+        print(f"{len(image_file_names_to_tag)} of {len(self.image_file_names)} tag sets to create")
+        message_batches = self._create_batches_in_anthropic(image_file_names_to_tag)
+
+        # Thumbnails for search results are made while the batches are processing
+        get_image_payload_cache().build_thumbnails(
+            [os.path.join(IMAGES_FOLDER, image_file_name) for image_file_name in self.image_file_names],
+            workers=self.PREPROCESSING_WORKERS
+        )
+
+        self._wait_for_batches_and_save_results(message_batches)
+        self._fan_out_tag_sets_to_duplicates()
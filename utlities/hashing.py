@@ -0,0 +1,18 @@
+import hashlib
+import json
+
+
+def file_content_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def config_hash(config: dict) -> str:
+    return text_hash(json.dumps(config, sort_keys=True))
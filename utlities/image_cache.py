@@ -0,0 +1,190 @@
+import os
+import json
+import base64
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+from directories import THUMBNAILS_FOLDER
+from file_utilities import atomic_write_json
+from hashing import file_content_hash
+from image_processing import crop_and_resize, encode_image
+from tracing import trace_span
+
+THUMBNAIL_WIDTH = 400
+THUMBNAIL_MAX_HEIGHT = 1600
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_MEDIA_TYPE = "image/webp"
+THUMBNAIL_QUALITY = 80
+
+# Not known to mimetypes on every Python version
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+# Widths served by the image server. Heights are cropped in the same proportion as THUMBNAIL_MAX_HEIGHT.
+VARIANT_WIDTHS = (200, THUMBNAIL_WIDTH, 800)
+
+
+def _write_thumbnail(image_path: str, thumbnail_path: str, width: int = THUMBNAIL_WIDTH) -> bool:
+    try:
+        with Image.open(image_path) as image:
+            thumbnail = crop_and_resize(image, width, THUMBNAIL_MAX_HEIGHT * width // THUMBNAIL_WIDTH)
+            thumbnail_bytes = encode_image(thumbnail, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    except Exception as e:
+        print(f"Unable to create thumbnail for {image_path}: {e}")
+        return False
+
+    tmp_path = f"{thumbnail_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(thumbnail_bytes)
+    os.replace(tmp_path, thumbnail_path)
+    return True
+
+
+class ImagePayloadCache:
+    """
+    Base64 image payloads for query results, served from two tiers:
+
+    1. An in-memory LRU of encoded payloads, bounded by max_memory_bytes.
+    2. Pre-resized WebP thumbnails on disk, named by the content hash of their source image.
+
+    A source file's hash is remembered together with its mtime and size, so a changed file gets a new thumbnail
+    while an unchanged one costs a single stat. Images that cannot be thumbnailed are served as the original file.
+    """
+
+    HASHES_FILE_NAME = "source_hashes.json"
+
+    def __init__(self, thumbnails_folder: str = THUMBNAILS_FOLDER, max_memory_bytes: int = 256 * 1024 * 1024):
+        self.thumbnails_folder = thumbnails_folder
+        self.max_memory_bytes = max_memory_bytes
+        self.hashes_path = os.path.join(self.thumbnails_folder, self.HASHES_FILE_NAME)
+
+        self._payloads: OrderedDict[Tuple, Dict] = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._source_hashes = self._load_source_hashes()
+
+    def _load_source_hashes(self) -> Dict[str, List]:
+        if not os.path.exists(self.hashes_path):
+            return {}
+        with open(self.hashes_path, "r") as f:
+            return json.load(f)
+
+    def _save_source_hashes(self) -> None:
+        os.makedirs(self.thumbnails_folder, exist_ok=True)
+        with self._lock:
+            source_hashes = dict(self._source_hashes)
+        atomic_write_json(self.hashes_path, source_hashes)
+
+    def _thumbnail_path(self, content_hash: str, width: int = THUMBNAIL_WIDTH) -> str:
+        file_name = content_hash if width == THUMBNAIL_WIDTH else f"{content_hash}_w{width}"
+        return os.path.join(self.thumbnails_folder, file_name + "." + THUMBNAIL_FORMAT.lower())
+
+    def _content_hash(self, image_path: str, stat: os.stat_result) -> Tuple[str, bool]:
+        """
+        Returns the content hash of the image, and whether it had to be recomputed.
+        """
+        known = self._source_hashes.get(image_path)
+        if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2], False
+
+        content_hash = file_content_hash(image_path)
+        with self._lock:
+            self._source_hashes[image_path] = [stat.st_mtime_ns, stat.st_size, content_hash]
+        return content_hash, True
+
+    def _variant_file(self, image_path: str, stat: os.stat_result, width: int) -> Tuple[str, str, str]:
+        content_hash, hash_changed = self._content_hash(image_path, stat)
+        thumbnail_path = self._thumbnail_path(content_hash, width)
+
+        if not os.path.exists(thumbnail_path):
+            os.makedirs(self.thumbnails_folder, exist_ok=True)
+            with trace_span("image_cache.write_thumbnail", width=width):
+                _write_thumbnail(image_path, thumbnail_path, width)
+        if hash_changed:
+            self._save_source_hashes()
+
+        if os.path.exists(thumbnail_path):
+            return thumbnail_path, THUMBNAIL_MEDIA_TYPE, f"{content_hash}-w{width}"
+        return image_path, mimetypes.guess_type(image_path)[0] or "image/png", content_hash
+
+    def variant_file(self, image_path: str, width: int = THUMBNAIL_WIDTH) -> Tuple[str, str, str]:
+        """
+        Returns (path, media type, etag) of the image resized to width, which must be one of VARIANT_WIDTHS.
+        The variant is created on first use; if that fails the original file is returned.
+        """
+        if width not in VARIANT_WIDTHS:
+            raise ValueError(f"Unsupported image width {width}, expected one of {VARIANT_WIDTHS}")
+        return self._variant_file(image_path, os.stat(image_path), width)
+
+    def _load_payload(self, image_path: str, stat: os.stat_result) -> Dict:
+        payload_path, media_type, _ = self._variant_file(image_path, stat, THUMBNAIL_WIDTH)
+
+        with trace_span("image_cache.read"):
+            with open(payload_path, "rb") as f:
+                image_bytes = f.read()
+        with trace_span("image_cache.base64", bytes=len(image_bytes)):
+            return {"image": base64.b64encode(image_bytes).decode('utf-8'), "media_type": media_type}
+
+    def _remember(self, key: Tuple, payload: Dict) -> None:
+        size = len(payload["image"])
+        if size > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            if key in self._payloads:
+                return
+            self._payloads[key] = payload
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._payloads.popitem(last=False)
+                self._memory_bytes -= len(evicted["image"])
+
+    def get(self, image_path: str) -> Dict:
+        """
+        Returns {"image": <base64>, "media_type": <mime type>} for the image at image_path.
+        """
+        stat = os.stat(image_path)
+        key = (image_path, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            payload = self._payloads.get(key)
+            if payload is not None:
+                self._payloads.move_to_end(key)
+                return payload
+
+        payload = self._load_payload(image_path, stat)
+        self._remember(key, payload)
+        return payload
+
+    def build_thumbnails(self, image_paths: List[str], workers: int = None) -> None:
+        """
+        Creates any missing thumbnails for image_paths on a process pool. Called while indexing, so queries only
+        read thumbnails that already exist.
+        """
+        os.makedirs(self.thumbnails_folder, exist_ok=True)
+
+        to_create = {}
+        for image_path in image_paths:
+            content_hash, _ = self._content_hash(image_path, os.stat(image_path))
+            thumbnail_path = self._thumbnail_path(content_hash)
+            if not os.path.exists(thumbnail_path):
+                to_create[thumbnail_path] = image_path
+        self._save_source_hashes()
+
+        if not to_create:
+            return
+
+        print(f"Creating {len(to_create)} thumbnails")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_write_thumbnail, to_create.values(), to_create.keys(), chunksize=16))
+
+
+@lru_cache(maxsize=None)
+def get_image_payload_cache() -> ImagePayloadCache:
+    return ImagePayloadCache()
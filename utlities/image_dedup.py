@@ -0,0 +1,258 @@
+import os
+import json
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+from pillow_avif import AvifImagePlugin
+
+from directories import IMAGES_FOLDER, VECTOR_INDEXES_FOLDER
+from file_utilities import atomic_write_json
+from image_processing import draft_for_width
+
+# Images are shrunk to HASH_IMAGE_SIZE x HASH_IMAGE_SIZE grey pixels, and the hash is taken from the lowest
+# HASH_FREQUENCIES x HASH_FREQUENCIES frequencies of their DCT
+HASH_IMAGE_SIZE = 32
+HASH_FREQUENCIES = 8
+
+# Pairs within the hash distance are confirmed on CONFIRM_IMAGE_SIZE x CONFIRM_IMAGE_SIZE colour thumbnails, since
+# the low frequencies of a few flat blocks can agree even when the blocks differ
+CONFIRM_IMAGE_SIZE = 16
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    n = np.arange(size)
+    return np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+
+
+_DCT = _dct_matrix(HASH_IMAGE_SIZE)
+
+def _perceptual_hash(image_path: str) -> str | None:
+    """
+    64-bit DCT hash: one bit per low frequency (apart from the constant term), set if that frequency is stronger than
+    the median. Re-encodes, rescales and small edits of an image change only a few bits.
+    """
+    # Runs in worker processes
+    try:
+        with Image.open(image_path) as image:
+            draft_for_width(image, HASH_IMAGE_SIZE)
+            pixels = np.asarray(
+                image.convert("L").resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.BILINEAR),
+                dtype=np.float64
+            )
+    except Exception as e:
+        print(f"Unable to hash {image_path}: {e}")
+        return None
+
+    frequencies = (_DCT @ pixels @ _DCT.T)[:HASH_FREQUENCIES, :HASH_FREQUENCIES].flatten()[1:]
+    return np.packbits(frequencies > np.median(frequencies)).tobytes().hex()
+
+
+def _confirmation_pixels(image_path: str) -> np.ndarray | None:
+    try:
+        with Image.open(image_path) as image:
+            draft_for_width(image, CONFIRM_IMAGE_SIZE)
+            return np.asarray(
+                image.convert("RGB").resize((CONFIRM_IMAGE_SIZE, CONFIRM_IMAGE_SIZE), Image.BILINEAR),
+                dtype=np.uint8
+            )
+    except Exception as e:
+        print(f"Unable to compare {image_path}: {e}")
+        return None
+
+
+class DuplicateImageIndex:
+    """
+    Groups near-identical images in the images folder (the same campaign in another format, resends) by the Hamming
+    distance between their perceptual hashes, so each group only has to be tagged, embedded and shown once.
+
+    Hashes are remembered with each file's mtime and size, so a rebuild only hashes new or changed images. Groups are
+    found with a multi-index lookup: each hash is split into HASH_BLOCKS blocks with a lookup table per block, and
+    only images that are close to each other in at least one block are ever compared.
+
+    Within a group, the first image by file name is the representative. Every other image is within max_distance of
+    it, and differs from it by at most max_pixel_difference per channel on average at CONFIRM_IMAGE_SIZE.
+    """
+
+    HASHES_FILE_NAME = "perceptual_hashes.json"
+    DUPLICATES_FILE_NAME = "image_duplicates.json"
+    HASH_BLOCKS = 4
+
+    def __init__(
+        self,
+        images_folder: str = IMAGES_FOLDER,
+        index_folder: str = VECTOR_INDEXES_FOLDER,
+        max_distance: int = 6,
+        max_pixel_difference: float = 6.0
+    ):
+        self.images_folder = images_folder
+        self.max_distance = max_distance
+        self.max_pixel_difference = max_pixel_difference
+        self.hashes_path = os.path.join(index_folder, self.HASHES_FILE_NAME)
+        self.duplicates_path = os.path.join(index_folder, self.DUPLICATES_FILE_NAME)
+
+        # Duplicate image file name -> file name of its group's representative
+        self._representatives: Dict[str, str] = {}
+        self._duplicates: Dict[str, List[str]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.duplicates_path):
+            return
+        with open(self.duplicates_path, "r") as f:
+            saved = json.load(f)
+        # Groups made with other thresholds are ignored until the next build
+        if (saved.get("images_folder"), saved.get("max_distance"), saved.get("max_pixel_difference")) == (
+            self.images_folder, self.max_distance, self.max_pixel_difference
+        ):
+            self._set_representatives(saved["representatives"])
+
+    def _set_representatives(self, representatives: Dict[str, str]) -> None:
+        duplicates = {}
+        for image_file_name, representative in representatives.items():
+            duplicates.setdefault(representative, []).append(image_file_name)
+        self._representatives = representatives
+        self._duplicates = duplicates
+
+    def _load_hashes(self) -> Dict[str, List]:
+        if not os.path.exists(self.hashes_path):
+            return {}
+        with open(self.hashes_path, "r") as f:
+            return json.load(f)
+
+    def _hashes(self, image_file_names: List[str], workers: int = None) -> Dict[str, str]:
+        known_hashes = self._load_hashes()
+        hashes, stats, to_hash = {}, {}, []
+        for image_file_name in image_file_names:
+            stat = os.stat(os.path.join(self.images_folder, image_file_name))
+            stats[image_file_name] = [stat.st_mtime_ns, stat.st_size]
+            known = known_hashes.get(image_file_name)
+            if known is not None and known[:2] == stats[image_file_name]:
+                hashes[image_file_name] = known[2]
+            else:
+                to_hash.append(image_file_name)
+
+        if to_hash:
+            print(f"Hashing {len(to_hash)} images")
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                image_paths = [os.path.join(self.images_folder, image_file_name) for image_file_name in to_hash]
+                for image_file_name, image_hash in zip(to_hash, pool.map(_perceptual_hash, image_paths, chunksize=32)):
+                    if image_hash is not None:
+                        hashes[image_file_name] = image_hash
+
+        os.makedirs(os.path.dirname(self.hashes_path), exist_ok=True)
+        atomic_write_json(self.hashes_path, {
+            image_file_name: stats[image_file_name] + [image_hash] for image_file_name, image_hash in hashes.items()
+        })
+        return hashes
+
+    def _confirmed_duplicates(self, image_file_name: str, other_image_file_name: str, pixels_cache: Dict) -> bool:
+        for name in (image_file_name, other_image_file_name):
+            if name not in pixels_cache:
+                pixels_cache[name] = _confirmation_pixels(os.path.join(self.images_folder, name))
+        pixels, other_pixels = pixels_cache[image_file_name], pixels_cache[other_image_file_name]
+        if pixels is None or other_pixels is None:
+            return False
+        return float(np.abs(pixels.astype(np.int16) - other_pixels).mean()) <= self.max_pixel_difference
+
+    def _group(self, image_file_names: List[str], hashes: List[int]) -> Dict[str, str]:
+        # Two hashes within max_distance differ in at most max_distance // HASH_BLOCKS bits in at least one block, so
+        # candidates are the images with a block within that many bits of the same block of this image
+        block_radius = self.max_distance // self.HASH_BLOCKS
+        block_bits = 64 // self.HASH_BLOCKS
+        flips = [
+            sum(1 << bit for bit in bits)
+            for distance in range(block_radius + 1) for bits in combinations(range(block_bits), distance)
+        ]
+
+        blocks = [
+            [(image_hash >> (block * block_bits)) & ((1 << block_bits) - 1) for image_hash in hashes]
+            for block in range(self.HASH_BLOCKS)
+        ]
+        tables = []
+        for block in blocks:
+            table = {}
+            for row, value in enumerate(block):
+                table.setdefault(value, []).append(row)
+            tables.append(table)
+
+        representatives = {}
+        pixels_cache = {}
+        assigned = [False] * len(image_file_names)
+        for row in range(len(image_file_names)):
+            if assigned[row]:
+                continue
+            assigned[row] = True
+
+            candidates = set()
+            for table, block in zip(tables, blocks):
+                for flip in flips:
+                    candidates.update(table.get(block[row] ^ flip, ()))
+
+            for candidate in sorted(candidates):
+                if (
+                    not assigned[candidate]
+                    and bin(hashes[row] ^ hashes[candidate]).count("1") <= self.max_distance
+                    and self._confirmed_duplicates(image_file_names[row], image_file_names[candidate], pixels_cache)
+                ):
+                    assigned[candidate] = True
+                    representatives[image_file_names[candidate]] = image_file_names[row]
+        return representatives
+
+    def build(self, image_file_names: List[str] = None, workers: int = None) -> None:
+        """
+        Hashes any new or changed images on a process pool (None = one worker per core) and regroups the library.
+        """
+        if image_file_names is None:
+            image_file_names = [name for name in os.listdir(self.images_folder) if not name.startswith(".")]
+
+        hashes = self._hashes(image_file_names, workers)
+        hashed_file_names = sorted(hashes)
+        representatives = self._group(
+            hashed_file_names,
+            [int(hashes[name], 16) for name in hashed_file_names]
+        )
+
+        self._set_representatives(representatives)
+        atomic_write_json(self.duplicates_path, {
+            "images_folder": self.images_folder,
+            "max_distance": self.max_distance,
+            "max_pixel_difference": self.max_pixel_difference,
+            "representatives": representatives
+        })
+        print(f"{len(representatives)} of {len(hashed_file_names)} images are duplicates, "
+              f"in {len(self._duplicates)} groups")
+
+    @property
+    def has_duplicates(self) -> bool:
+        return bool(self._representatives)
+
+    def representative(self, image_file_name: str) -> str:
+        return self._representatives.get(image_file_name, image_file_name)
+
+    def duplicates_of(self, image_file_name: str) -> List[str]:
+        return self._duplicates.get(image_file_name, [])
+
+    def representatives(self, image_file_names: List[str]) -> List[str]:
+        """
+        The image file names that are not a duplicate of another image.
+        """
+        return [name for name in image_file_names if name not in self._representatives]
+
+    def representative_ids(self, id_for: Callable[[str], str] = None) -> Dict[str, str]:
+        """
+        Maps the id of every duplicate image to the id of its group's representative, e.g. tag set ids with
+        id_for=tag_set_id.
+        """
+        id_for = id_for or (lambda image_file_name: image_file_name)
+        return {
+            id_for(image_file_name): id_for(representative)
+            for image_file_name, representative in self._representatives.items()
+        }
+
+@lru_cache(maxsize=None)
+def get_duplicate_image_index() -> DuplicateImageIndex:
+    return DuplicateImageIndex()
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import threading
+from functools import lru_cache
+from typing import Dict
+
+from directories import IMAGES_FOLDER, VECTOR_INDEXES_FOLDER
+from file_utilities import atomic_write_json
+from tag_set_store import tag_set_id
+
+# If several files share a name, the earliest extension here wins
+IMAGE_EXTENSIONS = [
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.avif',
+    '.tiff', '.tif', '.webp', '.svg', '.ico',
+    '.heic', '.heif', '.raw', '.cr2', '.nef',
+    '.arw', '.dng', '.psd', '.ai', '.eps'
+]
+
+
+class ImageFileIndex:
+    """
+    Maps email names (image file names without extension) to their path in the images folder, and also tag set ids,
+    which is what tag sets and keyword-RAG vectors are keyed by.
+
+    The mapping is persisted next to the vector indexes together with the images folder's mtime. The folder is only
+    listed again when its mtime changes, i.e. when files are added, removed or renamed, and that check runs at most
+    once every REFRESH_INTERVAL_SECONDS. Lookups are a dictionary hit and never scan the folder.
+    """
+
+    INDEX_FILE_NAME = "image_file_index.json"
+    REFRESH_INTERVAL_SECONDS = 30
+
+    def __init__(self, images_folder: str = IMAGES_FOLDER, index_folder: str = VECTOR_INDEXES_FOLDER):
+        self.images_folder = images_folder
+        self.index_path = os.path.join(index_folder, self.INDEX_FILE_NAME)
+        self._folder_mtime_ns = None
+        self._file_names = {}
+        self._file_names_by_tag_set_id = {}
+        self._last_refresh_check = 0.0
+        self._refresh_lock = threading.Lock()
+
+        self._load()
+        self.refresh()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r") as f:
+            saved_index = json.load(f)
+        if saved_index.get("images_folder") == self.images_folder:
+            self._folder_mtime_ns = saved_index["folder_mtime_ns"]
+            self._set_file_names(saved_index["file_names"])
+
+    def _set_file_names(self, file_names: Dict[str, str]) -> None:
+        self._file_names = file_names
+        self._file_names_by_tag_set_id = {
+            tag_set_id(image_file_name): image_file_name for image_file_name in sorted(file_names.values())
+        }
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        atomic_write_json(self.index_path, {
+            "images_folder": self.images_folder,
+            "folder_mtime_ns": self._folder_mtime_ns,
+            "file_names": self._file_names
+        })
+
+    @staticmethod
+    def _build_file_names(image_file_names) -> Dict[str, str]:
+        extension_rank = {ext: rank for rank, ext in enumerate(IMAGE_EXTENSIONS)}
+
+        file_names = {}
+        for image_file_name in image_file_names:
+            stem, ext = os.path.splitext(image_file_name)
+            rank = extension_rank.get(ext.lower())
+            if rank is None:
+                continue
+            current = file_names.get(stem)
+            if current is None or rank < extension_rank[os.path.splitext(current)[1].lower()]:
+                file_names[stem] = image_file_name
+        return file_names
+
+    def refresh(self, force: bool = False) -> None:
+        with self._refresh_lock:
+            self._last_refresh_check = time.monotonic()
+
+            folder_mtime_ns = os.stat(self.images_folder).st_mtime_ns
+            if folder_mtime_ns == self._folder_mtime_ns and not force:
+                return
+
+            self._set_file_names(self._build_file_names(
+                name for name in os.listdir(self.images_folder) if not name.startswith(".")
+            ))
+            self._folder_mtime_ns = folder_mtime_ns
+            self._save()
+
+    def _refresh_if_due(self) -> None:
+        if time.monotonic() - self._last_refresh_check > self.REFRESH_INTERVAL_SECONDS:
+            self.refresh()
+
+    def path_for(self, email_name: str) -> str:
+        self._refresh_if_due()
+
+        image_file_name = self._file_names.get(email_name)
+        if image_file_name is None:
+            raise Exception(f"No local file found for {email_name}")
+        return os.path.join(self.images_folder, image_file_name)
+
+    def path_for_tag_set_id(self, image_tag_set_id: str) -> str:
+        """
+        Like path_for, for a tag set id, which differs from the email name for names with characters other than
+        letters, digits, "-" and "_", or over TAG_SET_ID_MAX_LENGTH characters.
+        """
+        self._refresh_if_due()
+
+        image_file_name = self._file_names_by_tag_set_id.get(image_tag_set_id)
+        if image_file_name is None:
+            raise Exception(f"No local file found for tag set {image_tag_set_id}")
+        return os.path.join(self.images_folder, image_file_name)
+
+
+@lru_cache(maxsize=None)
+def get_image_file_index() -> ImageFileIndex:
+    return ImageFileIndex()
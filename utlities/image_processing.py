@@ -0,0 +1,79 @@
+import io
+
+from PIL import Image
+from pillow_avif import AvifImagePlugin
+
+
+def crop_and_resize(img: Image, target_width: int, max_height: int) -> Image:
+    """
+    Scales the image to target_width and keeps at most max_height pixels from the top. The crop happens in source
+    coordinates first, so rows that would be thrown away are never resampled.
+    """
+    width, height = img.size
+    scale = target_width / width
+
+    source_max_height = min(height, round(max_height / scale))
+    if source_max_height < height:
+        img = img.crop((0, 0, width, source_max_height))
+
+    return img.resize((target_width, max(1, round(source_max_height * scale))), Image.LANCZOS)
+
+
+def draft_for_width(img: Image, target_width: int) -> Image:
+    """
+    Lets formats that support it (JPEG) decode at the smallest power-of-two reduction that is still at least
+    target_width wide, which skips most of the decode work for large images. Must be called before the pixels are
+    loaded; other formats are left unchanged.
+    """
+    width, height = img.size
+    if img.format == "JPEG" and width > target_width:
+        img.draft(img.mode, (target_width, max(1, round(height * target_width / width))))
+    return img
+
+
+def _has_transparency(img: Image) -> bool:
+    return img.mode in ("RGBA", "RGBa", "LA", "La", "PA") or "transparency" in img.info
+
+
+def flatten_onto_white(img: Image) -> Image:
+    """
+    RGB version of the image for formats without transparency, with transparent areas white rather than the black
+    a plain convert gives them.
+    """
+    if not _has_transparency(img):
+        return img.convert("RGB")
+    rgba = img.convert("RGBA")
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(rgba, mask=rgba.getchannel("A"))
+    return background
+
+
+def encode_image(img: Image, image_format: str, quality: int = None) -> bytes:
+    if image_format.upper() in ("JPEG", "JPG") and (img.mode not in ("RGB", "L") or _has_transparency(img)):
+        img = flatten_onto_white(img)
+
+    img_buffer = io.BytesIO()
+    if quality is None:
+        img.save(img_buffer, format=image_format)
+    else:
+        img.save(img_buffer, format=image_format, quality=quality)
+    return img_buffer.getvalue()
+
+
+def encode_image_within_budget(
+    img: Image,
+    image_format: str,
+    quality: int,
+    max_bytes: int,
+    min_quality: int,
+    quality_step: int = 10
+) -> bytes:
+    """
+    Encodes the image at quality, stepping the quality down until it fits in max_bytes. If it still does not fit
+    at min_quality, the min_quality encoding is returned.
+    """
+    image_bytes = encode_image(img, image_format, quality=quality)
+    while len(image_bytes) > max_bytes and quality > min_quality:
+        quality = max(min_quality, quality - quality_step)
+        image_bytes = encode_image(img, image_format, quality=quality)
+    return image_bytes
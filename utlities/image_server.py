@@ -0,0 +1,96 @@
+import os
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from directories import IMAGES_FOLDER, IMAGE_SERVER_PORT
+from image_cache import THUMBNAIL_WIDTH, VARIANT_WIDTHS, get_image_payload_cache
+
+IMAGES_ROUTE = "/images/"
+
+
+def _snap_width(requested_width: int) -> int:
+    # Smallest served width that is at least the requested one, so arbitrary widths can't fill the disk
+    return next((width for width in VARIANT_WIDTHS if width >= requested_width), VARIANT_WIDTHS[-1])
+
+
+class _ImageRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /images/<image file name>?w=<width> returns the image resized to the nearest served width.
+    """
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if not url.path.startswith(IMAGES_ROUTE):
+            self.send_error(404)
+            return
+
+        image_file_name = unquote(url.path[len(IMAGES_ROUTE):])
+        image_path = os.path.join(self.server.images_folder, image_file_name)
+        # Only files directly inside the images folder are served
+        if os.path.basename(image_file_name) != image_file_name or not os.path.isfile(image_path):
+            self.send_error(404)
+            return
+
+        try:
+            width = _snap_width(int(parse_qs(url.query).get("w", [THUMBNAIL_WIDTH])[0]))
+        except ValueError:
+            self.send_error(400, "w must be an integer")
+            return
+
+        file_path, media_type, etag = get_image_payload_cache().variant_file(image_path, width)
+        etag = f'"{etag}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        with open(file_path, "rb") as f:
+            body = f.read()
+
+        self.send_response(200)
+        self.send_header("Content-Type", media_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "public, max-age=3600")
+        self.send_header("ETag", etag)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Every thumbnail request would otherwise be printed into the notebook
+        pass
+
+
+class ImageServer:
+    """
+    Serves resized variants of the images folder over HTTP from a daemon thread, so rendered results can reference
+    images by URL instead of inlining them. Variants come from the same on-disk thumbnail cache as inline payloads.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, images_folder: str = IMAGES_FOLDER):
+        self._server = ThreadingHTTPServer((host, port), _ImageRequestHandler)
+        self._server.daemon_threads = True
+        self._server.images_folder = images_folder
+        self.host, self.port = self._server.server_address[:2]
+        self.base_url = f"http://{self.host}:{self.port}"
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name="image-server", daemon=True)
+        self._thread.start()
+
+    def image_url(self, image_path: str, width: int = THUMBNAIL_WIDTH) -> str:
+        return f"{self.base_url}{IMAGES_ROUTE}{quote(os.path.basename(image_path))}?w={width}"
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@lru_cache(maxsize=None)
+def get_image_server() -> ImageServer:
+    """
+    Process-wide image server, on IMAGE_SERVER_PORT if set and otherwise a free port.
+    """
+    return ImageServer(port=IMAGE_SERVER_PORT)
@@ -0,0 +1,194 @@
+import os
+import re
+import json
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from directories import VECTOR_INDEXES_FOLDER
+from file_utilities import atomic_write_json
+
+# Longest first, so "ments" is tried before "s"
+_SUFFIXES = ("ments", "ment", "ings", "ing", "ed", "es", "s")
+_MIN_STEM_LENGTH = 4
+
+
+def _stem(token: str) -> str:
+    # Just enough stemming for marketing tags, e.g. "abandoned" / "abandonment" -> "abandon"
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= _MIN_STEM_LENGTH:
+            return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    return [_stem(token) for token in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the tag strings of a keyword-RAG index.
+
+    On disk, postings are two flat arrays (document numbers as int32, term frequencies as uint16) that are
+    memory-mapped on load. meta.json maps each term to its offset and length in those arrays, and its idf.
+    """
+
+    META_FILE = "meta.json"
+    POSTING_DOCS_FILE = "posting_docs.i32"
+    POSTING_TFS_FILE = "posting_tfs.u16"
+    DOC_LENGTHS_FILE = "doc_lengths.f32"
+    # Indexes built before version 2 also indexed the tag set key names ("description", "tags", ...)
+    FORMAT_VERSION = 2
+    # Terms in more than this fraction of documents do not count towards a confident lexical match
+    MAX_CONFIDENT_DOC_FRACTION = 0.5
+
+    def __init__(
+        self,
+        doc_ids: List[str],
+        terms: Dict[str, Tuple[int, int, float]],
+        posting_docs: np.ndarray,
+        posting_tfs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+        version: int = FORMAT_VERSION
+    ):
+        self.doc_ids = doc_ids
+        self.terms = terms
+        self.posting_docs = posting_docs
+        self.posting_tfs = posting_tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.version = version
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @staticmethod
+    def folder_for_index(index_name: str) -> str:
+        return os.path.join(VECTOR_INDEXES_FOLDER, index_name + "_bm25")
+
+    @classmethod
+    def build(cls, documents: List[Dict[str, str]], k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        """
+        documents are {"id": ..., "text": ...} dicts, as produced by TagSetStore.lexical_documents.
+        """
+        doc_ids = [document["id"] for document in documents]
+        term_postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+
+        for doc_number, document in enumerate(documents):
+            tokens = tokenize(document["text"])
+            doc_lengths[doc_number] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_postings.setdefault(term, []).append((doc_number, tf))
+
+        terms = {}
+        posting_docs, posting_tfs = [], []
+        for term, postings in sorted(term_postings.items()):
+            doc_frequency = len(postings)
+            idf = float(np.log(1 + (len(documents) - doc_frequency + 0.5) / (doc_frequency + 0.5)))
+            terms[term] = (len(posting_docs), doc_frequency, idf)
+            posting_docs.extend(doc_number for doc_number, _ in postings)
+            posting_tfs.extend(min(tf, np.iinfo(np.uint16).max) for _, tf in postings)
+
+        return cls(
+            doc_ids=doc_ids,
+            terms=terms,
+            posting_docs=np.asarray(posting_docs, dtype=np.int32),
+            posting_tfs=np.asarray(posting_tfs, dtype=np.uint16),
+            doc_lengths=doc_lengths,
+            k1=k1,
+            b=b
+        )
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        for file_name, array in (
+            (self.POSTING_DOCS_FILE, self.posting_docs),
+            (self.POSTING_TFS_FILE, self.posting_tfs),
+            (self.DOC_LENGTHS_FILE, self.doc_lengths)
+        ):
+            tmp_path = os.path.join(folder, file_name + ".tmp")
+            np.ascontiguousarray(array).tofile(tmp_path)
+            os.replace(tmp_path, os.path.join(folder, file_name))
+
+        # meta.json is written last, so a reader never sees it next to postings from an older build
+        atomic_write_json(os.path.join(folder, self.META_FILE), {
+            "version": self.FORMAT_VERSION,
+            "doc_ids": self.doc_ids,
+            "terms": self.terms,
+            "k1": self.k1,
+            "b": self.b
+        })
+
+    @classmethod
+    def load(cls, folder: str) -> "BM25Index":
+        with open(os.path.join(folder, cls.META_FILE), "r") as f:
+            meta = json.load(f)
+
+        def open_array(file_name: str, dtype) -> np.ndarray:
+            path = os.path.join(folder, file_name)
+            if os.path.getsize(path) == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode="r")
+
+        return cls(
+            doc_ids=meta["doc_ids"],
+            terms={term: tuple(entry) for term, entry in meta["terms"].items()},
+            posting_docs=open_array(cls.POSTING_DOCS_FILE, np.int32),
+            posting_tfs=open_array(cls.POSTING_TFS_FILE, np.uint16),
+            doc_lengths=open_array(cls.DOC_LENGTHS_FILE, np.float32),
+            k1=meta["k1"],
+            b=meta["b"],
+            version=meta.get("version", 1)
+        )
+
+    @classmethod
+    def load_for_index(cls, index_name: str) -> "BM25Index | None":
+        folder = cls.folder_for_index(index_name)
+        if not os.path.exists(os.path.join(folder, cls.META_FILE)):
+            return None
+        index = cls.load(folder)
+        if index.version != cls.FORMAT_VERSION:
+            print(f"Ignoring the outdated BM25 index of {index_name}, re-run the upsert to rebuild it")
+            return None
+        return index
+
+    def search(self, query: str, k: int = 5) -> Tuple[List[Dict], int]:
+        """
+        Returns the top k {"id": ..., "score": ...} matches, and how many documents contain every informative
+        query term. Terms in more than MAX_CONFIDENT_DOC_FRACTION of the documents are not informative, and a query
+        made only of such terms has no full matches.
+        """
+        query_terms = list(dict.fromkeys(tokenize(query)))
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        terms_matched = np.zeros(len(self.doc_ids), dtype=np.int32)
+        max_confident_doc_frequency = self.MAX_CONFIDENT_DOC_FRACTION * len(self.doc_ids)
+        informative_term_count = 0
+
+        for term in query_terms:
+            entry = self.terms.get(term)
+            if entry is None:
+                # Counts as informative, so no document fully matches a query with an unknown term
+                informative_term_count += 1
+                continue
+            offset, doc_frequency, idf = entry
+            docs = self.posting_docs[offset:offset + doc_frequency]
+            tfs = self.posting_tfs[offset:offset + doc_frequency].astype(np.float32)
+
+            length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + length_norm)
+            if doc_frequency <= max_confident_doc_frequency:
+                terms_matched[docs] += 1
+                informative_term_count += 1
+
+        full_match_count = (
+            int(np.count_nonzero(terms_matched == informative_term_count)) if informative_term_count else 0
+        )
+
+        matching = np.flatnonzero(scores)
+        if len(matching) == 0:
+            return [], full_match_count
+        top = matching[np.argsort(-scores[matching])[:k]]
+        return [{"id": self.doc_ids[doc], "score": float(scores[doc])} for doc in top], full_match_count
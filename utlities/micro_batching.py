@@ -0,0 +1,132 @@
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted concurrently from many threads into batches for one process_batch call, which must
+    return one result per item, in order.
+
+    A batch is sent once it has max_batch_size items, or max_wait_ms after its first item arrived. Items wait in a
+    queue of at most max_queue_size; when it is full, submit raises QueueFullError instead of queueing more work
+    than can be served.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List], List],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 3.0,
+        max_queue_size: int = 256,
+        name: str = "micro-batcher",
+        max_samples: int = 10000
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.name = name
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._batch_sizes = deque(maxlen=max_samples)
+        self._queue_waits_ms = deque(maxlen=max_samples)
+        self._batch_durations_ms = deque(maxlen=max_samples)
+        self.submitted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.failed_batches = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(f"{self.name} has {self.max_queue_size} items waiting")
+
+        with self._lock:
+            self.submitted += 1
+        return future
+
+    def _next_batch(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+
+            # Requests that gave up waiting are not processed
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                results = self.process_batch([item for item, _, _ in batch])
+            except Exception as e:
+                with self._lock:
+                    self.failed_batches += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self._lock:
+                self.batches += 1
+                self._batch_sizes.append(len(batch))
+                self._batch_durations_ms.append((time.perf_counter() - started) * 1000)
+                self._queue_waits_ms.extend((started - queued) * 1000 for _, _, queued in batch)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            batch_sizes = np.asarray(self._batch_sizes)
+            queue_waits_ms = np.asarray(self._queue_waits_ms)
+            batch_durations_ms = np.asarray(self._batch_durations_ms)
+            stats = {
+                "queue_depth": self.queue_depth,
+                "max_queue_size": self.max_queue_size,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "failed_batches": self.failed_batches
+            }
+
+        if len(batch_sizes):
+            stats.update({
+                "mean_batch_size": float(batch_sizes.mean()),
+                "max_batch_size": int(batch_sizes.max()),
+                "p50_queue_wait_ms": float(np.percentile(queue_waits_ms, 50)),
+                "p99_queue_wait_ms": float(np.percentile(queue_waits_ms, 99)),
+                "p50_batch_ms": float(np.percentile(batch_durations_ms, 50)),
+                "p99_batch_ms": float(np.percentile(batch_durations_ms, 99))
+            })
+        return stats
@@ -4,8 +4,19 @@ from typing import List, Dict
 import time
 import os
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from langchain_pinecone import PineconeEmbeddings
-from directories import IMAGE_TAG_SETS_FOLDER
+from tenacity import retry, stop_after_attempt, wait_exponential
+from directories import VECTOR_INDEXES_FOLDER
+from hashing import text_hash
+from file_utilities import atomic_write_json
+from vector_store import VectorStore, PineconeVectorStore
+from lexical_index import BM25Index
+from tag_set_store import TagSetStore, tag_set_id
+from image_dedup import DuplicateImageIndex
+from tracing import bind_trace_context, trace_span
 
 from dotenv import load_dotenv
 
@@ -13,26 +24,17 @@ load_dotenv()
 
 EMBEDDINGS_MODEL = 'multilingual-e5-large'
 
-def _join_list_or_return_string(s: str | List) -> str:
-    if type(s) == str:
-        return ": " + s
-    if type(s) == list:
-        return ":\n - " + "\n - ".join(s)
-    print("unable to reformat ", s)
-    return ""
-
-def _email_json_to_string(email_metadata_json: Dict) -> str:
-    email_tags_str = ""
-
-    for k, v in email_metadata_json.items():
-        email_tags_str = email_tags_str + "\n\n" + k + _join_list_or_return_string(v)
-
-    return (email_tags_str)
 
+@lru_cache(maxsize=None)
+def get_pinecone_client() -> Pinecone:
+    """
+    Process-wide Pinecone client, so that long-lived handlers share its configuration and connection pools.
+    """
+    return Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
 
 def create_index(index_name: str) -> None:
 
-    pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+    pc = get_pinecone_client()
 
     embeddings = PineconeEmbeddings(
         model=EMBEDDINGS_MODEL,
@@ -60,67 +62,157 @@ def create_index(index_name: str) -> None:
     print("\n")
 
 def _get_data_to_embed(index_name: str) -> List[Dict[str, str]]:
-
-    email_tags_dir = os.path.join(IMAGE_TAG_SETS_FOLDER, index_name)
-
-    data_to_embed_list = []
-    for email_tags_file in os.listdir(email_tags_dir):
-        if email_tags_file.startswith("."):
-            continue
-
-        with open(os.path.join(email_tags_dir, email_tags_file), "r") as f:
-            email_metadata_json = json.load(f)
-
-        email_tags_str = _email_json_to_string(email_metadata_json)
-
-        data_to_embed_list.append(
-            {
-                "id": email_tags_file.replace(".json", ""),
-                "text": email_tags_str
-
-            }
-        )
-
-    return data_to_embed_list
-
-def get_embeddings_and_upsert(index_name: str) -> None:
-
-    pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
-
-    data_to_embed_list = _get_data_to_embed(index_name)
-
-    chunk_size = 50
-    chunks = [data_to_embed_list[i:i + chunk_size] for i in range(0, len(data_to_embed_list), chunk_size)]
-
-    records = []
-
-    for chunk_to_embed in chunks:
-        # Convert the text into numerical vectors that Pinecone can index
-        embeddings_chunk = pc.inference.embed(
-            model="multilingual-e5-large",
-            inputs=[d["text"] for d in chunk_to_embed],
-            parameters={
-                "input_type": "passage",
-                "truncate": "END"
-            }
-        )
-
-        for d, e in zip(chunk_to_embed, embeddings_chunk):
-            records.append({
-                "id": d["id"],
-                "values": e["values"],
-            })
-
-    index = pc.Index(index_name) 
-
-    index.upsert(
-        vectors=records,
-        namespace=index_name
+    return TagSetStore(index_name).documents()
+
+EMBED_CHUNK_SIZE = 50
+MAX_UPSERTS_IN_FLIGHT = 4
+SAVE_STATE_EVERY_N_CHUNKS = 20
+
+
+def _embedded_text_hashes_path(index_name: str) -> str:
+    return os.path.join(VECTOR_INDEXES_FOLDER, index_name + "_embedded_text_hashes.json")
+
+
+def _load_embedded_text_hashes(index_name: str, vector_store: VectorStore) -> Dict[str, str]:
+    """
+    Hashes of the documents already upserted into vector_store, or {} if the saved ones may not describe what is in
+    it: they were recorded for another store, or the store has fewer vectors than were upserted (e.g. the index was
+    recreated).
+    """
+    path = _embedded_text_hashes_path(index_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        state = json.load(f)
+
+    # Files saved before the store's location was recorded hold only the hashes
+    location, embedded_text_hashes = (state["location"], state["hashes"]) if "hashes" in state else (None, state)
+    if location is not None and location != vector_store.location:
+        print(f"Documents were upserted into {location}, not {vector_store.location}; embedding everything")
+        return {}
+
+    vector_count = vector_store.count()
+    if vector_count < len(embedded_text_hashes):
+        print(f"{vector_store.location} has {vector_count} vectors, but {len(embedded_text_hashes)} were upserted; "
+              f"embedding everything")
+        return {}
+    return embedded_text_hashes
+
+
+def _save_embedded_text_hashes(
+    index_name: str,
+    vector_store: VectorStore,
+    embedded_text_hashes: Dict[str, str]
+) -> None:
+    os.makedirs(VECTOR_INDEXES_FOLDER, exist_ok=True)
+    atomic_write_json(_embedded_text_hashes_path(index_name), {
+        "location": vector_store.location,
+        "hashes": embedded_text_hashes
+    })
+
+
+@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=1, max=30), reraise=True)
+def _embed_passages(pc: Pinecone, texts: List[str]) -> List[List[float]]:
+    # Convert the text into numerical vectors that Pinecone can index
+    embeddings_chunk = pc.inference.embed(
+        model=EMBEDDINGS_MODEL,
+        inputs=texts,
+        parameters={
+            "input_type": "passage",
+            "truncate": "END"
+        }
     )
+    return [e["values"] for e in embeddings_chunk]
+
+
+@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=1, max=30), reraise=True)
+def _upsert_chunk(vector_store: VectorStore, records: List[Dict]) -> None:
+    with trace_span("upsert.upsert_chunk", records=len(records)):
+        vector_store.upsert(records)
+
+
+def get_embeddings_and_upsert(
+    index_name: str,
+    vector_store: VectorStore = None,
+    incremental: bool = True,
+    duplicate_index: DuplicateImageIndex = None
+) -> None:
+    """
+    Embeds tag sets and upserts them in chunks, with up to MAX_UPSERTS_IN_FLIGHT chunks being sent at once.
+
+    In incremental mode the hash of each document's embedding text is remembered once its vector is upserted, so
+    only new or changed documents are embedded, and vectors for documents that no longer exist are deleted.
+    Everything is re-embedded if the hashes were saved for another vector store, or the store has fewer vectors
+    than were upserted, e.g. after the index was recreated. incremental=False always re-embeds everything.
+
+    With a duplicate_index, only the representative of each group of near-identical images is embedded and indexed,
+    and vectors already upserted for the other images of a group are deleted.
+    """
+
+    pc = get_pinecone_client()
+    if vector_store is None:
+        vector_store = PineconeVectorStore(pc.Index(index_name), namespace=index_name)
+
+    with trace_span("upsert.load_documents"):
+        data_to_embed_list = _get_data_to_embed(index_name)
+        if duplicate_index is not None:
+            duplicate_ids = duplicate_index.representative_ids(id_for=tag_set_id)
+            data_to_embed_list = [d for d in data_to_embed_list if d["id"] not in duplicate_ids]
+
+        embedded_text_hashes = _load_embedded_text_hashes(index_name, vector_store) if incremental else {}
+        text_hashes = {d["id"]: text_hash(d["text"]) for d in data_to_embed_list}
+
+    removed_ids = [doc_id for doc_id in embedded_text_hashes if doc_id not in text_hashes]
+    if removed_ids:
+        # The vector store splits the delete into requests as large as its backend accepts
+        with trace_span("upsert.delete", ids=len(removed_ids)):
+            vector_store.delete(removed_ids)
+    for doc_id in removed_ids:
+        del embedded_text_hashes[doc_id]
+
+    to_embed = [d for d in data_to_embed_list if embedded_text_hashes.get(d["id"]) != text_hashes[d["id"]]]
+    print(f"{len(to_embed)} documents to embed, {len(removed_ids)} removed, "
+          f"{len(data_to_embed_list) - len(to_embed)} unchanged")
+
+    def record_upserted(chunk_ids: List[str]) -> None:
+        for doc_id in chunk_ids:
+            embedded_text_hashes[doc_id] = text_hashes[doc_id]
+
+    in_flight = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_UPSERTS_IN_FLIGHT) as upsert_pool:
+            for chunk_number, i in enumerate(range(0, len(to_embed), EMBED_CHUNK_SIZE), start=1):
+                chunk_to_embed = to_embed[i:i + EMBED_CHUNK_SIZE]
+                with trace_span("upsert.embed_chunk", texts=len(chunk_to_embed)):
+                    embeddings = _embed_passages(pc, [d["text"] for d in chunk_to_embed])
+                records = [{"id": d["id"], "values": e} for d, e in zip(chunk_to_embed, embeddings)]
+
+                if len(in_flight) >= MAX_UPSERTS_IN_FLIGHT:
+                    chunk_ids, future = in_flight.popleft()
+                    with trace_span("upsert.wait_for_upsert"):
+                        future.result()
+                    record_upserted(chunk_ids)
+                in_flight.append((
+                    [d["id"] for d in chunk_to_embed],
+                    upsert_pool.submit(bind_trace_context(_upsert_chunk), vector_store, records)
+                ))
+
+                if chunk_number % SAVE_STATE_EVERY_N_CHUNKS == 0:
+                    _save_embedded_text_hashes(index_name, vector_store, embedded_text_hashes)
+
+            while in_flight:
+                chunk_ids, future = in_flight.popleft()
+                future.result()
+                record_upserted(chunk_ids)
+    finally:
+        # Whatever was upserted before a failure is kept, so a re-run only does the remaining documents
+        _save_embedded_text_hashes(index_name, vector_store, embedded_text_hashes)
+
+    # The BM25 index used by KeyWordRAGSearchHandler.hybrid_query is built from the same tag sets, values only
+    lexical_documents = TagSetStore(index_name).lexical_documents()
+    with trace_span("upsert.build_bm25", documents=len(lexical_documents)):
+        BM25Index.build(lexical_documents).save(BM25Index.folder_for_index(index_name))
 
     print("Index after upsert:")
-    print(pc.Index(index_name).describe_index_stats())
+    print(vector_store.describe())
     print("\n")
-
-
-
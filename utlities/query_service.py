@@ -0,0 +1,260 @@
+"""
+Long-running HTTP query service, with handlers, models and indexes kept warm between requests.
+
+    python utlities/query_service.py --keyword-rag-index email-type --clip-index clip-email-index
+
+Concurrent requests are coalesced per engine into micro-batches, so one e5 embed call and one CLIP text forward
+pass serve many queries. Endpoints:
+
+    GET /search?q=<query>&k=5&engines=keyword_rag,clip   results as JSON, with image URLs from the image server
+    GET /html?q=<query>&k=5                               both engines rendered side by side
+    GET /metrics                                          request latency, and queue depth and batch sizes per engine
+"""
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError
+from functools import lru_cache, partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from directories import QUERY_SERVICE_PORT
+from display import (
+    EmailHTMLDisplayHTMLRenderer,
+    get_image_embeddings_search_handler,
+    get_keyword_rag_search_handler
+)
+from image_server import ImageServer, get_image_server
+from micro_batching import MicroBatcher, QueueFullError
+
+ENGINES = ("keyword_rag", "clip")
+MAX_K = 100
+
+
+def _search_batch(handler, requests: List[Tuple[str, int]]) -> List[List[Dict]]:
+    # One query_many call for the whole batch, at the largest k asked for; top-k results are a prefix of top-max(k)
+    max_k = max(k for _, k in requests)
+    results = handler.query_many([query for query, _ in requests], max_k, inline_images=False)
+    return [matches[:k] for matches, (_, k) in zip(results, requests)]
+
+
+class _QueryRequestHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Dict[str, str] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: Dict, headers: Dict[str, str] = None) -> None:
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json", headers)
+
+    def do_GET(self) -> None:
+        service: QueryService = self.server.service
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        if url.path == "/metrics":
+            self._send_json(200, service.metrics())
+            return
+        if url.path not in ("/search", "/html"):
+            self._send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+
+        try:
+            query = params["q"][0]
+            k = int(params.get("k", [5])[0])
+            engines = params.get("engines", [",".join(ENGINES)])[0].split(",")
+            if url.path == "/html":
+                engines = list(ENGINES)
+            if not 0 < k <= MAX_K or not engines or any(engine not in ENGINES for engine in engines):
+                raise ValueError
+        except (KeyError, ValueError):
+            self._send_json(400, {"error": f"Expected q, k between 1 and {MAX_K}, and engines from {ENGINES}"})
+            return
+
+        try:
+            results = service.search(query, k, engines)
+        except QueueFullError as e:
+            self._send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+            return
+        except TimeoutError:
+            self._send_json(504, {"error": "Search timed out"})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+
+        if url.path == "/html":
+            self._send(200, service.render(query, results).encode("utf-8"), "text/html; charset=utf-8")
+        else:
+            self._send_json(200, {"query": query, "k": k, "results": results})
+
+    def log_message(self, format, *args) -> None:
+        # Per-request lines would drown out everything else; /metrics has the numbers
+        pass
+
+
+class QueryService:
+    """
+    Serves searches over one keyword-RAG index and one CLIP index from a ThreadingHTTPServer.
+
+    Each engine has a MicroBatcher: a batch is sent after max_batch_size queries, or max_wait_ms after its first
+    query. When an engine already has max_queue_size queries waiting, further requests get a 503 with Retry-After
+    rather than queueing without bound.
+    """
+
+    def __init__(
+        self,
+        keyword_rag_index_name: str,
+        clip_index_name: str,
+        host: str = "127.0.0.1",
+        port: int = QUERY_SERVICE_PORT,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 3.0,
+        max_queue_size: int = 256,
+        request_timeout_s: float = 30.0,
+        keyword_rag_handler=None,
+        clip_handler=None,
+        image_server: ImageServer = None
+    ):
+        handlers = {
+            "keyword_rag": keyword_rag_handler or get_keyword_rag_search_handler(keyword_rag_index_name),
+            "clip": clip_handler or get_image_embeddings_search_handler(clip_index_name)
+        }
+        self.batchers = {
+            engine: MicroBatcher(
+                partial(_search_batch, handler),
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+                max_queue_size=max_queue_size,
+                name=f"{engine}-batcher"
+            )
+            for engine, handler in handlers.items()
+        }
+        self.request_timeout_s = request_timeout_s
+        self.image_server = image_server or get_image_server()
+        self.renderer = EmailHTMLDisplayHTMLRenderer(image_server=self.image_server)
+
+        self._latencies_ms = deque(maxlen=10000)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+        self._server = ThreadingHTTPServer((host, port), _QueryRequestHandler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        self.host, self.port = self._server.server_address[:2]
+        self.base_url = f"http://{self.host}:{self.port}"
+        self._thread = None
+
+    def search(self, query: str, k: int, engines: List[str]) -> Dict[str, List[Dict]]:
+        start = time.perf_counter()
+        futures = {}
+        try:
+            for engine in engines:
+                futures[engine] = self.batchers[engine].submit((query, k))
+        except QueueFullError:
+            for future in futures.values():
+                future.cancel()
+            with self._lock:
+                self.rejected += 1
+            raise
+
+        results = {}
+        for engine, future in futures.items():
+            results[engine] = [
+                {**result, "image_url": self.image_server.image_url(result["image_path"])}
+                for result in future.result(timeout=self.request_timeout_s)
+            ]
+
+        with self._lock:
+            self.requests += 1
+            self._latencies_ms.append((time.perf_counter() - start) * 1000)
+        return results
+
+    def render(self, query: str, results: Dict[str, List[Dict]]) -> str:
+        return self.renderer.display_emails_html_from_query(
+            emails_from_keywords_rag=results["keyword_rag"],
+            emails_from_image_embeddings=results["clip"],
+            email_query=query
+        )
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            latencies_ms = np.asarray(self._latencies_ms)
+            metrics = {"requests": self.requests, "rejected": self.rejected}
+
+        if len(latencies_ms):
+            metrics.update({
+                "p50_latency_ms": float(np.percentile(latencies_ms, 50)),
+                "p95_latency_ms": float(np.percentile(latencies_ms, 95)),
+                "p99_latency_ms": float(np.percentile(latencies_ms, 99))
+            })
+        metrics["engines"] = {engine: batcher.stats() for engine, batcher in self.batchers.items()}
+        return metrics
+
+    def warm_up(self) -> None:
+        """
+        Runs one search per engine, so models are loaded and clients connected before the first real request.
+        """
+        self.search("warm up", 1, list(ENGINES))
+
+    def start(self) -> None:
+        # Serves from a daemon thread, e.g. from a notebook
+        self._thread = threading.Thread(target=self._server.serve_forever, name="query-service", daemon=True)
+        self._thread.start()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@lru_cache(maxsize=None)
+def get_query_service(keyword_rag_index_name: str, clip_index_name: str) -> QueryService:
+    """
+    Process-wide query service for the two indexes, started on a daemon thread.
+    """
+    service = QueryService(keyword_rag_index_name, clip_index_name)
+    service.start()
+    return service
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keyword-rag-index", required=True)
+    parser.add_argument("--clip-index", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=QUERY_SERVICE_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=3.0)
+    parser.add_argument("--max-queue-size", type=int, default=256)
+    args = parser.parse_args()
+
+    service = QueryService(
+        args.keyword_rag_index,
+        args.clip_index,
+        host=args.host,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_queue_size=args.max_queue_size
+    )
+    service.warm_up()
+    print(f"Serving on {service.base_url}")
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+from typing import Dict, List
+
+# Standard damping constant from the reciprocal rank fusion paper (Cormack et al., 2009)
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: List[List[Dict]],
+    weights: List[float] = None,
+    top_k: int = None,
+    rrf_k: int = RRF_K
+) -> List[Dict]:
+    """
+    Fuses several best-first lists of {"id": ..., "score": ...} matches. Each list contributes
+    weight / (rrf_k + rank) for every id it contains; the fused score replaces the original ones.
+    """
+    if weights is None:
+        weights = [1.0] * len(ranked_lists)
+
+    fused_scores = {}
+    for ranked_list, weight in zip(ranked_lists, weights):
+        for rank, match in enumerate(ranked_list, start=1):
+            fused_scores[match["id"]] = fused_scores.get(match["id"], 0.0) + weight / (rrf_k + rank)
+
+    fused = sorted(fused_scores.items(), key=lambda item: item[1], reverse=True)
+    if top_k is not None:
+        fused = fused[:top_k]
+    return [{"id": match_id, "score": score} for match_id, score in fused]
@@ -0,0 +1,59 @@
+import os
+import json
+import threading
+from typing import Dict, List
+
+from file_utilities import atomic_write_json
+
+
+class TagSetManifest:
+    """
+    Records, for every tag set of an index, which image content, prompt and model config produced it.
+    Stored as a dotfile in the index's tag folder.
+    """
+
+    MANIFEST_FILE_NAME = ".manifest.json"
+
+    def __init__(self, tags_folder_file_path: str):
+        self.manifest_path = os.path.join(tags_folder_file_path, self.MANIFEST_FILE_NAME)
+        self.records = self._load()
+
+        # Batches are ingested concurrently, so updates and saves are serialized
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def save(self) -> None:
+        with self._lock:
+            atomic_write_json(self.manifest_path, self.records, indent=4)
+
+    @staticmethod
+    def create_record(image_file_name: str, image_hash: str, prompt_hash: str, model_config: Dict) -> Dict:
+        return {
+            "image_file_name": image_file_name,
+            "image_hash": image_hash,
+            "prompt_hash": prompt_hash,
+            "model_config": model_config
+        }
+
+    def is_up_to_date(self, tag_set_id: str, record: Dict) -> bool:
+        return self.records.get(tag_set_id) == record
+
+    def set(self, tag_set_id: str, record: Dict) -> None:
+        with self._lock:
+            self.records[tag_set_id] = record
+
+    def remove(self, tag_set_id: str) -> None:
+        with self._lock:
+            self.records.pop(tag_set_id, None)
+
+    def ids_for_missing_images(self, image_file_names: List[str]) -> List[str]:
+        current_image_file_names = set(image_file_names)
+        return [
+            tag_set_id for tag_set_id, record in self.records.items()
+            if record["image_file_name"] not in current_image_file_names
+        ]
@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from directories import IMAGE_TAG_SETS_FOLDER
+
+# Tag set ids are also used as Anthropic batch custom_ids, which are at most 64 characters of [a-zA-Z0-9_-]
+TAG_SET_ID_MAX_LENGTH = 64
+
+
+def tag_set_id(image_file_name: str) -> str:
+    name, ext = os.path.splitext(image_file_name)
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', name)[:TAG_SET_ID_MAX_LENGTH]
+
+
+def _join_list_or_return_string(s: str | List) -> str:
+    if type(s) == str:
+        return ": " + s
+    if type(s) == list:
+        return ":\n - " + "\n - ".join(s)
+    print("unable to reformat ", s)
+    return ""
+
+def _email_json_to_string(email_metadata_json: Dict) -> str:
+    email_tags_str = ""
+
+    for k, v in email_metadata_json.items():
+        email_tags_str = email_tags_str + "\n\n" + k + _join_list_or_return_string(v)
+
+    return (email_tags_str)
+
+
+def _email_json_values_to_string(email_metadata_json: Dict) -> str:
+    # Only the tag values, so the key names shared by every tag set do not end up in the lexical index
+    values = []
+    for v in email_metadata_json.values():
+        values.extend(v if type(v) == list else [v])
+    return "\n".join(str(value) for value in values)
+
+
+class TagSetStore:
+    """
+    All tag sets of one keyword-RAG index in a single SQLite file, keyed by tag set id (the email name).
+    Each row holds the raw tag dict as JSON and the string rendered by _email_json_to_string, so neither index
+    builds nor queries need to parse or re-render anything.
+
+    Tag sets from the older one-JSON-file-per-email folder are imported in one transaction, which also sets a marker
+    in the meta table. Until the marker is set, every time the store is opened retries the import. Imported files never
+    replace tag sets already in the store.
+    """
+
+    LEGACY_IMPORTED_KEY = "legacy_imported"
+
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.db_path = os.path.join(IMAGE_TAG_SETS_FOLDER, index_name + ".sqlite")
+        self.legacy_folder = os.path.join(IMAGE_TAG_SETS_FOLDER, index_name)
+        self._connections = threading.local()
+
+        connection = self._connection()
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS tag_sets (
+                id TEXT PRIMARY KEY, tags_json TEXT NOT NULL, tags_string TEXT NOT NULL
+            )"""
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if os.path.isdir(self.legacy_folder) and not self._legacy_imported():
+            self.import_folder(self.legacy_folder)
+
+    def _legacy_imported(self) -> bool:
+        return self._connection().execute(
+            "SELECT 1 FROM meta WHERE key = ?", (self.LEGACY_IMPORTED_KEY,)
+        ).fetchone() is not None
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._connections.connection = connection
+        return connection
+
+    @staticmethod
+    def _row(tag_set_id: str, tags_dict: Dict) -> Tuple[str, str, str]:
+        return tag_set_id, json.dumps(tags_dict), _email_json_to_string(tags_dict)
+
+    def put(self, tag_set_id: str, tags_dict: Dict) -> None:
+        self.put_many([(tag_set_id, tags_dict)])
+
+    def put_many(self, tag_sets: Iterable[Tuple[str, Dict]]) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT OR REPLACE INTO tag_sets VALUES (?, ?, ?)",
+                (self._row(tag_set_id, tags_dict) for tag_set_id, tags_dict in tag_sets)
+            )
+
+    def delete(self, tag_set_ids: List[str]) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("DELETE FROM tag_sets WHERE id = ?", ((tag_set_id,) for tag_set_id in tag_set_ids))
+
+    def contains(self, tag_set_id: str) -> bool:
+        return self._connection().execute(
+            "SELECT 1 FROM tag_sets WHERE id = ?", (tag_set_id,)
+        ).fetchone() is not None
+
+    def get(self, tag_set_id: str) -> Dict:
+        row = self._connection().execute("SELECT tags_json FROM tag_sets WHERE id = ?", (tag_set_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No tag set found for email: {tag_set_id}")
+        return json.loads(row[0])
+
+    def get_string(self, tag_set_id: str) -> str:
+        row = self._connection().execute("SELECT tags_string FROM tag_sets WHERE id = ?", (tag_set_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No tag set found for email: {tag_set_id}")
+        return row[0]
+
+    def documents(self) -> List[Dict[str, str]]:
+        """
+        All tag sets as {"id": ..., "text": <rendered tag string>} dicts, the form used for embedding.
+        """
+        return [
+            {"id": tag_set_id, "text": tags_string}
+            for tag_set_id, tags_string in self._connection().execute("SELECT id, tags_string FROM tag_sets")
+        ]
+
+    def lexical_documents(self) -> List[Dict[str, str]]:
+        """
+        All tag sets as {"id": ..., "text": <tag values>} dicts, the form used for the BM25 index.
+        """
+        return [
+            {"id": tag_set_id, "text": _email_json_values_to_string(json.loads(tags_json))}
+            for tag_set_id, tags_json in self._connection().execute("SELECT id, tags_json FROM tag_sets")
+        ]
+
+    def import_folder(self, folder: str) -> None:
+        def read_tag_sets():
+            for email_tags_file in os.listdir(folder):
+                if email_tags_file.startswith(".") or not email_tags_file.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(folder, email_tags_file), "r") as f:
+                        yield email_tags_file[:-len(".json")], json.load(f)
+                except json.JSONDecodeError:
+                    print(f"Skipping invalid JSON in {email_tags_file}")
+
+        # Any other error rolls the whole import back, and it is retried the next time the store is opened
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT OR IGNORE INTO tag_sets VALUES (?, ?, ?)",
+                (self._row(tag_set_id, tags_dict) for tag_set_id, tags_dict in read_tag_sets())
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", (self.LEGACY_IMPORTED_KEY, os.path.abspath(folder))
+            )
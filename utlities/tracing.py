@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextvars import ContextVar, copy_context
+from functools import lru_cache
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from directories import TRACE_EXPORTERS, TRACE_JSONL_PATH
+
+# The innermost open span in the current thread or task, so nested spans record their parent
+_current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+
+class SpanExporter:
+    """
+    Receives each finished span as a dict with name, trace_id, span_id, parent_id, start_time (unix seconds),
+    duration_ms, thread and attributes.
+    """
+
+    def export(self, span: Dict) -> None:
+        raise NotImplementedError
+
+
+class LogExporter(SpanExporter):
+
+    def export(self, span: Dict) -> None:
+        attributes = " ".join(f"{key}={value}" for key, value in span["attributes"].items())
+        print(f"[trace] {span['name']} {span['duration_ms']:.2f}ms {attributes}")
+
+
+class JSONLinesExporter(SpanExporter):
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", buffering=1)
+
+    def export(self, span: Dict) -> None:
+        line = json.dumps(span, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+
+class HistogramExporter(SpanExporter):
+    """
+    Keeps the most recent max_samples durations of each span name in memory.
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self._durations: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict) -> None:
+        with self._lock:
+            durations = self._durations.get(span["name"])
+            if durations is None:
+                durations = self._durations[span["name"]] = deque(maxlen=self.max_samples)
+            durations.append(span["duration_ms"])
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            durations_by_name = {name: np.asarray(durations) for name, durations in self._durations.items()}
+
+        return {
+            name: {
+                "count": len(durations),
+                "total_ms": float(durations.sum()),
+                "p50_ms": float(np.percentile(durations, 50)),
+                "p95_ms": float(np.percentile(durations, 95)),
+                "p99_ms": float(np.percentile(durations, 99))
+            }
+            for name, durations in sorted(durations_by_name.items())
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._durations.clear()
+
+
+class Span:
+
+    __slots__ = ("tracer", "name", "attributes", "span_id", "parent", "trace_id", "_start", "_start_time", "_token")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.parent = _current_span.get()
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = self.parent.trace_id if self.parent is not None else self.span_id
+        self._token = _current_span.set(self)
+        self._start_time = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        duration_ms = (time.perf_counter() - self._start) * 1000
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = repr(exc_value)
+
+        self.tracer._export({
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "start_time": self._start_time,
+            "duration_ms": duration_ms,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes
+        })
+
+
+class _NoOpSpan:
+    """
+    Returned by Tracer.span when no exporter is set up, so a disabled span costs one attribute check.
+    """
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def __enter__(self) -> "_NoOpSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+class Tracer:
+    """
+    Times pipeline stages with nested context-manager spans, and hands each finished span to every exporter.
+    With no exporters, spans are not created at all.
+
+        with get_tracer().span("keyword_rag.vector_query", queries=3) as span:
+            ...
+            span.set_attribute("matches", len(matches))
+    """
+
+    def __init__(self, exporters: List[SpanExporter] = None):
+        self.exporters: List[SpanExporter] = list(exporters or [])
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    def add_exporter(self, exporter: SpanExporter) -> None:
+        self.exporters = self.exporters + [exporter]
+
+    def remove_exporter(self, exporter: SpanExporter) -> None:
+        self.exporters = [e for e in self.exporters if e is not exporter]
+
+    def span(self, name: str, **attributes) -> "Span | _NoOpSpan":
+        if not self.exporters:
+            return _NO_OP_SPAN
+        return Span(self, name, attributes)
+
+    def _export(self, span: Dict) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                # A broken exporter must never fail the request being traced
+                print(f"Unable to export span {span['name']}: {e}")
+
+
+def _exporters_from_environment() -> List[SpanExporter]:
+    exporters = []
+    for exporter_name in filter(None, (name.strip() for name in (TRACE_EXPORTERS or "").split(","))):
+        if exporter_name == "log":
+            exporters.append(LogExporter())
+        elif exporter_name == "jsonl":
+            exporters.append(JSONLinesExporter(TRACE_JSONL_PATH or "traces.jsonl"))
+        elif exporter_name == "histogram":
+            exporters.append(HistogramExporter())
+        else:
+            print(f"Unknown trace exporter {exporter_name}, ignoring it")
+    return exporters
+
+
+@lru_cache(maxsize=None)
+def get_tracer() -> Tracer:
+    """
+    Process-wide tracer, with the exporters listed in TRACE_EXPORTERS (any of "log", "jsonl", "histogram").
+    Tracing is off when it is unset.
+    """
+    return Tracer(_exporters_from_environment())
+
+
+def trace_span(name: str, **attributes) -> "Span | _NoOpSpan":
+    return get_tracer().span(name, **attributes)
+
+
+def bind_trace_context(fn: Callable) -> Callable:
+    """
+    Wraps fn so that spans it opens on a pool thread are children of the span open here. Bind once per task,
+    since a bound function cannot run on two threads at once.
+    """
+    if not get_tracer().enabled:
+        return fn
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
@@ -0,0 +1,479 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
+
+import numpy as np
+
+from directories import VECTOR_INDEXES_FOLDER
+from file_utilities import atomic_write_json
+
+
+class VectorStore:
+    """
+    Backend the search handlers and index builders read and write vectors through.
+    Query results are returned as a list of {"id": ..., "score": ...} dicts, best match first.
+    """
+
+    def upsert(self, vectors: List[Dict]) -> None:
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]) -> None:
+        raise NotImplementedError
+
+    def query(self, vector: List[float], top_k: int) -> List[Dict]:
+        raise NotImplementedError
+
+    def query_many(self, vectors: List[List[float]], top_k: int) -> List[List[Dict]]:
+        return [self.query(vector, top_k) for vector in vectors]
+
+    def describe(self) -> Dict:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """
+        Number of vectors stored.
+        """
+        raise NotImplementedError
+
+    @property
+    def location(self) -> str:
+        """
+        Identifies where vectors are stored, so state about what was upserted can be tied to one store.
+        """
+        raise NotImplementedError
+
+
+class PineconeVectorStore(VectorStore):
+    """
+    Upserts are split into requests of UPSERT_BATCH_SIZE vectors, since Pinecone rejects upsert requests over 2 MB
+    (about 100 1024-d vectors as JSON), and deletes into requests of DELETE_BATCH_SIZE ids, the most it accepts.
+    """
+
+    UPSERT_BATCH_SIZE = 100
+    DELETE_BATCH_SIZE = 1000
+
+    def __init__(self, index, namespace: str):
+        self.index = index
+        self.namespace = namespace
+
+    def upsert(self, vectors: List[Dict]) -> None:
+        for i in range(0, len(vectors), self.UPSERT_BATCH_SIZE):
+            self.index.upsert(
+                vectors=vectors[i:i + self.UPSERT_BATCH_SIZE],
+                namespace=self.namespace
+            )
+
+    def delete(self, ids: List[str]) -> None:
+        for i in range(0, len(ids), self.DELETE_BATCH_SIZE):
+            self.index.delete(ids=ids[i:i + self.DELETE_BATCH_SIZE], namespace=self.namespace)
+
+    def query(self, vector: List[float], top_k: int) -> List[Dict]:
+        results = self.index.query(
+            namespace=self.namespace,
+            vector=vector,
+            top_k=top_k,
+            include_values=False,
+            include_metadata=False
+        )
+        return [{"id": m["id"], "score": m["score"]} for m in results["matches"]]
+
+    def query_many(self, vectors: List[List[float]], top_k: int, max_workers: int = 8) -> List[List[Dict]]:
+        # Pinecone queries take one vector each, so they are sent concurrently instead
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda vector: self.query(vector, top_k), vectors))
+
+    def describe(self) -> Dict:
+        return self.index.describe_index_stats()
+
+    def count(self) -> int:
+        namespace = self.describe()["namespaces"].get(self.namespace)
+        return namespace["vector_count"] if namespace else 0
+
+    @property
+    def location(self) -> str:
+        return f"pinecone:{self.namespace}"
+
+
+def _encode_ids(ids: List[str], start_offset: int = 0) -> Tuple[bytes, np.ndarray]:
+    encoded = [vector_id.encode("utf-8") for vector_id in ids]
+    ends = start_offset + np.cumsum([len(vector_id) for vector_id in encoded], dtype=np.int64)
+    return b"".join(encoded), ends
+
+
+class MappedIdTable:
+    """
+    Read-only list of string ids, stored as their concatenated UTF-8 bytes and the int64 end offset of each id.
+    Both files are memory-mapped, so opening a table of millions of ids parses nothing, and looking up the id of a
+    result reads a few bytes.
+    """
+
+    def __init__(self, data_path: str, ends_path: str, count: int):
+        self.count = count
+        self._ends = np.zeros(0, dtype=np.int64)
+        self._data = np.zeros(0, dtype=np.uint8)
+        if count:
+            self._ends = np.memmap(ends_path, dtype=np.int64, mode="r", shape=(count,))
+            if self._ends[-1]:
+                self._data = np.memmap(data_path, dtype=np.uint8, mode="r", shape=(int(self._ends[-1]),))
+
+    @staticmethod
+    def write(ids: List[str], data_path: str, ends_path: str) -> None:
+        data, ends = _encode_ids(ids)
+        for path, content in ((data_path, data), (ends_path, ends.tobytes())):
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def encoded_nbytes(ids) -> int:
+        if isinstance(ids, MappedIdTable):
+            return ids.nbytes
+        return sum(len(vector_id.encode("utf-8")) for vector_id in ids) + 8 * len(ids)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self._data.nbytes + self._ends.nbytes)
+
+    @property
+    def data_nbytes(self) -> int:
+        return int(self._data.nbytes)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, row: int) -> str:
+        row = int(row)
+        if row < 0:
+            row += self.count
+        if not 0 <= row < self.count:
+            raise IndexError(f"Row {row} out of range for {self.count} ids")
+        start = int(self._ends[row - 1]) if row else 0
+        return self._data[start:int(self._ends[row])].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self) -> List[str]:
+        data = self._data.tobytes()
+        ends = self._ends.tolist()
+        return [data[start:end].decode("utf-8") for start, end in zip([0] + ends[:-1], ends)]
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Exact cosine search over a local index folder. Vectors are stored L2-normalized as a raw float32 matrix and
+    opened with np.memmap, so there is no load step and worker processes share the same page cache.
+    Row order of the matrix matches the memory-mapped ID table.
+
+    Writes are incremental: new vectors are appended to the matrix and ID table, vectors of existing ids are
+    overwritten in place, and deleted rows are only marked as deleted until compact() rewrites the files without
+    them. meta.json holds the row count and is written last, so a crashed write leaves the previous rows intact.
+    """
+
+    VECTORS_FILE = "vectors.f32"
+    IDS_FILE = "ids.utf8"
+    ID_ENDS_FILE = "id_ends.i64"
+    DELETED_FILE = "deleted.u8"
+    META_FILE = "meta.json"
+    # ID table written before writes were incremental, converted on first use
+    LEGACY_IDS_FILE = "ids.json"
+
+    def __init__(self, index_folder: str):
+        self.index_folder = index_folder
+        self._meta_cache = None
+        self._ids = None
+        self._vectors = None
+        self._deleted = None
+        # Id -> row of every live vector, built on the first write
+        self._row_for_id = None
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def for_index(cls, index_name: str) -> "LocalVectorStore":
+        return cls(os.path.join(VECTOR_INDEXES_FOLDER, index_name))
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.index_folder, file_name)
+
+    def _migrate_legacy_id_table(self) -> None:
+        with open(self._path(self.LEGACY_IDS_FILE), "r") as f:
+            id_table = json.load(f)
+        ids = id_table["ids"]
+        MappedIdTable.write(ids, self._path(self.IDS_FILE), self._path(self.ID_ENDS_FILE))
+        np.zeros(len(ids), dtype=np.uint8).tofile(self._path(self.DELETED_FILE))
+        atomic_write_json(self._path(self.META_FILE), {
+            "dimension": id_table["dimension"],
+            "count": len(ids),
+            "deleted_count": 0,
+            "version": 0
+        })
+        os.remove(self._path(self.LEGACY_IDS_FILE))
+
+    def _meta(self) -> Dict:
+        if self._meta_cache is None:
+            if not os.path.exists(self._path(self.META_FILE)):
+                if not os.path.exists(self._path(self.LEGACY_IDS_FILE)):
+                    return {"dimension": None, "count": 0, "deleted_count": 0, "version": None}
+                self._migrate_legacy_id_table()
+            with open(self._path(self.META_FILE), "r") as f:
+                self._meta_cache = json.load(f)
+        return self._meta_cache
+
+    def _reset(self) -> None:
+        self._meta_cache = None
+        self._ids = None
+        self._vectors = None
+        self._deleted = None
+
+    @property
+    def version(self) -> int | None:
+        """
+        Incremented by every write, or None before the first one.
+        """
+        return self._meta()["version"]
+
+    @property
+    def ids(self) -> MappedIdTable:
+        # Deleted rows keep their id until compact()
+        if self._ids is None:
+            self._ids = MappedIdTable(self._path(self.IDS_FILE), self._path(self.ID_ENDS_FILE), self._meta()["count"])
+        return self._ids
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            meta = self._meta()
+            if not meta["count"]:
+                self._vectors = np.zeros((0, meta["dimension"] or 0), dtype=np.float32)
+            else:
+                self._vectors = np.memmap(
+                    self._path(self.VECTORS_FILE),
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(meta["count"], meta["dimension"])
+                )
+        return self._vectors
+
+    @property
+    def deleted(self) -> np.ndarray | None:
+        """
+        Boolean mask of the rows deleted since the last compact(), or None if there are none.
+        """
+        meta = self._meta()
+        if not meta["deleted_count"]:
+            return None
+        if self._deleted is None:
+            self._deleted = np.fromfile(self._path(self.DELETED_FILE), dtype=np.uint8, count=meta["count"]) != 0
+        return self._deleted
+
+    def live_rows(self) -> np.ndarray:
+        deleted = self.deleted
+        if deleted is None:
+            return np.arange(self._meta()["count"])
+        return np.flatnonzero(~deleted)
+
+    def __len__(self) -> int:
+        meta = self._meta()
+        return meta["count"] - meta["deleted_count"]
+
+    def nbytes(self) -> int:
+        return int(self.vectors.nbytes) + self.ids.nbytes
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _row_for_id_map(self) -> Dict[str, int]:
+        if self._row_for_id is None:
+            deleted = self.deleted
+            self._row_for_id = {
+                vector_id: row for row, vector_id in enumerate(self.ids.tolist())
+                if deleted is None or not deleted[row]
+            }
+        return self._row_for_id
+
+    def _write_meta(self, meta: Dict, **changes) -> None:
+        os.makedirs(self.index_folder, exist_ok=True)
+        atomic_write_json(self._path(self.META_FILE), {
+            **meta,
+            **changes,
+            "version": (meta["version"] or 0) + 1
+        })
+        self._reset()
+
+    def _truncate_to(self, meta: Dict) -> None:
+        # Drops anything a crashed write appended after the last row recorded in meta.json
+        count = meta["count"]
+        for file_name, size in (
+            (self.VECTORS_FILE, count * (meta["dimension"] or 0) * 4),
+            (self.IDS_FILE, self.ids.data_nbytes),
+            (self.ID_ENDS_FILE, count * 8),
+            (self.DELETED_FILE, count)
+        ):
+            path = self._path(file_name)
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            elif os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def upsert(self, vectors: List[Dict]) -> None:
+        if not vectors:
+            return
+
+        with self._write_lock:
+            try:
+                self._upsert(vectors)
+            except Exception:
+                self._row_for_id = None
+                raise
+
+    def _upsert(self, vectors: List[Dict]) -> None:
+        new_values = self._normalize(np.asarray([v["values"] for v in vectors], dtype=np.float32))
+
+        meta = self._meta()
+        if meta["dimension"] is not None and meta["count"] and meta["dimension"] != new_values.shape[1]:
+            raise ValueError(
+                f"Vector dimension {new_values.shape[1]} does not match index dimension {meta['dimension']}"
+            )
+
+        row_for_id = self._row_for_id_map()
+        overwritten_rows, overwritten_values = {}, {}
+        appended_ids, appended_values = [], []
+        for vector, values in zip(vectors, new_values):
+            row = row_for_id.get(vector["id"])
+            if row is None:
+                row_for_id[vector["id"]] = meta["count"] + len(appended_ids)
+                appended_ids.append(vector["id"])
+                appended_values.append(values)
+            elif row >= meta["count"]:
+                # Repeated within this call
+                appended_values[row - meta["count"]] = values
+            else:
+                overwritten_rows[vector["id"]] = row
+                overwritten_values[vector["id"]] = values
+
+        os.makedirs(self.index_folder, exist_ok=True)
+        self._truncate_to(meta)
+
+        if overwritten_rows:
+            rows = np.fromiter(overwritten_rows.values(), dtype=np.int64, count=len(overwritten_rows))
+            existing = np.memmap(
+                self._path(self.VECTORS_FILE),
+                dtype=np.float32,
+                mode="r+",
+                shape=(meta["count"], meta["dimension"])
+            )
+            existing[rows] = np.asarray(list(overwritten_values.values()))
+            existing.flush()
+            del existing
+
+        if appended_ids:
+            id_data, id_ends = _encode_ids(appended_ids, self.ids.data_nbytes)
+            for file_name, content in (
+                (self.VECTORS_FILE, np.ascontiguousarray(appended_values, dtype=np.float32).tobytes()),
+                (self.IDS_FILE, id_data),
+                (self.ID_ENDS_FILE, id_ends.tobytes()),
+                (self.DELETED_FILE, bytes(len(appended_ids)))
+            ):
+                with open(self._path(file_name), "ab") as f:
+                    f.write(content)
+
+        self._write_meta(
+            meta,
+            dimension=int(new_values.shape[1]),
+            count=meta["count"] + len(appended_ids)
+        )
+
+    def delete(self, ids: List[str]) -> None:
+        with self._write_lock:
+            try:
+                self._delete(ids)
+            except Exception:
+                self._row_for_id = None
+                raise
+
+    def _delete(self, ids: List[str]) -> None:
+        row_for_id = self._row_for_id_map()
+        rows = [row_for_id.pop(vector_id) for vector_id in set(ids) if vector_id in row_for_id]
+        if not rows:
+            return
+
+        meta = self._meta()
+        deleted = np.memmap(self._path(self.DELETED_FILE), dtype=np.uint8, mode="r+", shape=(meta["count"],))
+        deleted[rows] = 1
+        deleted.flush()
+        del deleted
+        self._write_meta(meta, deleted_count=meta["deleted_count"] + len(rows))
+
+    def compact(self, chunk_rows: int = 65536) -> None:
+        """
+        Rewrites the index without deleted rows, copying chunk_rows vectors at a time. Rows are renumbered, so
+        anything holding row numbers (an ANN index built from this store) must be rebuilt.
+        """
+        with self._write_lock:
+            meta = self._meta()
+            if not meta["deleted_count"]:
+                return
+
+            live_rows = self.live_rows()
+            ids = self.ids.tolist()
+            id_data, id_ends = _encode_ids([ids[row] for row in live_rows])
+
+            # Every file is written in full before any is swapped in
+            with open(self._path(self.VECTORS_FILE) + ".tmp", "wb") as f:
+                for start in range(0, len(live_rows), chunk_rows):
+                    f.write(np.ascontiguousarray(self.vectors[live_rows[start:start + chunk_rows]]).tobytes())
+            for file_name, content in (
+                (self.IDS_FILE, id_data),
+                (self.ID_ENDS_FILE, id_ends.tobytes()),
+                (self.DELETED_FILE, bytes(len(live_rows)))
+            ):
+                with open(self._path(file_name) + ".tmp", "wb") as f:
+                    f.write(content)
+            for file_name in (self.VECTORS_FILE, self.IDS_FILE, self.ID_ENDS_FILE, self.DELETED_FILE):
+                os.replace(self._path(file_name) + ".tmp", self._path(file_name))
+
+            self._write_meta(meta, count=len(live_rows), deleted_count=0)
+            self._row_for_id = None
+
+    def query(self, vector: List[float], top_k: int) -> List[Dict]:
+        return self.query_many([vector], top_k)[0]
+
+    def query_many(self, vectors: List[List[float]], top_k: int) -> List[List[Dict]]:
+        if not len(self):
+            return [[] for _ in vectors]
+
+        query_vectors = self._normalize(np.asarray(vectors, dtype=np.float32))
+        scores = query_vectors @ self.vectors.T
+        deleted = self.deleted
+        if deleted is not None:
+            scores[:, deleted] = -np.inf
+
+        k = min(top_k, len(self))
+        top_rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top_rows, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_rows = np.take_along_axis(top_rows, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [
+            [{"id": self.ids[row], "score": float(score)} for row, score in zip(rows, row_scores)]
+            for rows, row_scores in zip(top_rows, top_scores)
+        ]
+
+    def describe(self) -> Dict:
+        return {
+            "dimension": self._meta()["dimension"] if len(self) else None,
+            "total_vector_count": len(self)
+        }
+
+    def count(self) -> int:
+        return len(self)
+
+    @property
+    def location(self) -> str:
+        return "local:" + os.path.abspath(self.index_folder)